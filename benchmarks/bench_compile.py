@@ -0,0 +1,98 @@
+"""Measure how long compiling turns keeps the event loop from serving players.
+
+Builds long turns out of the sample transcripts (their dialogue repeated),
+then compiles a batch of them while a ticker on the same event loop wakes
+every millisecond, and reports the throughput and how late the ticker woke
+(median, 99th percentile and worst): compiling on the loop, fragment by
+fragment as `generate_diffs` does, then whole turns with `compile_turn` on
+threads and on processes, which `vnml.compiler` used to offer.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_compile
+"""
+
+import asyncio
+import re
+import statistics
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterator
+
+from vnml.compiler import DISPLAY_DEFAULTS, Diff, GameSnapshot, calculate_diff, compile_turn, vnml2log
+from vnml.components.playground import outputs
+from vnml.parser import stream_vnml_parser, tag_of
+
+TICK = 0.001
+
+
+def long_turn(transcript: str, repeat: int) -> str:
+    """`transcript` with every `<dialogue>` block said `repeat` times, lines numbered."""
+    def dialogue(match: re.Match) -> str:
+        return "".join(match[0].replace("\n<narration>\n", f"\n<narration>\n{i}. ") for i in range(repeat))
+    return re.sub(r"<dialogue>.*?</dialogue>\n", dialogue, transcript, flags=re.S)
+
+
+def per_fragment(document: str, snapshot: GameSnapshot) -> Iterator[Diff]:
+    """The diffs of `document`, compiled one fragment at a time."""
+    for vnml in stream_vnml_parser([document]):
+        diff = calculate_diff(snapshot, vnml2log(vnml, snapshot.characters), vnml)
+        snapshot += diff
+        yield diff
+        if tag_of(vnml) == "options":
+            break
+
+
+async def _ticker(lags: list[float], stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def _run(documents: list[str], pool: Executor | None) -> tuple[float, list[float], int]:
+    lags, stop = [], asyncio.Event()
+    ticker = asyncio.create_task(_ticker(lags, stop))
+    await asyncio.sleep(0)
+    snapshot = GameSnapshot(*DISPLAY_DEFAULTS.values())
+    started = time.perf_counter()
+    if pool is None:
+        diffs = 0
+        for document in documents:
+            for _ in per_fragment(document, GameSnapshot(*DISPLAY_DEFAULTS.values())):
+                diffs += 1
+                await asyncio.sleep(0)  # as the model writes them, the loop gets a turn between fragments
+    else:
+        loop = asyncio.get_running_loop()
+        turns = await asyncio.gather(*(loop.run_in_executor(pool, compile_turn, document, snapshot)
+                                       for document in documents))
+        diffs = sum(len(turn.diffs) for turn in turns)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    return elapsed, lags, diffs
+
+
+def main(repeat: int = 20, count: int = 32, workers: int = 4):
+    documents = [long_turn(outputs[i % len(outputs)], repeat) for i in range(count)]
+    fragments = urls = 0
+    for document in documents:  # also warms the URL caches, which the modes share in this process
+        turn = compile_turn(document, GameSnapshot(*DISPLAY_DEFAULTS.values()))
+        assert len(turn.diffs) == len(list(per_fragment(document, GameSnapshot(*DISPLAY_DEFAULTS.values()))))
+        fragments, urls = fragments + len(turn.diffs), urls + len(turn.urls)
+    print(f"{count} turns, {fragments} fragments, {urls} media URLs")
+    print(f"{'':<16} {'diffs/s':>9} {'median lag':>11} {'p99 lag':>10} {'worst lag':>10}")
+    for mode, pool in (("on the loop", None), ("threads", ThreadPoolExecutor(workers)),
+                       ("processes", ProcessPoolExecutor(workers))):
+        if pool is not None:
+            asyncio.run(_run(documents[:workers], pool))  # start the workers
+        elapsed, lags, diffs = asyncio.run(_run(documents, pool))
+        p99 = statistics.quantiles(lags, n=100, method="inclusive")[-1]
+        print(f"{mode:<16} {diffs / elapsed:>9.0f} {statistics.median(lags) * 1e3:>8.2f} ms "
+              f"{p99 * 1e3:>7.2f} ms {max(lags) * 1e3:>7.2f} ms")
+        if pool is not None:
+            pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Compare the compact history store against a plain list of diff dicts.
+
+Builds a long session by replaying the sample transcripts with varied lines,
+then reports, for the `list[dict]` that used to live in the Reflex state and
+for `HistoryBuffer`, the memory held per diff, the serialized size per diff, the
+serialization work per event (Reflex pickled the whole list; the buffer
+encodes the new record) and the time to serialize the whole session.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_diff_store
+"""
+
+import pickle
+import sys
+import timeit
+
+from vnml.compiler import DISPLAY_DEFAULTS, GameSnapshot, calculate_diff, vnml2log
+from vnml.components.playground import outputs
+from vnml.history import HistoryBuffer
+from vnml.parser import stream_vnml_parser
+
+
+def session(lines: int) -> list[dict]:
+    """`Diff.__dict__`s of a session of at least `lines` lines."""
+    transcripts = [list(stream_vnml_parser(transcript)) for transcript in outputs]
+    snapshot = GameSnapshot(*DISPLAY_DEFAULTS.values())
+    diffs = []
+    while len(diffs) < lines:
+        for fragments in transcripts:
+            for vnml in fragments:
+                # Number the spoken lines, so that only scenes and sprites repeat.
+                vnml = vnml.replace(">\n", f">\n{len(diffs)}. ", 1) if "<options" not in vnml else vnml
+                diff = calculate_diff(snapshot, vnml2log(vnml, snapshot.characters), vnml, "\n")
+                snapshot += diff
+                diffs.append(diff.__dict__)
+    return diffs
+
+
+def deep_size(obj, seen: set | None = None) -> int:
+    """Bytes held by `obj` and everything it references, counting shared objects once."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_size(getattr(obj, name), seen) for name in obj.__slots__)
+    return size
+
+
+def main(lines: int = 1200, number: int = 20):
+    diffs = session(lines)
+    history = HistoryBuffer()
+    for diff in diffs:
+        history.append(diff)
+    assert [history.vnml_at(i) for i in range(len(history))] == [diff["vnml"] for diff in diffs]
+    data = history.to_bytes()
+    restored = HistoryBuffer.from_bytes(data)
+    assert [restored[i] for i in range(len(restored))] == [history[i] for i in range(len(history))]
+
+    pickled = pickle.dumps(diffs)
+    pickle_time = timeit.timeit(lambda: pickle.dumps(diffs), number=number) / number
+    append_time = timeit.timeit(lambda: HistoryBuffer()._encode(history._diffs[-1]), number=number * 100)
+    append_time /= number * 100
+    held = [history._diffs, history._ends, history._strings, history._encoded, history._encoded_ends]
+    rows = [
+        # Reflex pickled the whole list on every event.
+        ("list[dict] + pickle", deep_size(diffs), len(pickled), pickle_time, pickle_time),
+        # Each event encodes one record; saving the session is a copy.
+        ("HistoryBuffer + to_bytes", deep_size(held), len(data), append_time,
+         timeit.timeit(history.to_bytes, number=number) / number),
+    ]
+    print(f"{len(diffs)} diffs")
+    print(f"{'':<26} {'memory/diff':>12} {'bytes/diff':>11} {'per event':>10} {'session':>10}")
+    for name, memory, size, event, seconds in rows:
+        print(f"{name:<26} {memory / len(diffs):>10.0f} B {size / len(diffs):>9.0f} B "
+              f"{event * 1e6:>7.1f} us {seconds * 1e3:>7.2f} ms")
+    load = timeit.timeit(lambda: HistoryBuffer.from_bytes(data), number=number) / number
+    print(f"HistoryBuffer.from_bytes: {load * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
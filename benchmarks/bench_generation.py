@@ -0,0 +1,107 @@
+"""Measure how generating turns affects the web worker, and who waits for them.
+
+Starts `benchmarks.mock_llama_cpp` in its own process, then has one player
+ask for a batch of turns (a live turn and its speculative branches) right
+before several other players ask for one each. It reports the turns per
+second, how late a ticker on the web worker's event loop woke (the latency
+every other event handler sees), and how long each kind of player waited for
+the first line of a turn: generating in the web worker, then on the
+generation workers with one queue for everybody, and with a queue per player.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_generation
+"""
+
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from vnml import generation, scheduler as scheduling
+from vnml.compiler import DISPLAY_DEFAULTS, GameSnapshot, TurnCompiler
+from vnml.components.playground import generate_diffs
+from vnml.history import HistoryBuffer
+from vnml.llm import PARALLEL_SLOTS, llm
+
+PORT = 8093
+TICK = 0.001
+
+
+async def _turn(session: str, started: float, waits: dict[str, float]) -> int:
+    history, snapshot = HistoryBuffer(), GameSnapshot(*DISPLAY_DEFAULTS.values())
+    # A start action of its own, or the scheduler would merge all these turns into one.
+    for diff in TurnCompiler(snapshot).feed(f"<action>Start, {session}!</action>").diffs:
+        history.append(diff.__dict__)
+    async for diff in generate_diffs(history, snapshot, "en", session):
+        if len(history) == 1:  # the first line the model wrote
+            waits[session] = time.perf_counter() - started
+        history.append(diff.__dict__)
+    return len(history)
+
+
+async def _ticker(lags: list[float], stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def _run(mode: str, branches: int, players: int) -> tuple[float, list[float], dict[str, float]]:
+    if mode != "web worker":
+        generation._pool = generation.GenerationPool(PARALLEL_SLOTS)
+        generation._pool.start()
+        await asyncio.gather(*(_turn(f"warm-up-{i}", 0, {}) for i in range(PARALLEL_SLOTS)))
+    lags, stop, waits = [], asyncio.Event(), {}
+    ticker = asyncio.create_task(_ticker(lags, stop))
+    started = time.perf_counter()
+    sessions = [f"eager/{i}" for i in range(branches)] + [f"player-{i}" for i in range(players)]
+    turns = []
+    for session in sessions:  # in this order, as if one tick apart
+        turns.append(asyncio.create_task(_turn(session, started, waits)))
+        await asyncio.sleep(0)
+    await asyncio.gather(*turns)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    if mode != "web worker":
+        generation._pool.close()
+    return len(sessions) / elapsed, lags, waits
+
+
+def main(branches: int = 8, players: int = 6, delay: float = 0.002):
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.mock_llama_cpp", "--port", str(PORT),
+                               "--parallel", str(PARALLEL_SLOTS), "--delay", str(delay)])
+    base_url, workers, player = llm.client.base_url, generation.GENERATION_WORKERS, scheduling.player
+    llm.client.base_url = f"http://127.0.0.1:{PORT}"
+    try:
+        while True:
+            try:
+                httpx.get(f"{llm.client.base_url}/health")
+                break
+            except httpx.ConnectError:
+                time.sleep(0.1)
+        print(f"{branches} turns of one player, then {players} players with one turn each, "
+              f"{PARALLEL_SLOTS} slots")
+        print(f"{'':<22} {'turns/s':>8} {'median lag':>11} {'p99 lag':>9} "
+              f"{'first line: eager':>18} {'others':>8}")
+        for mode in ("web worker", "one queue", "queue per player"):
+            generation.GENERATION_WORKERS = 0 if mode == "web worker" else PARALLEL_SLOTS
+            scheduling.player = (lambda session: "") if mode == "one queue" else player
+            scheduling.scheduler.__init__()
+            rate, lags, waits = asyncio.run(_run(mode, branches, players))
+            eager = [wait for session, wait in waits.items() if session.startswith("eager")]
+            others = [wait for session, wait in waits.items() if not session.startswith("eager")]
+            print(f"{mode:<22} {rate:>8.2f} {statistics.median(lags) * 1e3:>8.2f} ms "
+                  f"{statistics.quantiles(lags, n=100, method='inclusive')[-1] * 1e3:>6.2f} ms "
+                  f"{statistics.mean(eager):>16.2f} s {statistics.mean(others):>6.2f} s")
+    finally:
+        server.terminate()
+        llm.client.base_url, generation.GENERATION_WORKERS, scheduling.player = base_url, workers, player
+
+
+if __name__ == "__main__":
+    main()
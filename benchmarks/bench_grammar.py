@@ -0,0 +1,91 @@
+"""Measure the turns that have to be written again without a grammar, and with one.
+
+First checks `vnml.grammar.validate` against a corpus: every sample turn of
+`vnml.components.playground.outputs` must pass, and reports which of the
+`DEFECTS` of `benchmarks.mock_llama_cpp` applied to it do not, since those
+are what sampling with the grammar rules out. Then has the mock, writing some
+turns with a defect, only one the grammar allows when it is sent the grammar,
+write turns until they are valid, and reports how many had to be written
+again, the tokens thrown away and the defects left in turns that passed.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_grammar
+"""
+
+import asyncio
+import contextlib
+
+from benchmarks.bench_scheduler import story
+from benchmarks.mock_llama_cpp import DEFECTS, start
+from vnml.components import playground
+from vnml.components.playground import action_diff, completion_params, outputs, turn_prompt
+from vnml.grammar import gbnf, resume_point, validate
+from vnml.llm import CompletionMetrics, llm, stream_completion
+
+MAX_ATTEMPTS = 4
+
+
+def corpus() -> list[tuple[str, str]]:
+    """`(defect or "", turn)` pairs: the sample turns, as written after the continue cue, and their defects."""
+    turns = []
+    for transcript in outputs:
+        turn = transcript[transcript.index("<scene>\n") + len("<scene>\n"):]
+        turn = turn[:turn.index("</options>") + len("</options>")]
+        turns.append(("", turn))
+        turns.extend((name, defect(turn)) for name, defect in DEFECTS.items())
+    return turns
+
+
+async def _turn(prompt: str, after: str) -> tuple[int, int]:
+    """Write a turn until it is valid; returns the attempts and the tokens of those thrown away."""
+    wasted = 0
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        metrics = CompletionMetrics()
+        texts = stream_completion(prompt, metrics, **completion_params(0, after))
+        async with contextlib.aclosing(texts) as texts:
+            text = "".join([text async for text in texts])
+        if validate(text, after):
+            return attempt, wasted
+        wasted += metrics.predicted_tokens
+    return MAX_ATTEMPTS + 1, wasted
+
+
+async def _run(turns: int) -> list[tuple[int, int]]:
+    history, snapshot, options = story("Eli")
+    history.append(action_diff(snapshot, options[0]).__dict__)
+    cue, prompt = await turn_prompt(history, "en", "bench")
+    return [await _turn(prompt, resume_point(history.vnml_at(-1), cue)) for _ in range(turns)]
+
+
+def main(turns: int = 200, defects: float = 0.2):
+    print(f"{'corpus':<24} {'turns':>6} {'rejected':>9}")
+    for name in ("", *DEFECTS):
+        results = [validate(turn) for defect, turn in corpus() if defect == name]
+        print(f"{name or 'sample turns':<24} {len(results):>6} {results.count(False):>9}")
+    print(f"\ngrammar: {len(gbnf())} bytes")
+
+    server = start(defects=defects)
+    base_url, grammar = llm.client.base_url, playground.GRAMMAR
+    llm.client.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"\n{turns} turns, {defects:.0%} of them malformed without a grammar, at most {MAX_ATTEMPTS} attempts")
+    print(f"{'':<16} {'retry rate':>11} {'given up':>9} {'tokens':>8} {'wasted':>8} {'defects kept':>13}")
+    try:
+        for mode in ("no grammar", "grammar"):
+            playground.GRAMMAR = mode == "grammar"
+            server.predicted = server.defective = 0
+            results = asyncio.run(_run(turns))
+            retries = sum(min(attempts, MAX_ATTEMPTS) - 1 for attempts, _ in results)
+            given_up = sum(attempts > MAX_ATTEMPTS for attempts, _ in results)
+            wasted = sum(wasted for _, wasted in results)
+            # Every attempt thrown away had a defect; the others are in turns that were kept.
+            kept = server.defective - retries - given_up
+            print(f"{mode:<16} {retries / turns:>10.1%} {given_up:>9} {server.predicted:>8} "
+                  f"{wasted:>7} ({wasted / server.predicted:.0%}) {kept:>6}")
+    finally:
+        server.shutdown()
+        llm.client.base_url, playground.GRAMMAR = base_url, grammar
+
+
+if __name__ == "__main__":
+    main()
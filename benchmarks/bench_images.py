@@ -0,0 +1,91 @@
+"""Measure how long a new background or sprite leaves the screen empty.
+
+Takes every background and sprite of the sample `outputs` and requests it
+from `benchmarks.stub_media`, whose images take longer the more pixels they
+have, like SDXL, one at a time as on one GPU: at the sizes the playground used
+to ask for, at those of `vnml.compiler.image_size`, and with a preview
+requested first. Reports the time to the first picture, the time to the full
+image, and the megapixels rendered.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_images
+"""
+
+import statistics
+import time
+
+import httpx
+
+from benchmarks.stub_media import DELAYS, start
+from vnml import compiler
+from vnml.compiler import (BACKGROUND_PREVIEW, BACKGROUND_SIZE, DISPLAY_DEFAULTS, SPRITE_PREVIEW, SPRITE_SIZE,
+                           GameSnapshot, background_url, calculate_diff, character_url, vnml2log)
+from vnml.components.playground import outputs
+from vnml.parser import decode_fragment, stream_vnml_parser
+
+MODES = {
+    "1600x960, 1024x1024": ((1600, 960), (1024, 1024), None, None),
+    "viewport": (BACKGROUND_SIZE, SPRITE_SIZE, None, None),
+    "viewport + preview": (BACKGROUND_SIZE, SPRITE_SIZE, BACKGROUND_PREVIEW, SPRITE_PREVIEW),
+}
+
+
+def images() -> list[tuple[str, tuple]]:
+    """`("background", (keywords,))` and `("sprite", (identifier, emotion, clothes))` of every new image shown."""
+    snapshot, seen = GameSnapshot(*DISPLAY_DEFAULTS.values()), []
+    for transcript in outputs:
+        for vnml in stream_vnml_parser(transcript):
+            snapshot += calculate_diff(snapshot, vnml2log(vnml, snapshot.characters), vnml)
+            fragment = decode_fragment(vnml)
+            if fragment is not None and fragment.tag == "scene":
+                seen.append(("background", (fragment.find("background").attrs["keywords"],)))
+            elif fragment is not None and fragment.tag == "character":
+                look = snapshot.characters[fragment.attrs["name"]]
+                seen.append(("sprite", (look["identifier"], look["emotion"], look["clothes"])))
+    return list(dict.fromkeys(seen))
+
+
+def _url(kind: str, args: tuple, size: tuple[int, int]) -> str:
+    if kind == "background":
+        return background_url(*args, *size)
+    return character_url(*args, *size)
+
+
+def _fetch(client: httpx.Client, url: str) -> float:
+    started = time.perf_counter()
+    client.get(url).raise_for_status()
+    return time.perf_counter() - started
+
+
+def main(delay: float = 0.1, per_megapixel: float = 2.0):
+    server = start(delays={**DELAYS, "image": delay}, per_megapixel=per_megapixel)
+    base_url = compiler.BASE_URL
+    compiler.BASE_URL = f"http://127.0.0.1:{server.server_address[1]}/"
+    character_url.cache_clear()
+    shown = images()
+    print(f"{len(shown)} images, rendered in {delay:.2f} s + {per_megapixel:.1f} s a megapixel")
+    print(f"{'':<22} {'first picture: p50':>19} {'max':>7} {'full image: p50':>16} {'max':>7} {'megapixels':>11}")
+    try:
+        with httpx.Client(timeout=60) as client:
+            for mode, (background, sprite, background_preview, sprite_preview) in MODES.items():
+                firsts, fulls, pixels = [], [], 0
+                for kind, args in shown:
+                    size, preview = (background, background_preview) if kind == "background" else (sprite, sprite_preview)
+                    first = _fetch(client, _url(kind, args, preview)) if preview else 0.0
+                    full = first + _fetch(client, _url(kind, args, size))
+                    firsts.append(first if preview else full)
+                    fulls.append(full)
+                    pixels += size[0] * size[1] + (preview[0] * preview[1] if preview else 0)
+                firsts.sort()
+                fulls.sort()
+                print(f"{mode:<22} {statistics.median(firsts):>17.2f} s {firsts[-1]:>5.2f} s "
+                      f"{statistics.median(fulls):>14.2f} s {fulls[-1]:>5.2f} s {pixels / 1e6:>11.1f}")
+    finally:
+        server.shutdown()
+        compiler.BASE_URL = base_url
+        character_url.cache_clear()
+
+
+if __name__ == "__main__":
+    main()
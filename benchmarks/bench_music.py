@@ -0,0 +1,104 @@
+"""Measure how long a scene waits for its music, with and without an intro clip.
+
+Serves `vnml.media_cache` in front of `benchmarks.stub_media`, whose music
+takes longer the longer the clip asked for, like MusicGen, and requests the
+music of every scene of the sample `outputs` as the playground does: the clip
+that loops alone, or the intro first. Reports the time to the first note and
+to the loop, then checks that the cache answers byte ranges, as browsers ask
+for to seek in and loop audio.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_music
+"""
+
+import asyncio
+import statistics
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from benchmarks.stub_media import DELAYS, start
+from vnml import compiler, media_cache
+from vnml.compiler import MUSIC_DURATION, MUSIC_INTRO, SEED, music_url
+from vnml.components.playground import outputs
+from vnml.media_cache import MediaCache, serve_media
+from vnml.parser import decode_fragment, stream_vnml_parser
+
+RANGES = {
+    "bytes=0-1023": (206, 1024),
+    "bytes=1024-": (206, None),
+    "bytes=-100": (206, 100),
+    "bytes=99999999-": (416, None),
+}
+
+
+def scenes() -> list[str]:
+    """The music keywords of every scene."""
+    keywords = []
+    for transcript in outputs:
+        for vnml in stream_vnml_parser(transcript):
+            fragment = decode_fragment(vnml)
+            if fragment is not None and fragment.tag == "scene":
+                keywords.append(fragment.find("music").attrs["keywords"])
+    return keywords
+
+
+async def _get(client: httpx.AsyncClient, url: str, **headers) -> tuple[float, httpx.Response]:
+    started = time.perf_counter()
+    response = await client.get(url, headers=headers)
+    return time.perf_counter() - started, response
+
+
+async def _run() -> list[str]:
+    app = FastAPI()
+    app.add_api_route("/media/{service}/{path:path}", serve_media)
+    transport = httpx.ASGITransport(app=app)
+    lines = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=60) as client:
+        for seed, mode in enumerate(("clip only", "intro first"), SEED):  # a seed each, not to hit the cache
+            firsts, loops = [], []
+            for keywords in scenes():
+                if mode == "intro first":
+                    # On one GPU the intro is generated first, as the prefetcher orders them.
+                    first, _ = await _get(client, music_url(keywords, seed, duration=MUSIC_INTRO))
+                    loops.append(first + (await _get(client, music_url(keywords, seed)))[0])
+                    firsts.append(first)
+                else:
+                    loops.append((await _get(client, music_url(keywords, seed)))[0])
+                    firsts.append(loops[-1])
+            lines.append(f"{mode:<12} {statistics.median(firsts):>17.2f} s {max(firsts):>5.2f} s "
+                         f"{statistics.median(loops):>9.2f} s {max(loops):>5.2f} s")
+
+        url = music_url(scenes()[0])
+        size = len((await client.get(url)).content)
+        lines.append(f"\nranges of a {size} byte clip")
+        for header, (status, length) in RANGES.items():
+            _, response = await _get(client, url, range=header)
+            ok = response.status_code == status and (length is None or len(response.content) == length)
+            lines.append(f"{header:<22} {response.status_code} {response.headers.get('content-range', ''):<22} "
+                         f"{len(response.content):>8} bytes {'ok' if ok else 'UNEXPECTED'}")
+    return lines
+
+
+def main(delay: float = 0.3, per_second: float = 0.1):
+    server = start(delays={**DELAYS, "music": delay}, per_second=per_second)
+    base_url, cache = compiler.BASE_URL, media_cache.cache
+    compiler.BASE_URL = "http://testserver/media/"
+    with tempfile.TemporaryDirectory() as directory:
+        media_cache.cache = MediaCache(directory, upstream=f"http://127.0.0.1:{server.server_address[1]}/")
+        try:
+            print(f"music takes {delay:.2f} s + {per_second:.2f} s a second; clips of {MUSIC_DURATION:g} s, "
+                  f"intros of {MUSIC_INTRO:g} s")
+            print(f"{'':<12} {'first note: p50':>17} {'max':>7} {'loop: p50':>11} {'max':>7}")
+            for line in asyncio.run(_run()):
+                print(line)
+        finally:
+            server.shutdown()
+            compiler.BASE_URL, media_cache.cache = base_url, cache
+
+
+if __name__ == "__main__":
+    main()
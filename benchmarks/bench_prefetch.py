@@ -0,0 +1,60 @@
+"""Check the media prefetcher against `benchmarks.stub_media`.
+
+Records the sample transcripts as history and has the prefetcher warm the
+lines ahead of a reader who clicks "->" every 0.1s, then reports how many
+requests reached each service, how many ran at once, and whether any URL
+was requested twice.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_prefetch
+"""
+
+import asyncio
+import time
+
+from benchmarks.stub_media import start
+from vnml.compiler import DISPLAY_DEFAULTS, GameSnapshot, calculate_diff, media_urls, vnml2log
+from vnml.components.playground import outputs
+from vnml.history import HistoryBuffer
+from vnml.parser import stream_vnml_parser
+from vnml.prefetch import MediaPrefetcher, service
+
+
+async def _read(history: HistoryBuffer, prefetcher: MediaPrefetcher, click: float):
+    for pointer in range(len(history)):
+        prefetcher.warm(history, pointer)
+        await asyncio.sleep(click)
+    await prefetcher.wait()
+
+
+def main(lookahead: int = 8, click: float = 0.1):
+    server = start()
+    origin = f"http://127.0.0.1:{server.server_address[1]}"
+    history = HistoryBuffer()
+    snapshot = GameSnapshot(*DISPLAY_DEFAULTS.values())
+    for transcript in outputs:
+        for vnml in stream_vnml_parser(transcript):
+            diff = calculate_diff(snapshot, vnml2log(vnml, snapshot.characters), vnml)
+            snapshot += diff
+            history.append(diff.__dict__)
+    urls = {url for i in range(len(history)) for url in media_urls(history[i]["do_log"])}
+
+    prefetcher = MediaPrefetcher(lookahead=lookahead, origin=origin)
+    started = time.perf_counter()
+    asyncio.run(_read(history, prefetcher, click))
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    print(f"{len(history)} lines, {len(urls)} distinct media URLs, {elapsed:.1f}s")
+    print(f"fetched {prefetcher.fetched}, failed {prefetcher.failed}")
+    for name in sorted(server.peak):
+        requests = sum(count for path, count in server.requests.items() if service(path) == name)
+        print(f"{name:>7}: {requests} requests, at most {server.peak[name]} at once")
+    duplicates = [path for path, count in server.requests.items() if count > 1]
+    assert not duplicates, duplicates
+    assert prefetcher.fetched == len(urls)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Measure how much of each turn's prompt llama.cpp can take from its KV cache.
+
+Plays several interleaved sessions against `benchmarks.mock_llama_cpp`, once
+with every session pinned to its own slot and once letting the server pick,
+and prints the cached and evaluated prompt tokens of every turn.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_prompt_cache
+"""
+
+import asyncio
+import random
+
+from benchmarks.mock_llama_cpp import start
+from vnml.components.playground import continue_vnml
+from vnml.history import HistoryBuffer
+from vnml.llm import PARALLEL_SLOTS, CompletionMetrics, SlotPool, llm, slots
+from vnml.parser import VNMLStreamParser, decode_fragment, tag_of
+
+
+async def _turn(history: HistoryBuffer, session: str) -> CompletionMetrics:
+    metrics = CompletionMetrics()
+    option = None
+    parser = VNMLStreamParser()
+    async for text in continue_vnml(history, "en", session, metrics):
+        for gap, vnml in parser.feed_raw(text):
+            # Only scene changes matter to the prompt, so skip resolving media URLs.
+            do_log = {"background_url": "scene"} if tag_of(vnml) == "scene" else {}
+            history.append({"do_log": do_log, "undo_log": {}, "vnml": vnml, "gap": gap})
+            if tag_of(vnml) == "options":
+                option = decode_fragment(vnml).find("option").text
+        if option is not None:
+            break
+    history.append({"do_log": {}, "undo_log": {}, "vnml": f"<action>{option}</action>", "gap": "\n"})
+    return metrics
+
+
+async def _play(sessions: int, turns: int, pinned: bool) -> list[list[CompletionMetrics]]:
+    slots.slot = SlotPool().slot if pinned else (lambda session, free=None: -1)
+    histories = {f"session-{i}": HistoryBuffer() for i in range(sessions)}
+    results = [[] for _ in range(turns)]
+    order = random.Random(0)
+    for turn in range(turns):
+        names = list(histories)
+        order.shuffle(names)
+        for session in names:
+            results[turn].append(await _turn(histories[session], session))
+    return results
+
+
+def _report(title: str, results: list[list[CompletionMetrics]]):
+    print(title)
+    print(f"{'turn':>4} {'prompt':>8} {'cached':>8} {'evaluated':>10} {'hit rate':>9}")
+    total_prompt = total_cached = 0
+    for turn, metrics in enumerate(results):
+        prompt = sum(m.prompt_tokens for m in metrics)
+        cached = sum(m.cached_tokens for m in metrics)
+        total_prompt, total_cached = total_prompt + prompt, total_cached + cached
+        print(f"{turn:>4} {prompt:>8} {cached:>8} {prompt - cached:>10} {cached / max(prompt, 1):>9.1%}")
+    print(f"{'all':>4} {total_prompt:>8} {total_cached:>8} {total_prompt - total_cached:>10} "
+          f"{total_cached / max(total_prompt, 1):>9.1%}\n")
+
+
+async def _compare(sessions: int, turns: int):
+    for pinned, title in ((True, "pinned to slots"), (False, "any idle slot")):
+        server = start(parallel=PARALLEL_SLOTS)  # a fresh server starts with empty slots
+        llm.client.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            _report(f"{sessions} sessions, {title}", await _play(sessions, turns, pinned))
+        finally:
+            server.shutdown()
+
+
+def main(sessions: int = PARALLEL_SLOTS, turns: int = 6):
+    base_url = llm.client.base_url
+    try:
+        asyncio.run(_compare(sessions, turns))
+    finally:
+        del slots.slot
+        llm.client.base_url = base_url
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Measure how the scheduler shares the llama.cpp slots between players.
+
+Against `benchmarks.mock_llama_cpp`, several players, each with a story of
+their own, have the branches of their options generated speculatively when a
+few players start a new story (the same prompt for all of them) and a few more
+choose an option, all waiting for their next line. Half the speculating players leave right away.
+Reports how long the waiting players waited for their first line, and the
+completions and tokens the server had to generate: once with every request
+sent straight to llama.cpp, which queues them on its slots in turn, and once
+through `vnml.scheduler`.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_scheduler
+"""
+
+import asyncio
+import statistics
+import time
+
+from benchmarks.mock_llama_cpp import start
+from vnml import generation, scheduler as scheduling
+from vnml.compiler import DISPLAY_DEFAULTS, GameSnapshot, compile_turn
+from vnml.components.playground import action_diff, generate_diffs, outputs
+from vnml.history import HistoryBuffer
+from vnml.llm import PARALLEL_SLOTS, SlotPool, llm, slots
+from vnml.scheduler import Priority, scheduler
+
+
+def story(hero: str) -> tuple[HistoryBuffer, GameSnapshot, list[str]]:
+    """The first sample transcript as a history, and the options it ends with."""
+    history, snapshot = HistoryBuffer(), GameSnapshot(*DISPLAY_DEFAULTS.values())
+    turn = compile_turn(outputs[0].replace("Eli", hero), snapshot)
+    for diff in turn.diffs:
+        history.append(diff.__dict__)
+        snapshot += diff
+    return history, snapshot, history[-1]["do_log"]["options"]
+
+
+async def _turn(history: HistoryBuffer, snapshot: GameSnapshot, session: str, priority: Priority,
+                started: float, waits: dict[str, float]):
+    first = len(history) + (len(history) == 0)  # past the start action of a new story
+    async for diff in generate_diffs(history, snapshot, "en", session, priority=priority):
+        history.append(diff.__dict__)
+        if len(history) == first + 1:
+            waits[session] = time.perf_counter() - started
+
+
+async def _run(speculating: int, new: int, choosing: int, leave_after: float) -> dict[str, float]:
+    turns, waits, gone = [], {}, set()
+    if scheduler.connected is not None:
+        scheduler.connected = lambda session: session not in gone
+    started = time.perf_counter()
+
+    def play(history, snapshot, session, priority):
+        turns.append(asyncio.create_task(_turn(history, snapshot, session, priority, started, waits)))
+
+    for player in range(speculating):
+        base, snapshot, options = story(f"Eli {player}")  # every player has a story of their own
+        for index, option in enumerate(options):
+            history = base.fork()
+            action = action_diff(snapshot, option)
+            history.append(action.__dict__)
+            play(history, snapshot + action, f"speculating-{player}/{index}", Priority.SPECULATIVE)
+    await asyncio.sleep(0)
+    for player in range(new):
+        play(HistoryBuffer(), GameSnapshot(*DISPLAY_DEFAULTS.values()), f"new-{player}", Priority.INTERACTIVE)
+    for player in range(choosing):
+        history, snapshot, options = story(f"Ada {player}")
+        option = options[player % len(options)]
+        action = action_diff(snapshot, option)
+        history.append(action.__dict__)
+        play(history, snapshot + action, f"choosing-{player}", Priority.INTERACTIVE)
+    await asyncio.sleep(leave_after)
+    gone.update(f"speculating-{player}" for player in range(speculating // 2))
+    await asyncio.gather(*turns)
+    return waits
+
+
+def main(speculating: int = 6, new: int = 4, choosing: int = 4, delay: float = 0.001):
+    workers, grace, base_url = generation.GENERATION_WORKERS, scheduling.DISCONNECT_GRACE, llm.client.base_url
+    generation.GENERATION_WORKERS, scheduling.DISCONNECT_GRACE = 0, 0
+    print(f"{speculating} players speculating on {PARALLEL_SLOTS} options each, half of them leaving, "
+          f"{new} new stories, {choosing} players choosing, {PARALLEL_SLOTS} slots")
+    print(f"{'':<18} {'first line: p50':>16} {'max':>7} {'completions':>12} {'tokens':>8} {'merged':>7}")
+    try:
+        for mode in ("straight to llama", "scheduler"):
+            server = start(parallel=PARALLEL_SLOTS, delay=delay)
+            llm.client.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+            scheduler.__init__()  # fresh queues and stats
+            if mode == "straight to llama":
+                # As many slots as requests, no two requests alike and nobody leaving: llama.cpp queues them.
+                scheduler.parallel = 1 << 16
+                scheduler._join = lambda key, priority: None
+                slots.slot = lambda session, free=None: SlotPool.slot(slots, session)
+            else:
+                del scheduler._join, slots.slot
+                scheduler.connected = lambda session: True
+            waits = asyncio.run(_run(speculating, new, choosing, leave_after=0.2))
+            interactive = sorted(wait for session, wait in waits.items() if not session.startswith("speculating"))
+            report = scheduler.report()
+            print(f"{mode:<18} {statistics.median(interactive):>14.2f} s {interactive[-1]:>5.2f} s "
+                  f"{server.completions:>12} {server.predicted:>8} {report['merged']:>7}")
+            server.shutdown()
+        print(f"\nscheduler waits for a slot: {report['wait']}")
+    finally:
+        generation.GENERATION_WORKERS, scheduling.DISCONNECT_GRACE = workers, grace
+        llm.client.base_url = base_url
+        scheduler.__init__()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Compare stepping through the history by copying snapshots against applying diffs in place.
+
+Replays a long session (see `benchmarks.bench_diff_store`) on a `DisplayState`,
+once the way `forward`/`backward` used to (export the whole snapshot, add the
+diff into a new one, import every field back) and once by setting only the
+fields each diff changes, and reports diffs per second, the vars Reflex marks
+dirty per step and the size of the delta sent to the browser per step, then
+the rate at which each kind of snapshot alone takes diffs.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_snapshot
+"""
+
+import json
+import time
+import timeit
+from dataclasses import dataclass, field
+
+from benchmarks.bench_diff_store import session
+from vnml.compiler import DISPLAY_DEFAULTS, Diff, GameSnapshot
+from vnml.components.playground import DisplayState
+from vnml.history import HistoryBuffer
+
+
+@dataclass
+class CopyingSnapshot:
+    """`GameSnapshot` as it was: every diff builds a new one from a copy of `__dict__`."""
+    background_url: str
+    background_preview_url: str
+    music_url: str
+    music_intro_url: str
+    character_url: str
+    character_preview_url: str
+    character_name: str
+    dialogue: str
+    dialogue_url: list[str]
+    option_title: str
+    options: list[str]
+    characters: dict[str, dict] = field(default_factory=dict)
+
+    def __add__(self, diff: Diff):
+        state = self.__dict__.copy()
+        for key, value in diff.do_log.items():
+            state[key] = value
+        return CopyingSnapshot(**state)
+
+    def __sub__(self, diff: Diff):
+        state = self.__dict__.copy()
+        for key, value in diff.undo_log.items():
+            state[key] = value
+        return CopyingSnapshot(**state)
+
+
+def export_snapshot(state: DisplayState) -> CopyingSnapshot:
+    return CopyingSnapshot(state.background_url, state.background_preview_url, state.music_url,
+                           state.music_intro_url, state.character_url, state.character_preview_url,
+                           state.character_name, state.dialogue, state.dialogue_url, state.option_title,
+                           list(state.options))
+
+
+def import_snapshot(state: DisplayState, snapshot: CopyingSnapshot):
+    state.background_url = snapshot.background_url
+    state.background_preview_url = snapshot.background_preview_url
+    state.music_url = snapshot.music_url
+    state.music_intro_url = snapshot.music_intro_url
+    state.character_url = snapshot.character_url
+    state.character_preview_url = snapshot.character_preview_url
+    state.character_name = snapshot.character_name
+    state.dialogue = snapshot.dialogue
+    state.dialogue_url = snapshot.dialogue_url
+    state.option_title = snapshot.option_title
+    state.options = snapshot.options
+
+
+def copying(state: DisplayState, history: HistoryBuffer, index: int, undo: bool):
+    diff = Diff(**history[index])
+    import_snapshot(state, export_snapshot(state) - diff if undo else export_snapshot(state) + diff)
+
+
+def in_place(state: DisplayState, history: HistoryBuffer, index: int, undo: bool):
+    state._apply(history.changes(index, undo))
+
+
+def run(step, history: HistoryBuffer, measure: bool) -> tuple[float, float, float, dict]:
+    """Step forward through `history` and back.
+
+    Returns diffs/s, dirty vars and delta bytes per step, and the state half way.
+    """
+    state = DisplayState(_reflex_internal_init=True)
+    state._clean()
+    steps = dirty = size = 0
+    started = time.perf_counter()
+    for indices, undo in ((range(len(history)), False), (reversed(range(len(history))), True)):
+        for index in indices:
+            step(state, history, index, undo)
+            steps += 1
+            if measure:
+                dirty += len(state.dirty_vars)
+                size += len(json.dumps(state.get_delta()))
+                state._clean()
+        if not undo:
+            end = {key: getattr(state, key) for key in DISPLAY_DEFAULTS}
+    elapsed = time.perf_counter() - started
+    return steps / elapsed, dirty / steps, size / steps, end
+
+
+def main(lines: int = 1200, rounds: int = 5):
+    history = HistoryBuffer()
+    for diff in session(lines):
+        history.append(diff)
+    print(f"{len(history)} diffs, stepped forward then back")
+    print(f"{'':<12} {'diffs/s':>10} {'dirty vars':>11} {'delta/step':>11}")
+    finals = []
+    for name, step in (("copying", copying), ("in place", in_place)):
+        rate = max(run(step, history, measure=False)[0] for _ in range(rounds))
+        _, dirty, size, end = run(step, history, measure=True)
+        finals.append(end)
+        print(f"{name:<12} {rate:>10.0f} {dirty:>11.1f} {size:>9.0f} B")
+    assert finals[0] == finals[1], finals
+
+    # The snapshots alone, as `generate_diffs` advances them.
+    diffs = [Diff(**history[index]) for index in range(len(history))]
+    for name, snapshot, advance in (
+        ("copying", CopyingSnapshot(*DISPLAY_DEFAULTS.values()), lambda snapshot, diff: snapshot + diff),
+        ("in place", GameSnapshot(*DISPLAY_DEFAULTS.values()), GameSnapshot.__iadd__),
+    ):
+        def replay():
+            current = snapshot
+            for diff in diffs:
+                current = advance(current, diff)
+        seconds = min(timeit.repeat(replay, number=1, repeat=rounds))
+        print(f"{name + ' snapshot':<20} {len(diffs) / seconds:>10.0f} diffs/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Measure speech per line against speech per sentence.
+
+Takes every narration and character line of the README example and of the
+sample `outputs`, and requests its speech from `benchmarks.stub_media`, whose
+speech takes longer the more text it is given, like ChatTTS: once as one URL
+for the whole line, and once a URL per sentence as `vnml.compiler.dialogue_url`
+builds them, each requested once the one before starts playing. Reports the
+URL lengths, the time to the first audio, how often playback would stall
+waiting for the next sentence, and how many requests the cache could answer.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_speech
+"""
+
+import statistics
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+import httpx
+
+from benchmarks.stub_media import DELAYS, start
+from vnml import compiler
+from vnml.compiler import SEED, dialogue_url, sentences
+from vnml.components.playground import outputs
+from vnml.keywords import normalize_text
+from vnml.parser import decode_fragment, stream_vnml_parser
+
+# Seconds of speech per character, about 15 characters a second in English.
+SPEECH_PER_CHAR = 1 / 15
+
+
+def lines() -> list[str]:
+    readme = (Path(__file__).parent.parent / "README.md").read_text(encoding="utf-8")
+    example = readme.split("```xml")[1].split("```")[0]
+    texts = []
+    for document in (example, *outputs):
+        for vnml in stream_vnml_parser([document]):
+            fragment = decode_fragment(vnml)
+            if fragment is not None and fragment.tag in ("narration", "character"):
+                texts.append(fragment.text.strip())
+    return texts
+
+
+def _fetch(client: httpx.Client, url: str) -> float:
+    started = time.perf_counter()
+    client.get(url).raise_for_status()
+    return time.perf_counter() - started
+
+
+def _play(client: httpx.Client, text: str) -> tuple[float, int]:
+    """Time to the first audio and stalls, requesting each sentence once the one before starts playing."""
+    urls, spoken = dialogue_url(text), sentences(text)
+    first = _fetch(client, urls[0])
+    stalls = sum(_fetch(client, url) > len(before) * SPEECH_PER_CHAR for url, before in zip(urls[1:], spoken))
+    return first, stalls
+
+
+def main(per_char: float = 0.002, delay: float = 0.05):
+    server = start(delays={**DELAYS, "speech": delay}, per_char={"speech": per_char})
+    base_url = compiler.BASE_URL
+    compiler.BASE_URL = f"http://127.0.0.1:{server.server_address[1]}/"
+    texts = lines()
+    print(f"{len(texts)} lines, speech takes {delay:.2f} s + {per_char * 1e3:.1f} ms a character")
+    print(f"{'':<14} {'URL chars: p50':>15} {'max':>6} {'first audio: p50':>17} {'max':>7} {'stalls':>7} "
+          f"{'requests':>9} {'distinct':>9}")
+    try:
+        with httpx.Client(timeout=60) as client:
+            for mode in ("whole line", "per sentence"):
+                if mode == "whole line":
+                    urls = [f"{compiler.BASE_URL}speech/{quote(normalize_text(text))}?seed={SEED}" for text in texts]
+                    plays = [(_fetch(client, url), 0) for url in urls]
+                else:
+                    urls = [url for text in texts for url in dialogue_url(text)]
+                    plays = [_play(client, text) for text in texts]
+                lengths = sorted(len(url) for url in urls)
+                firsts = sorted(first for first, _ in plays)
+                print(f"{mode:<14} {statistics.median(lengths):>15.0f} {lengths[-1]:>6} "
+                      f"{statistics.median(firsts):>15.2f} s {firsts[-1]:>5.2f} s "
+                      f"{sum(stalls for _, stalls in plays):>7} {len(urls):>9} {len(set(urls)):>9}")
+    finally:
+        server.shutdown()
+        compiler.BASE_URL = base_url
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Measure the sprites a story needs rendered, with and without the emotion palette.
+
+Compiles the sample `outputs` and counts, per character, the emotions the
+model wrote and the distinct sprites they need: one per emotion word without
+`vnml.keywords.PALETTE`, at most one per palette emotion with it, all of which
+the sheet queued when the character first appears covers. Then has the
+prefetcher render a sheet against `benchmarks.stub_media` while an upcoming
+line asks for a sprite, and reports how long that line waits.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_sprites
+"""
+
+import asyncio
+import time
+from collections import defaultdict
+
+from benchmarks.stub_media import DELAYS, start
+from vnml import keywords
+from vnml.compiler import DISPLAY_DEFAULTS, GameSnapshot, calculate_diff, character_url, sprite_sheet, vnml2log
+from vnml.components.playground import new_sprite_sheets, outputs
+from vnml.parser import stream_vnml_parser
+from vnml.prefetch import MediaPrefetcher
+
+
+def sprites() -> tuple[dict[str, set[str]], dict[str, set[str]], set[str], int]:
+    """Per character, the emotions written and the sprite URLs shown; the URLs of the sheets queued, and lines."""
+    emotions, shown, sheets, lines = defaultdict(set), defaultdict(set), set(), 0
+    snapshot = GameSnapshot(*DISPLAY_DEFAULTS.values())
+    for transcript in outputs:
+        for vnml in stream_vnml_parser(transcript):
+            diff = calculate_diff(snapshot, vnml2log(vnml, snapshot.characters), vnml)
+            snapshot += diff
+            sheets.update(url for sheet in new_sprite_sheets(diff.__dict__) for url in sheet)
+            if snapshot.character_name and diff.do_log.get("character_url"):
+                emotions[snapshot.character_name].add(snapshot.characters[snapshot.character_name]["emotion"])
+                shown[snapshot.character_name].add(snapshot.character_url)
+                lines += 1
+    return emotions, shown, sheets, lines
+
+
+async def _wait_behind_sheet(origin: str, render: float) -> float:
+    prefetcher = MediaPrefetcher(origin=origin)
+    prefetcher.render_sheet(sprite_sheet("bench, sheet"))
+    await asyncio.sleep(render / 2)  # the sheet has the GPU
+    started = time.perf_counter()
+    url = character_url("bench, upcoming line", "happy")
+    prefetcher.prefetch([url])
+    await prefetcher._requested[url]
+    waited = time.perf_counter() - started
+    await prefetcher.wait()
+    return waited
+
+
+def main(render: float = 0.05):
+    palette = list(keywords.palette.emotions)
+    print(f"palette: {', '.join(palette)}")
+    print(f"{'':<12} {'lines':>6} {'emotions':>9} {'sprites':>8} {'in a sheet':>11} {'sheet renders':>14}")
+    try:
+        for mode in ("no palette", "palette"):
+            keywords.palette.emotions = palette if mode == "palette" else []
+            character_url.cache_clear()
+            emotions, shown, sheets, lines = sprites()
+            urls = set().union(*shown.values())
+            print(f"{mode:<12} {lines:>6} {sum(map(len, emotions.values())):>9} {len(urls):>8} "
+                  f"{len(urls & sheets):>11} {len(sheets):>14}")
+        keywords.palette.emotions = palette
+        for name in sorted(shown):
+            print(f"  {name}: {len(emotions[name])} emotions as {len(shown[name])} sprites")
+
+        server = start(delays={**DELAYS, "image": render})
+        waited = asyncio.run(_wait_behind_sheet(f"http://127.0.0.1:{server.server_address[1]}", render))
+        server.shutdown()
+        print(f"\nupcoming sprite behind a sheet of {len(sprite_sheet('bench, sheet'))} sprites: "
+              f"waited {waited:.2f} s, {render:.2f} s a render")
+    finally:
+        keywords.palette.emotions = palette
+        character_url.cache_clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Measure what importing the app costs a web or generation worker as it starts.
+
+Imports each of `BUDGETS` in a fresh interpreter under `python -X importtime`,
+a few times, and reports the fastest, against its budget, with the slowest
+of the modules it pulls in. Exits with status 1 if one is over its budget, or
+imports one of `LAZY`, which are only needed once the app talks to llama.cpp.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --scale 2  # on a slower machine
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+# Milliseconds each module may take to import, with everything it imports.
+BUDGETS = {
+    "vnml.compiler": 100,  # what generation workers compile turns with
+    "vnml.generation": 100,  # and what they import
+    "vnml.components.playground": 1500,
+    "vnml.vnml": 3000,  # the whole app, most of it Reflex
+}
+
+# Packages that are imported on first use, not with the app.
+LAZY = ("furchain", "langchain", "langchain_core", "bs4", "lxml")
+
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+def import_time(module: str) -> tuple[float, dict[str, float]]:
+    """Milliseconds to import `module` in a fresh interpreter, and by top-level package, those of what it imports."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"})
+    if result.returncode:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+    total, packages = 0.0, {}
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match is None:
+            continue
+        own, cumulative, _, name = match.groups()
+        package = name.partition(".")[0]
+        packages[package] = packages.get(package, 0.0) + int(own) / 1000
+        if name == module:
+            total = int(cumulative) / 1000
+    return total, packages
+
+
+def main(runs: int = 3, scale: float = 1.0) -> int:
+    print(f"{'module':<28} {'import':>9} {'budget':>9}  slowest packages")
+    failed = []
+    for module, budget in BUDGETS.items():
+        total, packages = min((import_time(module) for _ in range(runs)), key=lambda result: result[0])
+        budget *= scale
+        eager = sorted(package for package in packages if package in LAZY)
+        slowest = sorted(packages.items(), key=lambda item: -item[1])[:4]
+        print(f"{module:<28} {total:>6.0f} ms {budget:>6.0f} ms  "
+              + ", ".join(f"{package} {ms:.0f}" for package, ms in slowest))
+        if total > budget:
+            failed.append(f"{module} took {total:.0f} ms, over its {budget:.0f} ms")
+        if eager:
+            failed.append(f"{module} imports {', '.join(eager)}")
+    for failure in failed:
+        print(f"REGRESSION: {failure}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every budget, e.g. on a slower machine")
+    args = parser.parse_args()
+    sys.exit(main(args.runs, args.scale))
@@ -0,0 +1,83 @@
+"""Measure what the caps in `vnml.compiler.MAX_LENGTH` save when generating turns.
+
+Against `benchmarks.mock_llama_cpp`, plays turns of the first sample story
+with no caps, the default ones and tight ones, on the generation workers or in
+the web worker. Reports per turn the lines the player gets, the tokens the
+server generated (including those of completions cut short, until they
+noticed) and the completions it took, and how many turns reached their options.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_turn_length
+"""
+
+import asyncio
+import os
+import time
+
+from benchmarks.bench_scheduler import story
+from benchmarks.mock_llama_cpp import start
+from vnml import generation
+from vnml.compiler import MAX_LENGTH
+from vnml.components.playground import action_diff, generate_diffs
+from vnml.llm import llm
+from vnml.parser import tag_of
+
+CAPS = {
+    "no caps": {"narration": 1 << 20, "character": 1 << 20, "dialogue": 1 << 20, "options": 1 << 20},
+    "default": dict(MAX_LENGTH),
+    "tight": {"narration": 160, "character": 100, "dialogue": 8, "options": 3},
+}
+
+
+async def _turn(index: int) -> tuple[int, bool]:
+    history, snapshot, options = story(f"Eli {index}")
+    action = action_diff(snapshot, options[index % len(options)])
+    history.append(action.__dict__)
+    snapshot += action
+    lines, done = 0, False
+    async for diff in generate_diffs(history, snapshot, "en", f"player-{index}"):
+        history.append(diff.__dict__)
+        lines += tag_of(diff.vnml) in ("narration", "character")
+        done = tag_of(diff.vnml) == "options"
+    return lines, done
+
+
+async def _run(turns: int) -> list[tuple[int, bool]]:
+    results = await asyncio.gather(*(_turn(index) for index in range(turns)))
+    if generation._pool is not None:
+        generation._pool.close()
+        generation._pool = None
+    return results
+
+
+def main(turns: int = 24, delay: float = 0.0005):
+    server = start(delay=delay)
+    base_url, workers, caps = llm.client.base_url, generation.GENERATION_WORKERS, dict(MAX_LENGTH)
+    llm.client.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"{turns} turns")
+    print(f"{'':<30} {'lines':>6} {'tokens':>7} {'completions':>12} {'with options':>13} {'time':>7}")
+    try:
+        for where in ("web worker", "generation workers"):
+            generation.GENERATION_WORKERS = 0 if where == "web worker" else workers or 4
+            for name, limits in CAPS.items():
+                MAX_LENGTH.update(limits)
+                # The workers are spawned afresh for every run and read their caps from the environment.
+                os.environ["VNML_MAX_LENGTH"] = ",".join(f"{tag}={cap}" for tag, cap in limits.items())
+                predicted, completions = server.predicted, server.completions
+                started = time.perf_counter()
+                results = asyncio.run(_run(turns))
+                elapsed = time.perf_counter() - started
+                lines = sum(lines for lines, _ in results) / turns
+                print(f"{name + ', ' + where:<30} {lines:>6.1f} {(server.predicted - predicted) / turns:>7.0f} "
+                      f"{(server.completions - completions) / turns:>12.1f} "
+                      f"{sum(done for _, done in results):>10}/{turns} {elapsed:>5.2f} s")
+    finally:
+        server.shutdown()
+        llm.client.base_url, generation.GENERATION_WORKERS = base_url, workers
+        MAX_LENGTH.update(caps)
+        os.environ.pop("VNML_MAX_LENGTH", None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Compare `vnml2log` against the previous BeautifulSoup/lxml implementation.
+
+Run from the repository root, with the baseline's requirements installed:
+
+    pip install -r requirements-bench.txt
+    python -m benchmarks.bench_vnml2log
+"""
+
+import timeit
+
+from bs4 import BeautifulSoup
+
+from vnml.compiler import (BACKGROUND_PREVIEW, BACKGROUND_SIZE, LOOKS, MUSIC_INTRO, SPRITE_PREVIEW, background_url,
+                           character_url, dialogue_url, merge_characters, music_url, vnml2log)
+from vnml.components.playground import outputs
+from vnml.parser import stream_vnml_parser
+
+
+def soup_vnml2log(vnml: str, characters: dict[str, dict]) -> dict:
+    """The fragment decoder `vnml2log` used before, kept here as the baseline."""
+    do_log = {
+        "character_url": None,
+        "character_preview_url": None,
+        "character_name": None,
+        "dialogue": None,
+        "dialogue_url": None,
+        "option_title": None,
+        "options": []
+    }
+    if vnml.startswith("<scene"):
+        soup = BeautifulSoup(vnml, 'lxml')
+        background_keywords = soup.find("background")['keywords']
+        music_keywords = soup.find("music")['keywords']
+        do_log.update(
+            {"background_url": background_url(background_keywords, *BACKGROUND_SIZE, names=characters),
+             "background_preview_url": background_url(background_keywords, *BACKGROUND_PREVIEW, names=characters)
+             if BACKGROUND_PREVIEW else None,
+             "music_url": music_url(music_keywords),
+             "music_intro_url": music_url(music_keywords, duration=MUSIC_INTRO) if MUSIC_INTRO else None,
+             "option_title": None,
+             "options": []})
+        return do_log
+    elif vnml.startswith("<character"):
+        soup = BeautifulSoup(vnml, 'lxml')
+        character_name = soup.find("character")['name']
+        known = characters.get(character_name, {})
+        look = {key: soup.find("character").get(key) or known.get(key) for key in LOOKS}
+        if not look["identifier"]:
+            look["identifier"] = character_name
+        text = soup.find("character").text.strip()
+        do_log.update({
+            "character_url": character_url(look["identifier"], look["emotion"], look["clothes"]),
+            "character_preview_url": character_url(look["identifier"], look["emotion"], look["clothes"],
+                                                   *SPRITE_PREVIEW) if SPRITE_PREVIEW else None,
+            "character_name": character_name,
+            "dialogue": text,
+            "dialogue_url": dialogue_url(text)
+        })
+        if look != known:
+            do_log["characters"] = {character_name: look}
+        return do_log
+    elif vnml.startswith("<narration"):
+        soup = BeautifulSoup(vnml, 'lxml')
+        text = soup.find("narration").text.strip()
+        do_log.update({"dialogue": text, "dialogue_url": dialogue_url(text)})
+        return do_log
+    elif vnml.startswith("<options"):
+        soup = BeautifulSoup(vnml, 'lxml')
+        option_title = soup.find("title").text.strip()
+        options = [i.text.strip() for i in soup.find_all("option")]
+        do_log.update({"option_title": option_title, "options": options})
+        return do_log
+    return {"dialogue": vnml, "option_title": None, "options": []}
+
+
+def cast(fragments: list[str]) -> dict[str, dict]:
+    """The character table at the end of `fragments`, for lines to fall back to."""
+    characters = {}
+    for vnml in fragments:
+        characters = merge_characters(characters, vnml2log(vnml, characters).get("characters"))
+    return characters
+
+
+def main(number: int = 200):
+    for index, transcript in enumerate(outputs):
+        fragments = list(stream_vnml_parser(transcript))
+        characters = cast(fragments)
+        assert [vnml2log(i, characters) for i in fragments] == [soup_vnml2log(i, characters) for i in fragments]
+        results = {}
+        for name, decoder in (("BeautifulSoup", soup_vnml2log), ("decode_fragment", vnml2log)):
+            seconds = min(timeit.repeat(lambda: [decoder(i, characters) for i in fragments],
+                                        number=number, repeat=5))
+            results[name] = seconds / number / len(fragments)
+        baseline = results["BeautifulSoup"]
+        print(f"transcript {index}: {len(fragments)} fragments, {len(transcript)} chars")
+        for name, per_fragment in results.items():
+            print(f"  {name:<16} {per_fragment * 1e6:9.1f} us/fragment  x{baseline / per_fragment:.1f}")
+
+
+if __name__ == "__main__":
+    main()
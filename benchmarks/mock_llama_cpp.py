@@ -0,0 +1,242 @@
+"""A stand-in for the llama.cpp server, good enough to measure prompt caching.
+
+It serves `/completion` (streaming and not), `/tokenize` and `/health` and
+emulates what matters for the client: every slot remembers the tokens of its
+last prompt and completion, and a new prompt only "evaluates" the tokens past
+the prefix it shares with them. Completions replay the sample transcripts from
+`vnml.components.playground.outputs`, with one of the `DEFECTS` of a model
+at the given rate. Given a grammar, the server only writes a defect that
+`vnml.grammar.validate` allows, as llama.cpp only samples what the grammar
+allows (see `benchmarks.bench_grammar`).
+
+Run from the repository root:
+
+    python -m benchmarks.mock_llama_cpp --port 8080 --parallel 4
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from vnml.components.playground import outputs
+from vnml.grammar import gbnf, validate
+
+_TOKEN = re.compile(r" ?\w+| ?[^\w\s]+|\s+")  # roughly as coarse as BPE
+
+# Simulated cost of a prompt token and a generated token.
+PROMPT_MS = 0.2
+PREDICTED_MS = 20.0
+
+
+def _cut_options(text: str) -> str:
+    return text[:text.index("<options>")] + "</vnml>\n```\n" if "<options>" in text else text
+
+
+# What goes wrong in turns the model writes: most of it no grammar allows, the
+# last few are well-formed but still spoil the story.
+DEFECTS = {
+    "unknown tag": lambda text: text.replace("<narration>", "<thought>I should be careful.</thought>\n<narration>", 1),
+    "missing keywords": lambda text: re.sub(r'<background keywords="[^"]*"', "<background", text, count=1),
+    "no options": _cut_options,
+    "unclosed element": lambda text: text.replace("</narration>", "", 1),
+    "misspelled closing tag": lambda text: text.replace("</character>", "</charater>", 1),
+    "prose between elements": lambda text: text.replace("</narration>\n", "</narration>\n**Eli:** Wait!\n", 1),
+    "nameless speaker": lambda text: re.sub(r'<character name="[^"]*"', '<character name=""', text, count=1),
+    "repeated line": lambda text: re.sub(r"<narration>.*?</narration>\n", lambda match: match[0] * 2, text,
+                                         count=1, flags=re.S),
+}
+
+# Where a turn may be left off, see `vnml.grammar.resume_point`.
+RESUME_POINTS = ("<scene>", "<options>", "scene", "narration", "character")
+
+
+def _resume_point(grammar: str) -> str | None:
+    """Where the turn goes on from, for a grammar from `vnml.grammar.gbnf`."""
+    return next((after for after in RESUME_POINTS if gbnf(after) == grammar), None)
+
+
+def _cut(text: str, stops: list[str]) -> tuple[str, str]:
+    """`text` up to the first of `stops` in it, and that stop."""
+    stops = [(text.find(stop), stop) for stop in stops if stop in text]
+    if not stops:
+        return text, ""
+    index, stop = min(stops)
+    return text[:index], stop
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN.findall(text)
+
+
+def _common_prefix(a: list[str], b: list[str]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def _story(prompt: str) -> str:
+    """The part of a sample transcript that follows where `prompt` leaves the turn.
+
+    That is its options after the wrap-up cue, its dialogue after a line and
+    otherwise everything after its first `<scene>`.
+    """
+    seed = random.getrandbits(32)
+    transcript = outputs[seed % len(outputs)]
+    if prompt.endswith("<options>\n"):
+        start = transcript.index("<options>\n") + len("<options>\n")
+    elif prompt.rstrip().endswith(("</narration>", "</character>")):
+        start = transcript.index("<dialogue>\n") + len("<dialogue>\n")
+    else:
+        start = transcript.index("<scene>\n") + len("<scene>\n")
+    # Tag every completion, so that sessions starting from the same prompt drift apart.
+    return transcript[start:].replace("<narration>\n", f"<narration>\n[{seed:08x}] ", 1)
+
+
+class MockLlamaCpp(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], parallel: int = 4, delay: float = 0.0, defects: float = 0.0):
+        super().__init__(address, _Handler)
+        self.slots: list[list[str]] = [[] for _ in range(parallel)]
+        self.busy = [False] * parallel
+        self.delay = delay  # seconds to sleep between streamed tokens
+        self.defects = defects  # share of completions that would come out with a defect
+        self.completions = 0  # requests served
+        self.defective = 0  # completions written with a defect
+        self.predicted = 0  # tokens generated, including those of requests cut short
+        self.lock = threading.Condition()
+
+    def acquire(self, id_slot: int, prompt: list[str]) -> tuple[int, int]:
+        """Pick a slot like llama.cpp does and return it with the cached prefix length.
+
+        Without an `id_slot` the server takes the first idle slot, whatever it
+        has cached. Either way the request waits until its slot is idle.
+        """
+        with self.lock:
+            if not 0 <= id_slot < len(self.slots):
+                self.lock.wait_for(lambda: not all(self.busy))
+                id_slot = self.busy.index(False)
+            self.lock.wait_for(lambda: not self.busy[id_slot])
+            self.busy[id_slot] = True
+            return id_slot, _common_prefix(self.slots[id_slot], prompt)
+
+    def complete(self, request: dict):
+        """Yield `(content, final event or None)` pairs for a `/completion` request."""
+        prompt = tokenize(request.get("prompt", ""))
+        id_slot, cached = self.acquire(request.get("id_slot", -1), prompt)
+        if not request.get("cache_prompt", False):
+            cached = 0
+        n_predict = request.get("n_predict", -1)
+        text = _story(request.get("prompt", "")) if request.get("stream") else " A short summary. -->"
+        text, stopping_word = _cut(text, request.get("stop", []))
+        if request.get("stream") and random.random() < self.defects:
+            defective, stop = _cut(random.choice(list(DEFECTS.values()))(text), request.get("stop", []))
+            stop = stop or stopping_word
+            after = _resume_point(request["grammar"]) if "grammar" in request else None
+            allowed = "grammar" not in request or after is not None and validate(defective + stop, after)
+            if allowed and defective != text:
+                text, stopping_word = defective, stop
+                with self.lock:
+                    self.defective += 1
+        generated = tokenize(text)
+        if 0 <= n_predict < len(generated):
+            generated, stopping_word = generated[:n_predict], ""
+        with self.lock:
+            self.completions += 1
+        try:
+            for token in generated:
+                with self.lock:
+                    self.predicted += 1
+                yield token, None
+        finally:
+            with self.lock:
+                self.slots[id_slot] = prompt + generated
+                self.busy[id_slot] = False
+                self.lock.notify_all()
+        evaluated = len(prompt) - cached
+        yield "", {
+            "content": "",
+            "stop": True,
+            "id_slot": id_slot,
+            "tokens_evaluated": len(prompt),
+            "tokens_predicted": len(generated),
+            "stopped_word": bool(stopping_word),
+            "stopped_limit": not stopping_word,
+            "stopping_word": stopping_word,
+            "timings": {
+                "prompt_n": evaluated,
+                "prompt_ms": evaluated * PROMPT_MS,
+                "predicted_n": len(generated),
+                "predicted_ms": len(generated) * PREDICTED_MS,
+            },
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: MockLlamaCpp
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._json({"status": "ok"})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/tokenize":
+            self._json({"tokens": [zlib.crc32(token.encode()) for token in tokenize(request["content"])]})
+        elif self.path != "/completion":
+            self.send_error(404)
+        elif not request.get("stream"):
+            content, final = "", {}
+            for token, final in self.server.complete(request):
+                content += token
+            self._json({**final, "content": content})
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            try:
+                for token, final in self.server.complete(request):
+                    event = final or {"content": token, "stop": False}
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+                    self.wfile.flush()
+                    if self.server.delay:
+                        time.sleep(self.server.delay)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+
+def start(port: int = 0, parallel: int = 4, delay: float = 0.0, defects: float = 0.0) -> MockLlamaCpp:
+    """Serve on a background thread; `server.server_address` has the actual port."""
+    server = MockLlamaCpp(("127.0.0.1", port), parallel, delay, defects)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--parallel", type=int, default=4)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds between streamed tokens")
+    parser.add_argument("--defects", type=float, default=0.0, help="share of malformed completions without a grammar")
+    args = parser.parse_args()
+    MockLlamaCpp(("127.0.0.1", args.port), args.parallel, args.delay, args.defects).serve_forever()
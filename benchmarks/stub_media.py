@@ -0,0 +1,109 @@
+"""A stand-in for the image, music and speech services behind nginx.
+
+Answers `/image/...`, `/music/...` and `/speech/...` (also under `/media/`,
+as the backend's media cache serves them) after a fixed delay per service,
+plus optionally one per character of the prompt, per pixel of the image or
+per second of the music asked for, like a GPU generating the asset, and counts
+how often each URL was requested and how many requests ran at once. Music is a
+silent WAV of the `duration` asked for.
+
+Run from the repository root, then point the app at it:
+
+    python -m benchmarks.stub_media --port 8300
+    VNML_MEDIA_BASE_URL=http://127.0.0.1:8300/ reflex run
+"""
+
+import argparse
+import io
+import threading
+import time
+import wave
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+DELAYS = {"image": 0.5, "music": 1.0, "speech": 0.2}
+
+BODIES = {
+    "image": ("image/png", b"\x89PNG\r\n\x1a\n" + bytes(1024)),
+    "music": ("audio/wav", b"RIFF" + bytes(4096)),
+    "speech": ("audio/wav", b"RIFF" + bytes(2048)),
+}
+
+
+def silence(seconds: float, rate: int = 8000) -> bytes:
+    """A WAV of `seconds` of silence, 8-bit mono."""
+    body = io.BytesIO()
+    with wave.open(body, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(1)
+        file.setframerate(rate)
+        file.writeframes(b"\x80" * int(seconds * rate))
+    return body.getvalue()
+
+
+class StubMedia(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], delays: dict[str, float] = DELAYS,
+                 per_char: dict[str, float] | None = None, per_megapixel: float = 0.0, per_second: float = 0.0):
+        super().__init__(address, _Handler)
+        self.delays = delays
+        self.per_char = per_char or {}  # extra seconds per character of the prompt, e.g. of text to speak
+        self.per_megapixel = per_megapixel  # extra seconds per million pixels of `width` x `height`
+        self.per_second = per_second  # extra seconds per second of music, its `duration`
+        self.requests: Counter[str] = Counter()
+        self.running: Counter[str] = Counter()
+        self.peak: Counter[str] = Counter()  # most requests running at once, per service
+        self.lock = threading.Lock()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: StubMedia
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        name = self.path.lstrip("/").removeprefix("media/").partition("/")[0]
+        if name not in BODIES:
+            self.send_error(404)
+            return
+        with self.server.lock:
+            self.server.requests[self.path] += 1
+            self.server.running[name] += 1
+            self.server.peak[name] = max(self.server.peak[name], self.server.running[name])
+        try:
+            url = urlsplit(self.path)
+            prompt = unquote(url.path).partition(f"{name}/")[2]
+            query = parse_qs(url.query)
+            pixels = int(query.get("width", ["0"])[0]) * int(query.get("height", ["0"])[0])
+            duration = float(query.get("duration", ["0"])[0])
+            time.sleep(self.server.delays.get(name, 0.0) + self.server.per_char.get(name, 0.0) * len(prompt)
+                       + self.server.per_megapixel * pixels / 1e6 + self.server.per_second * duration)
+        finally:
+            with self.server.lock:
+                self.server.running[name] -= 1
+        content_type, body = BODIES[name]
+        if name == "music" and duration:
+            body = silence(duration)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start(port: int = 0, delays: dict[str, float] = DELAYS, per_char: dict[str, float] | None = None,
+          per_megapixel: float = 0.0, per_second: float = 0.0) -> StubMedia:
+    """Serve on a background thread; `server.server_address` has the actual port."""
+    server = StubMedia(("127.0.0.1", port), delays, per_char, per_megapixel, per_second)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8300)
+    args = parser.parse_args()
+    StubMedia(("127.0.0.1", args.port)).serve_forever()
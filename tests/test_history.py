@@ -0,0 +1,115 @@
+"""`HistoryBuffer` restores the same states through keyframes, forks, truncations and pages."""
+
+import asyncio
+
+from vnml.history import KEYFRAME_INTERVAL, PAGE_SIZE, HistoryBuffer
+
+LENGTH = 3 * PAGE_SIZE + KEYFRAME_INTERVAL // 2
+
+
+def diff(index: int, text: str = "line") -> dict:
+    do_log, undo_log = {"dialogue": f"{text} {index}"}, {"dialogue": f"{text} {index - 1}"}
+    if index % 10 == 0:
+        do_log["background_url"], undo_log["background_url"] = f"{text} scene {index}", None
+    if index % 7 == 0:  # a new look for one character, the others unchanged
+        name = f"character {index % 3}"
+        do_log["characters"] = {name: {"identifier": f"{text} {index}", "clothes": ""}}
+        undo_log["characters"] = {name: None}
+    return {"do_log": do_log, "undo_log": undo_log, "vnml": f"<narration>{text} {index}</narration>", "gap": "\n"}
+
+
+def replayed(diffs: list[dict], index: int) -> dict:
+    """The state after `diffs[:index + 1]`, stepping through every one of them."""
+    state = {}
+    for diff in diffs[:index + 1]:
+        for key, value in diff["do_log"].items():
+            state[key] = {**state.get(key, {}), **value} if key == "characters" else value
+    return state
+
+
+def history_of(diffs: list[dict]) -> HistoryBuffer:
+    history = HistoryBuffer()
+    for diff in diffs:
+        history.append(diff)
+    return history
+
+
+def test_state_at_every_index():
+    diffs = [diff(index) for index in range(LENGTH)]
+    history = history_of(diffs)
+    for index in range(-1, LENGTH):
+        assert history.state_at(index) == replayed(diffs, index)
+
+
+def test_truncate_then_append():
+    old, new = [diff(index, "old") for index in range(LENGTH)], [diff(index, "new") for index in range(LENGTH)]
+    for length in (0, 1, KEYFRAME_INTERVAL - 1, KEYFRAME_INTERVAL, KEYFRAME_INTERVAL + 1, PAGE_SIZE + 5):
+        history = history_of(old)
+        history.vnml()  # truncating must also cut the joined VNML
+        history.truncate(length)
+        for item in new[length:]:
+            history.append(item)
+        expected = history_of(old[:length] + new[length:])
+        assert history.vnml() == expected.vnml()
+        assert history.scenes() == expected.scenes()
+        for index in range(-1, LENGTH, 5):
+            assert history.state_at(index) == expected.state_at(index)
+
+
+def test_fork_is_independent():
+    diffs = [diff(index) for index in range(2 * KEYFRAME_INTERVAL + 3)]
+    history = history_of(diffs)
+    fork = history.fork()
+    fork.append(diff(len(diffs), "fork"))
+    history.truncate(KEYFRAME_INTERVAL + 1)
+    history.append(diff(KEYFRAME_INTERVAL + 1, "other"))
+    assert len(fork) == len(diffs) + 1
+    assert fork.state_at(len(diffs) - 1) == replayed(diffs, len(diffs) - 1)
+    assert fork.vnml_at(-1) == f"<narration>fork {len(diffs)}</narration>"
+    assert history.vnml_at(-1) == f"<narration>other {KEYFRAME_INTERVAL + 1}</narration>"
+
+
+def test_bytes_round_trip():
+    history = history_of([diff(index) for index in range(LENGTH)])
+    history.truncate(LENGTH - 3)  # leaves strings of the dropped diffs in the table
+    copy = HistoryBuffer.from_bytes(history.to_bytes())
+    assert copy.vnml() == history.vnml()
+    assert copy.scenes() == history.scenes()
+    assert all(copy[index] == history[index] for index in range(len(history)))
+    assert copy.state_at(len(copy) - 1) == history.state_at(len(history) - 1)
+
+
+def paged(diffs: list[dict]) -> tuple[HistoryBuffer, list[tuple[int, int]]]:
+    """A history of `diffs` read back from a store a page at a time, and the pages read."""
+    expected, reads = history_of(diffs), []
+
+    def loader(start: int, stop: int) -> tuple[dict, list[dict]]:
+        reads.append((start, stop))
+        return expected.state_at(start - 1), [expected[index] for index in range(start, stop)]
+
+    return HistoryBuffer.paged(len(diffs), expected.scene_starts, loader), reads
+
+
+def test_pages_fault_in():
+    diffs = [diff(index) for index in range(LENGTH)]
+    history, reads = paged(diffs)
+    assert history.loaded_from == 2 * PAGE_SIZE  # the page holding the last PAGE_SIZE diffs, and those after it
+    assert history.state_at(PAGE_SIZE + 3) == replayed(diffs, PAGE_SIZE + 3)
+    assert history.loaded_from == PAGE_SIZE
+    assert history.vnml() == history_of(diffs).vnml()
+    assert history.loaded_from == 0
+    assert len(reads) == 3
+
+
+def test_concurrent_loads():
+    diffs = [diff(index) for index in range(LENGTH)]
+    history, reads = paged(diffs)
+
+    async def load():
+        await asyncio.gather(history.load(PAGE_SIZE + 1), history.load(0), history.load(-1))
+
+    asyncio.run(load())
+    assert history.loaded_from == 0
+    assert all(history[index] == history_of(diffs)[index] for index in (0, PAGE_SIZE - 1, PAGE_SIZE, LENGTH - 1))
+    assert history.scenes() == history_of(diffs).scenes()
+    assert reads[0] == (2 * PAGE_SIZE, LENGTH)
@@ -0,0 +1,59 @@
+"""`VNMLStreamParser` cuts the same fragments however the stream is split."""
+
+import pytest
+
+from vnml.parser import VNMLStreamParser, tag_of
+
+STREAM = (
+    "```vnml\n<vnml lang=\"en\">\n<!-- a < b -->\n<Scene>\n<background keywords=\"old town\"/>\n</Scene>\n"
+    "<dialogue>\n<NARRATION>\nIf a < b and b > c\n</narration>\n"
+    "a < b, and 1<2 <character name=\"Eli\" emotion=\"calm\">\nHello <there>.\n</Character>\n"
+    "</dialogue>\n<options>\n<title>Next?</title>\n<option>Go</option>\n</OPTIONS>\n"
+)
+
+FRAGMENTS = [
+    "<Scene>\n<background keywords=\"old town\"/>\n</Scene>",
+    "<NARRATION>\nIf a < b and b > c\n</narration>",
+    "<character name=\"Eli\" emotion=\"calm\">\nHello <there>.\n</Character>",
+    "<options>\n<title>Next?</title>\n<option>Go</option>\n</OPTIONS>",
+]
+
+
+def feed_in_chunks(text: str, size: int) -> list[tuple[str, str]]:
+    parser = VNMLStreamParser()
+    return [pair for start in range(0, len(text), size) for pair in parser.feed_raw(text[start:start + size])]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 4, 5, 7, 16, len(STREAM)])
+def test_chunk_splits(size):
+    pairs = feed_in_chunks(STREAM, size)
+    assert [fragment for _, fragment in pairs] == FRAGMENTS
+    assert "".join(gap + fragment for gap, fragment in pairs) == STREAM[:STREAM.rindex(">") + 1]
+
+
+def test_stray_less_than_is_text():
+    assert VNMLStreamParser().feed("a < b <narration>x</narration>") == ["<narration>x</narration>"]
+
+
+def test_less_than_at_the_end_of_a_chunk():
+    parser = VNMLStreamParser()
+    assert parser.feed("a <") == []
+    assert parser.feed_raw(" b <") == []
+    assert parser.feed_raw("narration>x</narration>") == [("a < b ", "<narration>x</narration>")]
+
+
+def test_closing_tag_in_any_case():
+    parser = VNMLStreamParser()
+    assert parser.feed("<narration>x</Narr") == []
+    assert parser.partial == "<narration>x</Narr"
+    assert parser.feed("ATION>") == ["<narration>x</NarrATION>"]
+
+
+@pytest.mark.parametrize("vnml, tag", [
+    ("<Options>\n<title>t</title></Options>", "options"),
+    ("  <CHARACTER name=\"A\">x</CHARACTER>", "character"),
+    ("text", ""),
+    ("< b", "b"),
+])
+def test_tag_of(vnml, tag):
+    assert tag_of(vnml) == tag
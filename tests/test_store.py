@@ -0,0 +1,120 @@
+"""Sessions written through `SessionStore` read back the same, whichever backend."""
+
+import pytest
+
+from vnml.history import KEYFRAME_INTERVAL, PAGE_SIZE, HistoryBuffer
+from vnml.store import RedisBackend, SessionStore, SQLiteBackend
+
+
+class FakeRedis:
+    """The few Redis commands `RedisBackend` uses, on dicts, with Redis's index rules."""
+
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self, transaction: bool = True) -> "FakeRedis._Pipeline":
+        return self._Pipeline(self)
+
+    class _Pipeline:
+        def __init__(self, redis: "FakeRedis"):
+            self._redis, self._calls = redis, []
+
+        def __getattr__(self, name: str):
+            return lambda *args, **kwargs: self._calls.append((name, args, kwargs))
+
+        def execute(self):
+            for name, args, kwargs in self._calls:
+                getattr(self._redis, name)(*args, **kwargs)
+
+    @staticmethod
+    def _span(items: list, start: int, end: int) -> slice:
+        size = len(items)
+        start, end = start + size if start < 0 else start, end + size if end < 0 else end
+        return slice(max(start, 0), end + 1)
+
+    def rpush(self, key: str, value: str):
+        self.data.setdefault(key, []).append(value)
+
+    def ltrim(self, key: str, start: int, end: int):
+        kept = self.data.get(key, [])[self._span(self.data.get(key, []), start, end)]
+        if kept:
+            self.data[key] = kept
+        else:
+            self.data.pop(key, None)
+
+    def lrange(self, key: str, start: int, end: int) -> list[str]:
+        items = self.data.get(key, [])
+        return items[self._span(items, start, end)]
+
+    def lindex(self, key: str, index: int) -> str | None:
+        items = self.data.get(key, [])
+        return items[index] if -len(items) <= index < len(items) else None
+
+    def llen(self, key: str) -> int:
+        return len(self.data.get(key, []))
+
+    def zadd(self, key: str, members: dict[str, int]):
+        self.data.setdefault(key, {}).update(members)
+
+    def zremrangebyscore(self, key: str, low: int, high: str):
+        members = self.data.get(key, {})
+        for member, score in list(members.items()):
+            if score >= low:
+                del members[member]
+
+    def zrange(self, key: str, start: int, end: int) -> list[str]:
+        return [member for member, _ in sorted(self.data.get(key, {}).items(), key=lambda item: item[1])]
+
+    def delete(self, *keys: str):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def set(self, key: str, value: str):
+        self.data[key] = value
+
+    def get(self, key: str) -> str | None:
+        return self.data.get(key)
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteBackend(str(tmp_path / "sessions.db"))
+    backend = RedisBackend.__new__(RedisBackend)
+    backend._redis = FakeRedis()
+    return backend
+
+
+def diff(index: int, text: str) -> dict:
+    scene = index % 10 == 0
+    return {
+        "do_log": {"dialogue": f"{text} {index}", **({"background_url": f"{text} scene {index}"} if scene else {})},
+        "undo_log": {"dialogue": f"{text} {index - 1}", **({"background_url": None} if scene else {})},
+        "vnml": f"<narration>{text} {index}</narration>",
+        "gap": "\n",
+    }
+
+
+@pytest.mark.parametrize("length", [0, KEYFRAME_INTERVAL // 2, KEYFRAME_INTERVAL, 300])
+def test_truncate_then_append(backend, length):
+    store = SessionStore(backend, flush_interval=0)
+    history, expected = store.open("session"), HistoryBuffer()
+    for index in range(300):
+        history.append(diff(index, "old"))
+        expected.append(diff(index, "old"))
+    store.flush()
+    history.truncate(length)
+    expected.truncate(length)
+    for index in range(length, length + 2 * PAGE_SIZE):  # so that reading it back starts from a keyframe
+        history.append(diff(index, "new"))
+        expected.append(diff(index, "new"))
+    store.flush()
+
+    resumed = SessionStore(backend).open("session")
+    assert resumed.loaded_from > 0
+    assert len(resumed) == len(expected)
+    assert resumed.scenes() == expected.scenes()
+    for index in (0, length - 1, length, PAGE_SIZE, len(expected) - 1):
+        if index >= 0:
+            assert resumed[index] == expected[index]
+            assert resumed.state_at(index) == expected.state_at(index)
@@ -0,0 +1,387 @@
+"""Compiling VNML into the diffs the playground steps through.
+
+Every fragment of a turn becomes a `Diff` against the snapshot of the lines
+before it: the media URLs and text it shows, and the character table when it
+changes a character's look. `TurnCompiler` does this for a whole turn in one
+pass, as one document or as it streams in: on the event loop that serves the
+players, a few fragments at a time, or in a generation worker, see
+`vnml.generation`.
+"""
+
+import math
+import os
+import re
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
+from urllib.parse import quote
+
+from vnml import keywords as keyword_index
+from vnml.keywords import normalize_text
+from vnml.parser import VNMLStreamParser, decode_fragment, tag_of
+
+# The media cache served by the backend (vnml.media_cache), in front of nginx.
+BASE_URL = os.environ.get("VNML_MEDIA_BASE_URL", "http://127.0.0.1:8000/media/")
+
+SEED = 42
+
+# Sprite URLs kept built, by look: every line of a character re-uses one of a few.
+SPRITE_CACHE = 4096
+
+# The playground box and the sprite slot in it, in CSS pixels (see vnml.components.playground).
+VIEWPORT = (1280, 720)
+SPRITE_SLOT = 512
+
+# Device pixels per CSS pixel that images are rendered for, e.g. 2 for HiDPI screens.
+IMAGE_DENSITY = float(os.environ.get("VNML_IMAGE_DENSITY", "1"))
+
+# The size of the previews shown while the full images render, relative to
+# theirs; a small one takes a fraction of the time. 0 turns previews off.
+PREVIEW_SCALE = float(os.environ.get("VNML_IMAGE_PREVIEW_SCALE", "0.25"))
+
+
+def image_size(width: int, height: int, scale: float = 1.0) -> tuple[int, int]:
+    """`width` x `height` CSS pixels at `IMAGE_DENSITY` and `scale`, rounded up to the multiples of 64 SDXL renders."""
+    return tuple(max(64, math.ceil(side * IMAGE_DENSITY * scale / 64) * 64) for side in (width, height))
+
+
+BACKGROUND_SIZE = image_size(*VIEWPORT)
+SPRITE_SIZE = image_size(SPRITE_SLOT, SPRITE_SLOT)
+BACKGROUND_PREVIEW = image_size(*VIEWPORT, PREVIEW_SCALE) if PREVIEW_SCALE > 0 else None
+SPRITE_PREVIEW = image_size(SPRITE_SLOT, SPRITE_SLOT, PREVIEW_SCALE) if PREVIEW_SCALE > 0 else None
+
+
+def background_url(keywords, width, height, seed=SEED, names=()):
+    keywords = keyword_index.backgrounds.normalize(keywords, names)
+    return f"{BASE_URL}image/cinematic,{quote(keywords, safe='')}?&width={width}&height={height}&seed={seed}"
+
+
+@lru_cache(maxsize=SPRITE_CACHE)
+def character_url(identifier, emotion, clothes=None, width=SPRITE_SIZE[0], height=SPRITE_SIZE[1], seed=SEED):
+    identifier = keyword_index.characters.normalize(identifier)
+    if clothes:
+        identifier = f"{identifier},{keyword_index.characters.normalize(clothes)}"
+    emotion = keyword_index.palette.quantize(keyword_index.emotions.normalize(emotion))
+    return f"{BASE_URL}image/upper body,focus on face,{quote(f'{identifier},{emotion}', safe='')}?seed={seed}&rembg=true&height={height}&width={width}"
+
+
+def sprite_sheet(identifier, clothes=None) -> list[str]:
+    """The sprites of a look in every emotion of the palette, previews first; none without a palette."""
+    sizes = [SPRITE_PREVIEW, SPRITE_SIZE] if SPRITE_PREVIEW else [SPRITE_SIZE]
+    return [character_url(identifier, emotion, clothes, *size)
+            for size in sizes for emotion in keyword_index.palette.emotions]
+
+
+# Seconds of the clip that loops through a scene, and of the short one it
+# starts with: generated first, it plays a second or so after the scene
+# starts, and, with the same seed, opens the same way. 0 goes without.
+MUSIC_DURATION = float(os.environ.get("VNML_MUSIC_DURATION", "30"))
+MUSIC_INTRO = float(os.environ.get("VNML_MUSIC_INTRO", "4"))
+
+
+def music_url(keywords, seed=SEED, duration=MUSIC_DURATION):
+    keywords = keyword_index.music.normalize(keywords)
+    return f"{BASE_URL}music/{quote(keywords, safe='')}?seed={seed}&duration={duration:g}"
+
+
+# Sentences shorter than this are spoken together with the next one.
+MIN_SPEECH_CHARS = 12
+
+_SENTENCE_END = re.compile(r"(?:[.!?…]+[\"'”’)]*(?=\s)|[。！？]+[”’」』]*)")
+
+
+def sentences(text: str) -> list[str]:
+    """`text` cut after every sentence, joining those shorter than `MIN_SPEECH_CHARS` to the next."""
+    cuts, start = [], 0
+    for match in _SENTENCE_END.finditer(text):
+        if len(text[start:match.end()].strip()) >= MIN_SPEECH_CHARS:
+            cuts.append(match.end())
+            start = match.end()
+    if cuts and len(text[cuts[-1]:].strip()) < MIN_SPEECH_CHARS:
+        cuts.pop()
+    bounds = [0, *cuts, len(text)]
+    return [segment for start, end in zip(bounds, bounds[1:]) if (segment := text[start:end].strip())]
+
+
+def dialogue_url(text, seed=SEED) -> list[str]:
+    """The speech of `text`, a URL per sentence.
+
+    Playback starts as soon as the first sentence is spoken rather than the
+    whole line, and a sentence said before is cached already.
+    """
+    return [f"{BASE_URL}speech/{quote(normalize_text(sentence))}?seed={seed}" for sentence in sentences(text)]
+
+
+@dataclass
+class Diff:
+    do_log: dict
+    undo_log: dict
+    vnml: str
+    gap: str = ''  # raw text the model wrote between the previous fragment and this one
+
+
+# What a character looks like; a line that leaves one out keeps the character's last one.
+LOOKS = ("identifier", "emotion", "clothes")
+
+
+def vnml2log(vnml: str, characters: dict[str, dict] | None = None) -> dict:
+    """The `do_log` of a fragment.
+
+    Args:
+        vnml: The fragment.
+        characters: The looks of the characters of the story so far, by name.
+            Never modified: a line that changes a look sets `do_log["characters"]`
+            to that entry alone, see `merge_characters`.
+    """
+    characters = characters or {}
+    do_log = {
+        "character_url": None,
+        "character_preview_url": None,
+        "character_name": None,
+        "dialogue": None,
+        "dialogue_url": None,
+        "option_title": None,
+        "options": []
+    }
+    fragment = decode_fragment(vnml)
+    tag = fragment.tag if fragment else None
+    if tag == "scene":
+        background_keywords = fragment.find("background").attrs['keywords']
+        music_keywords = fragment.find("music").attrs['keywords']
+        do_log.update(
+            {"background_url": background_url(background_keywords, *BACKGROUND_SIZE, names=characters),
+             "background_preview_url": background_url(background_keywords, *BACKGROUND_PREVIEW, names=characters)
+             if BACKGROUND_PREVIEW else None,
+             "music_url": music_url(music_keywords),
+             "music_intro_url": music_url(music_keywords, duration=MUSIC_INTRO) if MUSIC_INTRO else None,
+             "option_title": None,
+             "options": []})
+        return do_log
+    elif tag == "character":
+        character_name = fragment.attrs['name']
+        known = characters.get(character_name, {})
+        look = {key: fragment.attrs.get(key) or known.get(key) for key in LOOKS}
+        if not look["identifier"]:  # a character the story never described
+            look["identifier"] = character_name
+        text = fragment.text.strip()
+        do_log.update({
+            "character_url": character_url(look["identifier"], look["emotion"], look["clothes"]),
+            "character_preview_url": character_url(look["identifier"], look["emotion"], look["clothes"],
+                                                   *SPRITE_PREVIEW) if SPRITE_PREVIEW else None,
+            "character_name": character_name,
+            "dialogue": text,
+            "dialogue_url": dialogue_url(text)
+        })
+        if look != known:
+            do_log["characters"] = {character_name: look}
+        return do_log
+    elif tag == "narration":
+        text = fragment.text.strip()
+        do_log.update({"dialogue": text, "dialogue_url": dialogue_url(text)})
+        return do_log
+    elif tag == "options":
+        option_title = fragment.find("title").text.strip()
+        options = [i.text.strip() for i in fragment.find_all("option")]
+        do_log.update({"option_title": option_title, "options": options})
+        return do_log
+    return {"dialogue": vnml, "option_title": None, "options": []}
+
+
+@dataclass(slots=True)
+class GameSnapshot:
+    background_url: str
+    background_preview_url: str  # a small render, shown until the full one loads
+    music_url: str
+    music_intro_url: str  # a short clip, played until the one that loops loads
+    character_url: str
+    character_preview_url: str
+    character_name: str
+    dialogue: str
+    dialogue_url: list[str]  # a URL per sentence, see `dialogue_url`
+    option_title: str
+    options: list[str]
+    characters: dict[str, dict] = field(default_factory=dict)  # {"name": {"identifier": "value"}}, see vnml2log
+
+    def apply(self, changes: dict):
+        """Set the fields in `changes` in place, leaving the others untouched."""
+        for key, value in changes.items():
+            if key == "characters":
+                value = merge_characters(self.characters, value)
+            setattr(self, key, value)
+
+    def __iadd__(self, diff: Diff):
+        self.apply(diff.do_log)
+        return self
+
+    def __isub__(self, diff: Diff):
+        self.apply(diff.undo_log)
+        return self
+
+    def __add__(self, diff: Diff):
+        snapshot = replace(self)
+        snapshot.apply(diff.do_log)
+        return snapshot
+
+    def __sub__(self, diff: Diff):
+        snapshot = replace(self)
+        snapshot.apply(diff.undo_log)
+        return snapshot
+
+
+def merge_characters(table: dict[str, dict], changes: dict[str, dict | None] | None) -> dict[str, dict]:
+    """`table` updated with the looks in `changes`, the `characters` of a `do_log` or `undo_log`.
+
+    Diffs only carry the entries a line changes, and an `undo_log` the entries
+    as they were before it, None for a character not in the table yet. The
+    table is copied rather than modified, as snapshots and histories share it.
+    """
+    if not changes:
+        return table
+    merged = {**table, **changes}
+    return {name: look for name, look in merged.items() if look is not None}
+
+
+# The fields of a diff that are media URLs; previews first, so that the
+# prefetcher has them ready well before the full images.
+MEDIA_KEYS = ("background_preview_url", "character_preview_url", "music_intro_url", "background_url", "music_url",
+              "character_url", "dialogue_url")
+
+
+def media_urls(do_log: dict) -> list[str]:
+    """The media URLs a diff shows, in order; speech has one per sentence."""
+    urls = []
+    for key in MEDIA_KEYS:
+        value = do_log.get(key)
+        if isinstance(value, (list, tuple)):
+            urls.extend(value)
+        elif value:
+            urls.append(value)
+    return urls
+
+
+# What the playground shows before the first diff; `DisplayState` has a var for each.
+# The character table is only needed to write diffs, so it stays in the history.
+DISPLAY_DEFAULTS = {
+    "background_url": None,
+    "background_preview_url": None,
+    "music_url": None,
+    "music_intro_url": None,
+    "character_url": None,
+    "character_preview_url": None,
+    "character_name": None,
+    "dialogue": None,
+    "dialogue_url": None,
+    "option_title": None,
+    "options": [],
+}
+
+
+def calculate_diff(snapshot: GameSnapshot, do_log: dict, vnml: str, gap: str = '') -> Diff:
+    undo_log = {}
+    for key, value in do_log.items():
+        old = getattr(snapshot, key)
+        if key == "characters":
+            old = {name: old.get(name) for name in value}
+        if value != old:
+            undo_log[key] = old
+    return Diff(do_log, undo_log, vnml, gap)
+
+
+# Caps on what the model writes in a turn, by element, e.g. "dialogue=40,narration=600":
+# characters for a narration or character line, lines for the dialogue of a
+# turn and options for its options. A line is cut at the last sentence that
+# fits, the options after the last option that does, and the dialogue after
+# the line that reaches its cap, then the turn goes on in a new completion.
+MAX_LENGTH = {
+    "narration": 1200,
+    "character": 600,
+    "dialogue": 60,
+    "options": 6,
+    **{
+        tag.strip(): int(cap)
+        for tag, _, cap in (item.partition("=") for item in os.environ.get("VNML_MAX_LENGTH", "").split(",") if item)
+    },
+}
+
+# Text fed to a `TurnCompiler` at the latest, even if no ">" in it may end a
+# fragment, so that a line running past its cap is cut soon after.
+FEED_CHARS = 64
+
+
+def overrun(partial: str) -> tuple[str, int, str] | None:
+    """How to end `partial`, the raw element being written, if it is past its cap in `MAX_LENGTH`.
+
+    Returns:
+        The element's tag, how much of `partial` to keep and what to close it
+        with, or None while it is within its cap.
+    """
+    tag = tag_of(partial)
+    if tag == "options":
+        ends = [match.end() for match in re.finditer(r"</\s*option\s*>", partial)]
+        if len(ends) >= MAX_LENGTH["options"]:
+            return tag, ends[MAX_LENGTH["options"] - 1], "\n</options>"
+    elif tag in ("narration", "character") and ">" in partial:
+        start = partial.index(">") + 1
+        if len(partial) - start > MAX_LENGTH[tag]:
+            text = partial[start:start + MAX_LENGTH[tag]]
+            ends = [match.end() for match in _SENTENCE_END.finditer(text)]
+            return tag, start + (ends[-1] if ends else len(text)), f"\n</{tag}>"
+    return None
+
+
+@dataclass
+class CompiledTurn:
+    """What a piece of a turn compiled to."""
+    diffs: list[Diff] = field(default_factory=list)
+    characters: dict[str, dict] = field(default_factory=dict)  # the character table after the last diff
+    urls: list[str] = field(default_factory=list)  # media shown by the diffs, in order of first use
+    done: bool = False  # whether the turn reached its options
+    cut: str = ""  # the element cut short at its cap in `MAX_LENGTH`, after which the completion should stop
+
+
+class TurnCompiler:
+    """Compiles a turn from its raw VNML, whole or chunk by chunk as the model writes it.
+
+    Every complete fragment becomes a diff against `snapshot`, which is advanced
+    past it in place. The turn ends with its options: anything after them is
+    left to the next turn. An element that runs past its cap in `MAX_LENGTH`
+    is closed right away, see `CompiledTurn.cut`.
+    """
+
+    def __init__(self, snapshot: GameSnapshot):
+        self.snapshot = snapshot
+        self.done = False
+        self.cut = ""
+        self._parser = VNMLStreamParser()
+
+    def feed(self, text: str) -> CompiledTurn:
+        """Compile the fragments that `text` completes."""
+        turn = CompiledTurn()
+        if self.done or self.cut:
+            return turn
+        self._compile(self._parser.feed_raw(text), turn)
+        if not self.done and (cap := overrun(self._parser.partial)):
+            self.cut, keep, closing = cap
+            self._compile(self._parser.close(keep, closing), turn)
+        turn.characters = self.snapshot.characters
+        turn.done = self.done
+        turn.cut = self.cut
+        return turn
+
+    def _compile(self, fragments: list[tuple[str, str]], turn: CompiledTurn):
+        seen = set(turn.urls)
+        for gap, vnml in fragments:
+            if self.done:
+                break
+            diff = calculate_diff(self.snapshot, vnml2log(vnml, self.snapshot.characters), vnml, gap)
+            self.snapshot += diff
+            turn.diffs.append(diff)
+            for url in media_urls(diff.do_log):
+                if url not in seen:
+                    seen.add(url)
+                    turn.urls.append(url)
+            self.done = tag_of(vnml) == "options"
+
+
+def compile_turn(document: str, snapshot: GameSnapshot) -> CompiledTurn:
+    """Compile a whole turn, e.g. one of the sample `outputs`, from `snapshot`, which is left as is."""
+    return TurnCompiler(replace(snapshot)).feed(document)
@@ -0,0 +1,49 @@
+"""An image shown as a small preview until its full resolution loads."""
+
+import reflex as rx
+
+# The full image is loaded off screen, and replaces the preview once it has;
+# until then, and for an image without a preview, the <img> shows what it can.
+_PROGRESSIVE_IMAGE = """
+function ProgressiveImage({ src, preview, fit }) {
+  const [loaded, setLoaded] = useState(null);
+  useEffect(() => {
+    if (!src || !preview) {
+      return;
+    }
+    const image = new Image();
+    image.onload = () => setLoaded(src);
+    image.src = src;
+    return () => {
+      image.onload = null;
+    };
+  }, [src, preview]);
+  return (
+    <img
+      src={loaded === src || !preview ? src : preview}
+      style={{ width: "100%", height: "100%", objectFit: fit ?? "contain" }}
+    />
+  );
+}
+"""
+
+
+class ProgressiveImage(rx.Component):
+    """Shows `preview`, e.g. `character_preview_url`, until `src` has loaded, then `src`; fills its parent."""
+
+    tag = "ProgressiveImage"
+
+    src: rx.Var[str]
+
+    preview: rx.Var[str]
+
+    fit: rx.Var[str]  # the CSS object-fit, "contain" by default
+
+    def add_imports(self) -> dict:
+        return {"react": ["useEffect", "useState"]}
+
+    def add_custom_code(self) -> list[str]:
+        return [_PROGRESSIVE_IMAGE]
+
+
+progressive_image = ProgressiveImage.create
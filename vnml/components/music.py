@@ -0,0 +1,81 @@
+"""The music of a scene: a short intro at once, then the clip that loops."""
+
+import reflex as rx
+
+# The intro loops until the clip has buffered enough to play through, then the
+# clip picks up where the intro is, which it opens the same way, and fades in
+# over it. Picking it up there is a seek, i.e. a Range request to the cache.
+_MUSIC_PLAYER = """
+function MusicPlayer({ intro, src, fade }) {
+  const first = useRef(null);
+  const second = useRef(null);
+  useEffect(() => {
+    const [opening, looping] = [first.current, second.current];
+    let timer = null;
+    looping.loop = true;
+    looping.src = src;
+    looping.load();
+    if (!intro) {
+      looping.volume = 1;
+      looping.play().catch(() => {});
+    } else {
+      opening.loop = true;
+      opening.src = intro;
+      opening.volume = 1;
+      opening.play().catch(() => {});
+      looping.volume = 0;
+      looping.oncanplaythrough = () => {
+        looping.oncanplaythrough = null;
+        if (opening.currentTime < looping.duration) {
+          looping.currentTime = opening.currentTime;
+        }
+        looping.play().catch(() => {});
+        const started = performance.now();
+        const duration = (fade ?? 2) * 1000;
+        timer = setInterval(() => {
+          const done = Math.min(1, (performance.now() - started) / duration);
+          looping.volume = done;
+          opening.volume = 1 - done;
+          if (done >= 1) {
+            clearInterval(timer);
+            opening.pause();
+          }
+        }, 50);
+      };
+    }
+    return () => {
+      clearInterval(timer);
+      looping.oncanplaythrough = null;
+      opening.pause();
+      looping.pause();
+    };
+  }, [intro, src]);
+  return (
+    <>
+      <audio ref={first} preload="auto" />
+      <audio ref={second} preload="auto" />
+    </>
+  );
+}
+"""
+
+
+class MusicPlayer(rx.Component):
+    """Plays `intro`, e.g. `music_intro_url`, until `src` can play through, then crossfades into `src` and loops it."""
+
+    tag = "MusicPlayer"
+
+    src: rx.Var[str]
+
+    intro: rx.Var[str]
+
+    fade: rx.Var[float]  # seconds of the crossfade, 2 by default
+
+    def add_imports(self) -> dict:
+        return {"react": ["useEffect", "useRef"]}
+
+    def add_custom_code(self) -> list[str]:
+        return [_MUSIC_PLAYER]
+
+
+music_player = MusicPlayer.create
@@ -1,236 +1,455 @@
-from dataclasses import dataclass
+import asyncio
+import contextlib
 from functools import partial
-from typing import Iterator
-from urllib.parse import quote
+from typing import AsyncIterator
 
 import reflex as rx
-from bs4 import BeautifulSoup
-from furchain.text.schema import LlamaCpp, ChatFormat
-from pydantic import Field
 
-BASE_URL = "http://127.0.0.1/"
+from vnml import generation
+from vnml.compiler import (DISPLAY_DEFAULTS, FEED_CHARS, MAX_LENGTH, SPRITE_SLOT, VIEWPORT, Diff, GameSnapshot,
+                           TurnCompiler, calculate_diff, sprite_sheet)
+from vnml.components.image import progressive_image
+from vnml.components.music import music_player
+from vnml.components.speech import speech_queue
+from vnml.grammar import GRAMMAR, gbnf, resume_point
+from vnml.history import HistoryBuffer, get_history, has_history
+from vnml.llm import CompletionMetrics, stream_completion
+from vnml.parser import decode_fragment, tag_of
+from vnml.prefetch import prefetcher
+from vnml.prompt import CONTINUE, N_PREDICT, WRAP_UP, build_prompt
+from vnml.scheduler import Cancelled, Priority, scheduler
+from vnml.speculation import SPECULATE, branches
+from vnml.store import store
+
+BACKLOG_LINES = 100
 
-SEED = 42
-
-def background_url(keywords, width, height, seed=SEED):
-    return f"{BASE_URL}image/cinematic,{quote(keywords, safe='')}?&width={width}&height={height}&seed={seed}"
-
-
-def character_url(identifier, emotion, width=1024, height=1024, seed=SEED):
-    return f"{BASE_URL}image/upper body,focus on face,{quote(f'{identifier},{emotion}', safe='')}?seed={seed}&rembg=true&height={height}&width={width}"
-
-
-def music_url(keywords, seed=SEED):
-    return f"{BASE_URL}music/{quote(keywords, safe='')}?seed={seed}"
+outputs = ["```vnml\n<vnml lang=\"en\">\n<action>Start!</action>\n<scene>\n<background keywords=\"old town, cobblestone streets, twilight, foggy, mysterious lights\"/>\n<music keywords=\"mysterious, whimsical, soft piano, strings, 19th century\"/>\n</scene>\n<dialogue>\n<narration>\nIn the heart of the old town, where the cobblestone streets whisper tales of the past, a young boy named Eli stumbles upon a shop that seems to have appeared out of nowhere. The sign above the door reads \"The Enchanted Emporium,\" and a faint glow emanates from within, casting eerie shadows on the foggy street.\n</narration>\n<character name=\"Eli\" identifier=\"14 years old, male, brown hair, green eyes, average build\" emotion=\"curious\" clothes=\"jeans, t-shirt\">\nWow, I've never seen this shop before. It looks like something out of a fairy tale.\n</character>\n<narration>\nEli pushes open the creaky door and steps inside. The shop is filled with an array of peculiar items: crystal balls, ancient books, and jars filled with strange powders and liquids. A bell above the door jingles, announcing his arrival.\n</narration>\n<character name=\"Mr. Harrow\" identifier=\"60 years old, male, white hair, piercing blue eyes, tall, thin\" emotion=\"welcoming\" clothes=\"tailored suit, top hat\">\nAh, welcome, young one. I've been expecting you.\n</character>\n<character name=\"Eli\" emotion=\"surprised\">\nExpecting me? I just stumbled upon this place by accident.\n</character>\n<character name=\"Mr. Harrow\" emotion=\"enigmatic\">\nPerhaps, or perhaps not. The universe has a way of guiding us to where we need to be.\n</character>\n<narration>\nEli looks around, his eyes wide with wonder. The air in the shop feels charged, as if magic is a tangible presence.\n</narration>\n<character name=\"Eli\" emotion=\"excited\">\nIs this place really... magical?\n</character>\n<character name=\"Mr. Harrow\" emotion=\"smiling\">\nIndeed, it is. And I sense a spark within you, Eli. A potential for great magic.\n</character>\n<character name=\"Eli\" emotion=\"eager\">\nCan you teach me? I've always dreamed of doing magic!\n</character>\n<character name=\"Mr. Harrow\" emotion=\"serious\">\nLearning magic is no small task. It requires dedication, courage, and a strong heart. Are you prepared for the challenges ahead?\n</character>\n<character name=\"Eli\" emotion=\"determined\">\nI am. I want to learn, no matter what it takes.\n</character>\n<character name=\"Mr. Harrow\" emotion=\"approving\">\nVery well. From this day forth, you shall be my apprentice. Together, we will protect this shop and its secrets from those who seek to misuse them.\n</character>\n<narration>\nAs Eli accepts the offer, the atmosphere in the shop shifts, as if acknowledging the new bond between master and apprentice.\n</narration>\n</dialogue>\n<scene>\n<background keywords=\"magic shop, shelves filled with curiosities, dim lighting, magical aura\"/>\n<music keywords=\"enchanting, mysterious, harp, flute, ethereal\"/>\n</scene>\n<dialogue>\n<narration>\nDays turn into weeks, and Eli begins his training under Mr. Harrow's tutelage. Each day brings new lessons and challenges, from understanding ancient spells to mastering the art of potion-making.\n</narration>\n<character name=\"Eli\" identifier=\"growing confidence, more adept at magic\" emotion=\"focused\" clothes=\"apprentice robe\">\nMr. Harrow, I think I've almost got the hang of this levitation spell.\n</character>\n<character name=\"Mr. Harrow\" emotion=\"encouraging\">\nExcellent, Eli. Remember, the key is concentration and belief in your own abilities.\n</character>\n<narration>\nAs Eli practices, a sudden chill fills the air, and the lights flicker ominously.\n</narration>\n<character name=\"Mr. Harrow\" emotion=\"alert\">\nSomething is amiss. Be on your guard, Eli.\n</character>\n<narration>\nA shadowy figure appears at the window, its eyes glowing red. It seems to be drawn to the magical energies within the shop.\n</narration>\n<character name=\"Eli\" emotion=\"fearful\">\nWhat is that thing?\n</character>\n<character name=\"Mr. Harrow\" emotion=\"resolute\">\nA dark entity, likely drawn by the magic. We must protect the shop.\n</character>\n<character name=\"Eli\" emotion=\"determined\">\nWhat should we do?\n</character>\n<character name=\"Mr. Harrow\" emotion=\"calm\">\nFirst, we fortify the defenses. Then, we prepare to confront it.\n</character>\n<narration>\nTogether, they work quickly, setting up protective wards and gathering magical artifacts. The air crackles with energy as they prepare for the confrontation.\n</narration>\n</dialogue>\n<options>\n<title>What should Eli do next?</title>\n<option>Confront the dark entity directly</option>\n<option>Set a magical trap</option>\n<option>Seek help from other magical beings</option>\n<option>Evacuate the shop and regroup</option>\n</options>\n<action>Set a magical trap</action>\n<!-- Continue with new scene, dialogue, options, and action based on the chosen action -->\n</vnml>\n```", "```vnml\n<vnml lang=\"en\">\n<action>Set a magical trap</action>\n<scene>\n<background keywords=\"magic shop, wards activated, tense atmosphere, magical traps set\"/>\n<music keywords=\"tense, suspenseful, low strings, eerie\"/>\n</scene>\n<dialogue>\n<narration>\nEli and Mr. Harrow work diligently to set a complex magical trap, designed to ensnare the dark entity without causing harm to the shop or themselves. The air is thick with anticipation and the charged energy of their preparations.\n</narration>\n<character name=\"Eli\" identifier=\"focused, determined\" emotion=\"nervous\" clothes=\"apprentice robe\">\nAre you sure this will work, Mr. Harrow?\n</character>\n<character name=\"Mr. Harrow\" emotion=\"confident\">\nTrust in the magic, Eli. It has never failed us before.\n</character>\n<narration>\nAs they finish setting the trap, the shadowy figure outside grows more restless, its red eyes flickering with impatience. It begins to cast dark spells towards the shop, trying to break through the protective wards.\n</narration>\n<character name=\"Eli\" emotion=\"alert\">\nIt's starting to attack the wards!\n</character>\n<character name=\"Mr. Harrow\" emotion=\"resolute\">\nHold steady. The trap will activate once it breaches the wards.\n</character>\n<narration>\nThe wards shimmer and crackle under the assault, but they hold firm. The dark entity, frustrated, intensifies its efforts, and finally, a ward shatters.\n</narration>\n<character name=\"Eli\" emotion=\"fearful\">\nIt's in!\n</character>\n<character name=\"Mr. Harrow\" emotion=\"calm\">\nNow, Eli! Activate the trap!\n</character>\n<narration>\nWith a swift motion, Eli triggers the magical trap. A web of shimmering light envelops the dark entity, binding it tightly. The entity struggles, but the more it fights, the tighter the magical bonds become.\n</narration>\n<character name=\"Eli\" emotion=\"relieved\">\nWe did it! It's trapped!\n</character>\n<character name=\"Mr. Harrow\" emotion=\"satisfied\">\nIndeed, we did. But we must not let our guard down. This entity may have allies.\n</character>\n<narration>\nThey secure the trapped entity, discussing their next steps. The shop, once again, returns to a semblance of peace, though the air still hums with residual magic.\n</narration>\n</dialogue>\n<options>\n<title>What should they do with the trapped entity?</title>\n<option>Interrogate the entity to learn its motives</option>\n<option>Contact the magical council for assistance</option>\n<option>Banish the entity to another realm</option>\n<option>Study the entity to understand its powers</option>\n</options>\n<action>Interrogate the entity to learn its motives</action>\n<!-- Continue with new scene, dialogue, options, and action based on the chosen action -->\n</vnml>\n```"]
 
+START = "<action>Start!</action>"
+
+
+async def turn_prompt(history: HistoryBuffer, lang: str = 'en', session: str = '',
+                      priority: Priority = Priority.INTERACTIVE) -> tuple[str, str]:
+    """The cue that the turn after `history` starts with, and the prompt that ends with it."""
+    last = tag_of(history.vnml_at(-1))
+    if last == "action":
+        cue = CONTINUE
+    elif last in ("narration", "character") and turn_lines(history) >= MAX_LENGTH["dialogue"]:
+        cue = WRAP_UP  # enough dialogue, on to the options
+    else:
+        cue = ''  # a turn that was cut short, e.g. a speculative branch, is picked up where it stopped
+    return cue, await build_prompt(history, lang, session=session, cue=cue, priority=priority)
+
+
+def turn_lines(history: HistoryBuffer) -> int:
+    """The narration and character lines of the turn that `history` ends with."""
+    lines = 0
+    for index in range(len(history) - 1, -1, -1):
+        tag = tag_of(history.vnml_at(index))
+        if tag == "action":
+            break
+        lines += tag in ("narration", "character")
+    return lines
+
+
+def completion_params(slot: int, after: str) -> dict:
+    """llama.cpp `/completion` parameters of a turn going on from `after`, see `vnml.grammar.resume_point`."""
+    params = dict(n_predict=N_PREDICT, stop=["</options>"], id_slot=slot, cache_prompt=True)
+    if GRAMMAR and (grammar := gbnf(after)):
+        params["grammar"] = grammar
+    return params
+
+
+async def continue_vnml(history: HistoryBuffer, lang: str = 'en', session: str = '',
+                        metrics: CompletionMetrics | None = None,
+                        priority: Priority = Priority.INTERACTIVE) -> AsyncIterator[str]:
+    """The raw VNML that continues `history`, as the model writes it."""
+    if len(history) == 0:
+        # The caller records this before asking for more, so the prompt below includes it.
+        yield START
+    cue, prompt = await turn_prompt(history, lang, session, priority)
+    after = resume_point(history.vnml_at(-1), cue)
+    if cue:
+        yield cue  # recorded with the first fragment, exactly as the model saw it
+    tokens = scheduler.stream(lambda slot: stream_completion(prompt, metrics, **completion_params(slot, after)),
+                              priority, session, key=prompt)
+    async with contextlib.aclosing(tokens) as tokens:
+        async for token in tokens:
+            yield token
+
+
+def turn_over(history: HistoryBuffer) -> bool:
+    return len(history) > 0 and tag_of(history.vnml_at(-1)) == "options"
+
+
+def new_sprite_sheets(diff: dict) -> list[list[str]]:
+    """The sprite sheets of the characters that `diff` first shows in a look, i.e. an identifier and clothes."""
+    looks = diff["do_log"].get("characters")
+    if not looks:
+        return []
+    before = diff["undo_log"].get("characters") or {}
+    return [
+        sprite_sheet(look["identifier"], look["clothes"]) for name, look in looks.items()
+        if before.get(name) is None or (look["identifier"], look["clothes"]) != (before[name]["identifier"],
+                                                                                 before[name]["clothes"])
+    ]
 
-def dialogue_url(text, seed=SEED):
-    return f"{BASE_URL}speech/{quote(text)}?seed={seed}"
 
-@dataclass
-class Diff:
-    do_log: dict
-    undo_log: dict
-    vnml: str
+def action_diff(snapshot: GameSnapshot, option: str) -> Diff:
+    return calculate_diff(
+        snapshot,
+        {"dialogue": f"Option {option} selected", "option_title": None, "options": []},
+        f"<action>{option}</action>",
+        '\n'
+    )
 
 
-llm = LlamaCpp(chat_format=ChatFormat.Llama3)
+async def generate_diffs(history: HistoryBuffer, snapshot: GameSnapshot, lang: str = 'en', session: str = '',
+                         metrics: CompletionMetrics | None = None,
+                         priority: Priority = Priority.INTERACTIVE) -> AsyncIterator[Diff]:
+    """Continue `history` from `snapshot`, its state at the end; the caller records every diff.
 
-outputs = ["```vnml\n<vnml lang=\"en\">\n<action>Start!</action>\n<scene>\n<background keywords=\"old town, cobblestone streets, twilight, foggy, mysterious lights\"/>\n<music keywords=\"mysterious, whimsical, soft piano, strings, 19th century\"/>\n</scene>\n<dialogue>\n<narration>\nIn the heart of the old town, where the cobblestone streets whisper tales of the past, a young boy named Eli stumbles upon a shop that seems to have appeared out of nowhere. The sign above the door reads \"The Enchanted Emporium,\" and a faint glow emanates from within, casting eerie shadows on the foggy street.\n</narration>\n<character name=\"Eli\" identifier=\"14 years old, male, brown hair, green eyes, average build\" emotion=\"curious\" clothes=\"jeans, t-shirt\">\nWow, I've never seen this shop before. It looks like something out of a fairy tale.\n</character>\n<narration>\nEli pushes open the creaky door and steps inside. The shop is filled with an array of peculiar items: crystal balls, ancient books, and jars filled with strange powders and liquids. A bell above the door jingles, announcing his arrival.\n</narration>\n<character name=\"Mr. Harrow\" identifier=\"60 years old, male, white hair, piercing blue eyes, tall, thin\" emotion=\"welcoming\" clothes=\"tailored suit, top hat\">\nAh, welcome, young one. I've been expecting you.\n</character>\n<character name=\"Eli\" emotion=\"surprised\">\nExpecting me? I just stumbled upon this place by accident.\n</character>\n<character name=\"Mr. Harrow\" emotion=\"enigmatic\">\nPerhaps, or perhaps not. The universe has a way of guiding us to where we need to be.\n</character>\n<narration>\nEli looks around, his eyes wide with wonder. The air in the shop feels charged, as if magic is a tangible presence.\n</narration>\n<character name=\"Eli\" emotion=\"excited\">\nIs this place really... magical?\n</character>\n<character name=\"Mr. Harrow\" emotion=\"smiling\">\nIndeed, it is. And I sense a spark within you, Eli. A potential for great magic.\n</character>\n<character name=\"Eli\" emotion=\"eager\">\nCan you teach me? I've always dreamed of doing magic!\n</character>\n<character name=\"Mr. Harrow\" emotion=\"serious\">\nLearning magic is no small task. It requires dedication, courage, and a strong heart. Are you prepared for the challenges ahead?\n</character>\n<character name=\"Eli\" emotion=\"determined\">\nI am. I want to learn, no matter what it takes.\n</character>\n<character name=\"Mr. Harrow\" emotion=\"approving\">\nVery well. From this day forth, you shall be my apprentice. Together, we will protect this shop and its secrets from those who seek to misuse them.\n</character>\n<narration>\nAs Eli accepts the offer, the atmosphere in the shop shifts, as if acknowledging the new bond between master and apprentice.\n</narration>\n</dialogue>\n<scene>\n<background keywords=\"magic shop, shelves filled with curiosities, dim lighting, magical aura\"/>\n<music keywords=\"enchanting, mysterious, harp, flute, ethereal\"/>\n</scene>\n<dialogue>\n<narration>\nDays turn into weeks, and Eli begins his training under Mr. Harrow's tutelage. Each day brings new lessons and challenges, from understanding ancient spells to mastering the art of potion-making.\n</narration>\n<character name=\"Eli\" identifier=\"growing confidence, more adept at magic\" emotion=\"focused\" clothes=\"apprentice robe\">\nMr. Harrow, I think I've almost got the hang of this levitation spell.\n</character>\n<character name=\"Mr. Harrow\" emotion=\"encouraging\">\nExcellent, Eli. Remember, the key is concentration and belief in your own abilities.\n</character>\n<narration>\nAs Eli practices, a sudden chill fills the air, and the lights flicker ominously.\n</narration>\n<character name=\"Mr. Harrow\" emotion=\"alert\">\nSomething is amiss. Be on your guard, Eli.\n</character>\n<narration>\nA shadowy figure appears at the window, its eyes glowing red. It seems to be drawn to the magical energies within the shop.\n</narration>\n<character name=\"Eli\" emotion=\"fearful\">\nWhat is that thing?\n</character>\n<character name=\"Mr. Harrow\" emotion=\"resolute\">\nA dark entity, likely drawn by the magic. We must protect the shop.\n</character>\n<character name=\"Eli\" emotion=\"determined\">\nWhat should we do?\n</character>\n<character name=\"Mr. Harrow\" emotion=\"calm\">\nFirst, we fortify the defenses. Then, we prepare to confront it.\n</character>\n<narration>\nTogether, they work quickly, setting up protective wards and gathering magical artifacts. The air crackles with energy as they prepare for the confrontation.\n</narration>\n</dialogue>\n<options>\n<title>What should Eli do next?</title>\n<option>Confront the dark entity directly</option>\n<option>Set a magical trap</option>\n<option>Seek help from other magical beings</option>\n<option>Evacuate the shop and regroup</option>\n</options>\n<action>Set a magical trap</action>\n<!-- Continue with new scene, dialogue, options, and action based on the chosen action -->\n</vnml>\n```", "```vnml\n<vnml lang=\"en\">\n<action>Set a magical trap</action>\n<scene>\n<background keywords=\"magic shop, wards activated, tense atmosphere, magical traps set\"/>\n<music keywords=\"tense, suspenseful, low strings, eerie\"/>\n</scene>\n<dialogue>\n<narration>\nEli and Mr. Harrow work diligently to set a complex magical trap, designed to ensnare the dark entity without causing harm to the shop or themselves. The air is thick with anticipation and the charged energy of their preparations.\n</narration>\n<character name=\"Eli\" identifier=\"focused, determined\" emotion=\"nervous\" clothes=\"apprentice robe\">\nAre you sure this will work, Mr. Harrow?\n</character>\n<character name=\"Mr. Harrow\" emotion=\"confident\">\nTrust in the magic, Eli. It has never failed us before.\n</character>\n<narration>\nAs they finish setting the trap, the shadowy figure outside grows more restless, its red eyes flickering with impatience. It begins to cast dark spells towards the shop, trying to break through the protective wards.\n</narration>\n<character name=\"Eli\" emotion=\"alert\">\nIt's starting to attack the wards!\n</character>\n<character name=\"Mr. Harrow\" emotion=\"resolute\">\nHold steady. The trap will activate once it breaches the wards.\n</character>\n<narration>\nThe wards shimmer and crackle under the assault, but they hold firm. The dark entity, frustrated, intensifies its efforts, and finally, a ward shatters.\n</narration>\n<character name=\"Eli\" emotion=\"fearful\">\nIt's in!\n</character>\n<character name=\"Mr. Harrow\" emotion=\"calm\">\nNow, Eli! Activate the trap!\n</character>\n<narration>\nWith a swift motion, Eli triggers the magical trap. A web of shimmering light envelops the dark entity, binding it tightly. The entity struggles, but the more it fights, the tighter the magical bonds become.\n</narration>\n<character name=\"Eli\" emotion=\"relieved\">\nWe did it! It's trapped!\n</character>\n<character name=\"Mr. Harrow\" emotion=\"satisfied\">\nIndeed, we did. But we must not let our guard down. This entity may have allies.\n</character>\n<narration>\nThey secure the trapped entity, discussing their next steps. The shop, once again, returns to a semblance of peace, though the air still hums with residual magic.\n</narration>\n</dialogue>\n<options>\n<title>What should they do with the trapped entity?</title>\n<option>Interrogate the entity to learn its motives</option>\n<option>Contact the magical council for assistance</option>\n<option>Banish the entity to another realm</option>\n<option>Study the entity to understand its powers</option>\n</options>\n<action>Interrogate the entity to learn its motives</action>\n<!-- Continue with new scene, dialogue, options, and action based on the chosen action -->\n</vnml>\n```"]
+    `snapshot` is advanced in place past every diff yielded. The turn is
+    generated on the generation workers, or if there are none, compiled on the
+    event loop whenever a chunk may complete a fragment. Either way it
+    waits for a llama.cpp slot from the scheduler, at `priority`.
 
-def stream_vnml_parser(vnml: Iterator[str]) -> Iterator[str]:
-    buffer = ''
-    for chr in vnml:
-        ...
-
-def continue_vnml(vnml: str, ) -> Iterator[str]:
-    if vnml == '':
-        yield "<action>Start!</action>"
-    yield "<scene>\n<background keywords=\"old town, cobblestone streets, twilight, foggy, mysterious lights\"/>\n<music keywords=\"mysterious, whimsical, soft piano, strings, 19th century\"/>\n</scene>"
-    yield "<narration>\nIn the heart of the old town, where the cobblestone streets whisper tales of the past, a young boy named Eli stumbles upon a shop that seems to have appeared out of nowhere. The sign above the door reads \"The Enchanted Emporium,\" and a faint glow emanates from within, casting eerie shadows on the foggy street.\n</narration>"
-    yield "<character name=\"Eli\" identifier=\"14 years old, male, brown hair, green eyes, average build\" emotion=\"curious\" clothes=\"jeans, t-shirt\">\nWow, I've never seen this shop before. It looks like something out of a fairy tale.\n</character>"
-    yield '''<narration>
-Eli pushes open the creaky door and steps inside. The shop is filled with an array of peculiar items: crystal balls, ancient books, and jars filled with strange powders and liquids. A bell above the door jingles, announcing his arrival.
-</narration>'''
-    yield '''<character name="Mr. Harrow" identifier="60 years old, male, white hair, piercing blue eyes, tall, thin" emotion="welcoming" clothes="tailored suit, top hat">
-Ah, welcome, young one. I've been expecting you.
-</character>'''
-    # yield
-
-
-    #     prompt = f'''```vnml
-    # <vnml lang="{DisplayState.lang}">
-    # {vnml}
-    # <!-- Continue with new scene, dialogue, options, and action based on the chosen action -->
-    # <scene>
-    # '''
-    #     result = llm.invoke(prompt, n_predict=50)
-    #     yield result
-    yield f"<scene><background keywords='magic shop, wards activated, tense atmosphere, magical traps set'/><music keywords='futuristic, electronic, fast-paced, synth, digital sounds, 21st century'/></scene>"
-    yield f"<character name='Aria' identifier='magic girl' emotion='happy'>欢迎来到魔法的世界，在这里有新奇的冒险等待着你</character>"
-    yield "<options><title>hello</title><option>h1</option><option>h2</option></options>"
-
-
-
-def vnml2log(vnml: str) -> dict:
-    do_log = {
-        "character_url": None,
-        "character_name": None,
-        "dialogue": None,
-        "dialogue_url": None,
-        "option_title": None,
-        "options": []
-    }
-    if vnml.startswith("<scene"):
-        soup = BeautifulSoup(vnml, 'lxml')
-        background_keywords = soup.find("background")['keywords']
-        music_keywords = soup.find("music")['keywords']
-        do_log.update(
-            {"background_url": background_url(background_keywords, 1600, 960),
-             "music_url": music_url(music_keywords), "option_title": None,
-             "options": []})
-        return do_log
-    elif vnml.startswith("<character"):
-        soup = BeautifulSoup(vnml, 'lxml')
-        character_name = soup.find("character")['name']
-        character_identifier = soup.find("character").get("identifier")
-        if not character_identifier:
-            character_identifier = DisplayState._characters[character_name]["identifier"]
-        character_emotion = soup.find("character").get("emotion")
-        if not character_emotion:
-            character_emotion = DisplayState._characters[character_name]["emotion"]
-        text = soup.find("character").text.strip()
-        do_log.update({
-            "character_url": character_url(character_identifier, character_emotion, ),
-            "character_name": character_name,
-            "dialogue": text,
-            "dialogue_url": dialogue_url(text)
-        })
-        DisplayState._characters["character_name"] = {
-            "identifier": character_identifier,
-            "emotion": character_emotion
-        }
-        return do_log
-    elif vnml.startswith("<narration"):
-        soup = BeautifulSoup(vnml, 'lxml')
-        text = soup.find("narration").text.strip()
-        do_log.update({"dialogue": text, "dialogue_url": dialogue_url(text)})
-        return do_log
-    elif vnml.startswith("<options"):
-        soup = BeautifulSoup(vnml, 'lxml')
-        option_title = soup.find("title").text.strip()
-        options = [i.text.strip() for i in soup.find_all("option")]
-        do_log.update({"option_title": option_title, "options": options})
-        return do_log
-    return {"dialogue": vnml, "option_title": None, "options": []}
-
-
-@dataclass
-class GameSnapshot:
-    background_url: str
-    music_url: str
-    character_url: str
-    character_name: str
-    dialogue: str
-    dialogue_url: str
-    option_title: str
-    options: list[str]
-    characters: dict[str, dict] = Field(default_factory=dict)  # {"name": {"identifier": "value"}}
-
-    def __add__(self, diff: Diff):
-        state = self.__dict__.copy()
-        for key, value in diff.do_log.items():
-            state[key] = value
-        return GameSnapshot(**state)
-
-    def __sub__(self, diff: Diff):
-        state = self.__dict__.copy()
-        for key, value in diff.undo_log.items():
-            state[key] = value
-        return GameSnapshot(**state)
-
-
-def calculate_diff(snapshot: GameSnapshot, do_log: dict, vnml: str) -> Diff:
-    undo_log = {}
-    for key, value in do_log.items():
-        if value != snapshot.__dict__[key]:
-            undo_log[key] = snapshot.__dict__[key]
-    return Diff(do_log, undo_log, vnml)
+    A completion cut short at a cap in `MAX_LENGTH` stops paying for tokens
+    there, and the turn goes on in the next one: with more lines, or once the
+    dialogue reached its cap, with the options.
+    """
+    metrics = metrics if metrics is not None else CompletionMetrics()
+    if len(history) == 0:
+        for diff in TurnCompiler(snapshot).feed(START).diffs:
+            yield diff
+    lines = turn_lines(history)
+    while True:
+        metrics.cut = ""
+        done = False
+        async with contextlib.aclosing(_completion(history, snapshot, lang, session, metrics, priority)) as diffs:
+            async for diff in diffs:
+                yield diff
+                done = tag_of(diff.vnml) == "options"
+                if tag_of(diff.vnml) in ("narration", "character"):
+                    lines += 1
+                    if lines >= MAX_LENGTH["dialogue"]:
+                        metrics.cut = "dialogue"
+                        break
+        if done or not metrics.cut:
+            return
+
+
+async def _completion(history: HistoryBuffer, snapshot: GameSnapshot, lang: str, session: str,
+                      metrics: CompletionMetrics, priority: Priority) -> AsyncIterator[Diff]:
+    """The diffs of one completion that continues `history`; see `generate_diffs`."""
+    if generation.GENERATION_WORKERS:
+        cue, prompt = await turn_prompt(history, lang, session, priority)
+        after = resume_point(history.vnml_at(-1), cue)
+        turn = scheduler.stream(
+            lambda slot: generation.pool().generate(slot, prompt, cue, snapshot, metrics,
+                                                    **completion_params(slot, after)),
+            priority, session, key=(prompt, repr(snapshot)))
+        async with contextlib.aclosing(turn) as diffs:  # giving up the turn frees its slot now
+            async for diff in diffs:
+                snapshot += diff
+                yield diff
+        return
+    compiler = TurnCompiler(snapshot)
+    pending = ""
+    async with contextlib.aclosing(continue_vnml(history, lang, session, metrics, priority)) as texts:
+        async for text in texts:
+            pending += text
+            if ">" not in text and len(pending) < FEED_CHARS:  # every fragment ends with one
+                continue
+            turn = compiler.feed(pending)  # a few fragments at most: cheaper on the loop than on a thread
+            pending = ""
+            for diff in turn.diffs:
+                yield diff
+            metrics.cut = turn.cut
+            if turn.done or turn.cut:  # the turn is over or goes on in another completion, stop paying for tokens
+                return
+
+
+def speculate_branches(session: str, history: HistoryBuffer, snapshot: GameSnapshot, lang: str):
+    """Generate the opening of every option of the turn that `history` ends with."""
+    options = history[-1]["do_log"].get("options") or []
+
+    def branch(option: str):
+        fork = history.fork()
+        action = action_diff(snapshot, option)
+        fork.append(action.__dict__)
+        start = snapshot + action
+
+        async def generate(slot: str):
+            async for diff in generate_diffs(fork, start, lang, slot, priority=Priority.SPECULATIVE):
+                fork.append(diff.__dict__)
+                yield diff.__dict__
+        return generate
+
+    branches.speculate(session, (len(history), history.vnml_at(-1)), {option: branch(option) for option in options})
 
 
 class DisplayState(rx.State):
     background_url: str | None = None  #
+    background_preview_url: str | None = None
     music_url: str | None = None
+    music_intro_url: str | None = None
     character_url: str | None = None
+    character_preview_url: str | None = None
     character_name: str | None = None
     dialogue: str | None = None  # "Hello, world!"
-    dialogue_url: str | None = None
+    dialogue_url: list[str] | None = None  # a URL per sentence
     option_title: str | None
     options: list[str] = []
-    diff_history: list[dict] = [
-    ]
     diff_pointer: int = -1
     lang: str = 'en'
-    _characters: dict[str, dict] = {}
+    generating: bool = False
+    cached_tokens: int = 0  # prompt tokens of the last turn llama.cpp took from its KV cache
+    evaluated_tokens: int = 0  # prompt tokens of the last turn it had to evaluate
+    history_length: int = 0
+    show_backlog: bool = False
+    backlog: list[dict[str, str]] = []
+    show_slots: bool = False
+    slot_name: str = ""
+    saved_slots: list[dict[str, str]] = []
+    _advance_requested: bool = False
+    # Bumped whenever the player leaves the turn being generated, e.g. to pick
+    # another option: diffs of a generation started before are dropped.
+    _epoch: int = 0
+    _generation: int = -1  # the epoch of the running generation
 
     @rx.var
     def last_button_disabled(self) -> bool:
         return self.diff_pointer <= 0
 
+    @rx.var
+    def background_image(self) -> str:
+        # CSS draws the first layer on top: the preview shows through until the full image loads.
+        return ", ".join(f"url('{url}')" for url in (self.background_url, self.background_preview_url) if url)
+
 
-    def export_snapshot(self) -> GameSnapshot:
+    def export_snapshot(self, history: HistoryBuffer) -> GameSnapshot:
+        # The character table is versioned with the history: take the one of the line shown.
+        state = history.state_at(self.diff_pointer) if self.diff_pointer >= 0 else {}
         return GameSnapshot(
             background_url=self.background_url,
+            background_preview_url=self.background_preview_url,
             music_url=self.music_url,
+            music_intro_url=self.music_intro_url,
             character_url=self.character_url,
+            character_preview_url=self.character_preview_url,
             character_name=self.character_name,
             dialogue=self.dialogue,
             dialogue_url=self.dialogue_url,
             option_title=self.option_title,
-            options=self.options,
-            characters=self._characters
-        )
-
-    def import_snapshot(self, snapshot: GameSnapshot):
-        self.background_url = snapshot.background_url
-        self.music_url = snapshot.music_url
-        self.character_url = snapshot.character_url
-        self.character_name = snapshot.character_name
-        self.dialogue = snapshot.dialogue
-        self.dialogue_url = snapshot.dialogue_url
-        self.option_title = snapshot.option_title
-        self.options = snapshot.options
-
-    def select_option(self, option: str):
-        self.diff_history = self.diff_history[:self.diff_pointer]  # clear the future
-        self.diff_history.append(
-            {"do_log": {"dialogue": f"Option {option} selected", "option_title": None, "options": []},
-             "undo_log": {"dialogue": None, "option_title": self.option_title, "options": self.options},
-             "vnml": f"<action>{option}</action>"}
+            options=list(self.options),
+            characters=state.get("characters", {}),
         )
-        self.forward()
 
-
-    def forward(self):
-        if len(self.diff_history) <= self.diff_pointer + 1:
-            history_vnml = ''.join([i['vnml'] for i in self.diff_history[:self.diff_pointer]])
-            snapshot = self.export_snapshot()
-            for vnml in continue_vnml(history_vnml):
-                do_log = vnml2log(vnml)
-                diff = calculate_diff(snapshot, do_log, vnml)
-                self.diff_history.append(diff.__dict__)
-                snapshot += diff
-        diff = self.diff_history[self.diff_pointer + 1]
-        self.import_snapshot(self.export_snapshot() + Diff(**diff))
+    def _apply(self, changes: dict):
+        # Only the vars set here are marked dirty, so only they are sent to the browser.
+        for key, value in changes.items():
+            if key in DISPLAY_DEFAULTS:
+                setattr(self, key, value)
+
+    async def _history(self, index: int | None = None) -> HistoryBuffer:
+        """The history of the session, reading what is not in memory from the store in a thread.
+
+        Args:
+            index: The oldest diff about to be read: the pages of a resumed
+                history down to it are read too, see `HistoryBuffer.load`.
+        """
+        token = self.router.session.client_token
+        if has_history(token):
+            history = get_history(token)
+        else:
+            loaded = await asyncio.to_thread(store.open, token)
+            history = get_history(token, lambda _: loaded)
+        if index is not None:
+            await history.load(index)
+        return history
+
+    def _remember(self):
+        store.save_position(self.router.session.client_token, self.diff_pointer, self.lang)
+
+    async def resume(self):
+        """Pick a stored story up where it was left, e.g. after the backend restarted."""
+        if self.history_length:
+            return
+        history = await self._history()
+        if len(history):
+            position = await asyncio.to_thread(store.position, self.router.session.client_token)
+            self.lang = position.get("lang", self.lang)
+            await self.seek(position.get("pointer", len(history) - 1))
+
+    def _leave_turn(self):
+        """Stop generating the turn the player left, so that its diffs are not recorded."""
+        self._epoch += 1
+        # Only the turn: speculative branches may be the one the player picks.
+        scheduler.cancel(self.router.session.client_token, branches=False)
+
+    async def select_option(self, option: str):
+        history = await self._history(self.diff_pointer)
+        self._leave_turn()
+        history.truncate(self.diff_pointer + 1)  # clear the future
+        if self.diff_pointer >= 0:
+            # A speculative branch for this option is picked up by `forward` instead of a new turn.
+            branches.choose(self.router.session.client_token,
+                            (self.diff_pointer + 1, history.vnml_at(self.diff_pointer)), option)
+        history.append(action_diff(self.export_snapshot(history), option).__dict__)
+        self.history_length = len(history)
+        self._step_forward(history)
+        return DisplayState.forward
+
+    def _step_forward(self, history: HistoryBuffer):
+        self._apply(history.changes(self.diff_pointer + 1))
         self.diff_pointer += 1
-        if diff["do_log"].get("background_url"):  # new scene, automatically continue
-            self.forward()
-
-    def backward(self):
-        print(self.export_snapshot())
-        diff = self.diff_history[self.diff_pointer]
-        self.import_snapshot(self.export_snapshot() - Diff(**diff))
+        self._remember()
+        prefetcher.warm(history, self.diff_pointer)
+        if history.is_scene(self.diff_pointer):  # new scene, automatically continue
+            if len(history) > self.diff_pointer + 1:
+                self._step_forward(history)
+            else:
+                self._advance_requested = True
+
+    @rx.background
+    async def forward(self):
+        history = await self._history()
+        async with self:
+            if len(history) > self.diff_pointer + 1:
+                self._step_forward(history)
+                return
+            self._advance_requested = True
+            if self.generating and self._generation == self._epoch:
+                return  # the running generation will advance once the next line arrives
+            self.generating = True
+            self._generation = epoch = self._epoch
+            snapshot = self.export_snapshot(history)
+            lang = self.lang
+            session = self.router.session.client_token
+        metrics = CompletionMetrics()
+        try:
+            branch = branches.adopted(session)
+            if branch is not None:
+                async for diff in branch.follow():
+                    snapshot.apply(diff["do_log"])
+                    await self._record(history, diff, epoch)
+            if not turn_over(history):
+                async for diff in generate_diffs(history, snapshot, lang, session, metrics):
+                    await self._record(history, diff.__dict__, epoch)
+            async with self:
+                if self._epoch != epoch:  # cancelled, the diffs just stopped
+                    raise Cancelled(session)
+            if SPECULATE and turn_over(history):
+                speculate_branches(session, history, snapshot, lang)
+        except Cancelled:
+            pass  # the player moved on or left, see `Scheduler.cancel`
+        finally:
+            async with self:
+                if self._generation == epoch:
+                    self.generating = False
+                    self.cached_tokens = metrics.cached_tokens
+                    self.evaluated_tokens = metrics.evaluated_tokens
+
+    async def _record(self, history: HistoryBuffer, diff: dict, epoch: int):
+        """Append a diff generated in `epoch`.
+
+        Raises:
+            Cancelled: If the player left that turn meanwhile.
+        """
+        async with self:
+            if self._epoch != epoch:
+                raise Cancelled(self.router.session.client_token)
+            history.append(diff)
+            self.history_length = len(history)
+            prefetcher.warm(history, self.diff_pointer)
+            for sheet in new_sprite_sheets(diff):
+                prefetcher.render_sheet(sheet)
+            if self._advance_requested:
+                self._advance_requested = False
+                self._step_forward(history)
+
+    async def backward(self):
+        history = await self._history(self.diff_pointer)
+        self._apply(history.changes(self.diff_pointer, undo=True))
         self.diff_pointer -= 1
+        self._remember()
+
+    async def seek(self, index: int):
+        """Show the state right after diff `index`, e.g. a backlog line or a save.
+
+        Restores the nearest keyframe of the history and replays the few diffs
+        after it, instead of stepping through every diff in between.
+        """
+        history = await self._history()
+        index = max(-1, min(int(index), len(history) - 1))
+        if index < len(history) - 1:
+            self._leave_turn()
+        await history.load(index + 1)  # the diffs `state_at` replays
+        state = history.state_at(index)
+        self._apply({
+            key: value for key, default in DISPLAY_DEFAULTS.items()
+            if (value := state.get(key, default)) != getattr(self, key)
+        })
+        self.diff_pointer = index
+        self.history_length = len(history)
+        self._advance_requested = False
+        self.show_backlog = False
+        self._remember()
+        prefetcher.warm(history, index)
+
+    async def scrub(self, value: list[int]):
+        await self.seek(value[0])
+
+    async def toggle_backlog(self):
+        """Open the backlog on the last `BACKLOG_LINES` lines up to the current one."""
+        self.show_backlog = not self.show_backlog
+        if not self.show_backlog:
+            return
+        start = max(0, self.diff_pointer + 1 - BACKLOG_LINES)
+        history = await self._history(start)
+        self.backlog = []
+        for index in range(start, self.diff_pointer + 1):
+            fragment = decode_fragment(history.vnml_at(index))
+            if fragment is not None and fragment.tag in ("narration", "character", "action"):
+                self.backlog.append({
+                    "index": str(index),
+                    "name": fragment.attrs.get("name", ""),
+                    "text": fragment.text.strip(),
+                })
+
+    async def toggle_slots(self):
+        self.show_slots = not self.show_slots
+        if self.show_slots:
+            await self._list_slots()
+
+    async def _list_slots(self):
+        slots = await asyncio.to_thread(store.slots, self.router.session.client_token)
+        self.saved_slots = [
+            {"name": name, "saved": meta["saved"], "line": str(meta["pointer"] + 1)}
+            for name, meta in sorted(slots.items(), key=lambda item: item[1]["saved"], reverse=True)
+        ]
+
+    async def save_slot(self):
+        """Save the story as it is now under `slot_name`, replacing a save of that name."""
+        name = self.slot_name.strip()
+        if not name:
+            return
+        history = await self._history()
+        store.save_slot(self.router.session.client_token, name, self.diff_pointer, len(history), self.lang)
+        self.slot_name = ""
+        await self._list_slots()
+
+    async def load_slot(self, name: str):
+        """Replace the story with the one saved as `name`, at the line it was saved on."""
+        session = self.router.session.client_token
+        branches.discard(session)
+        self._epoch += 1
+        scheduler.cancel(session)  # a turn still being generated belongs to the story replaced
+        position = await asyncio.to_thread(store.load_slot, session, name)
+        self.show_slots = False
+        self.lang = position.get("lang", self.lang)
+        await self.seek(position.get("pointer", -1))
 
 
 def display_options() -> rx.Component:
@@ -248,10 +467,74 @@ def display_options() -> rx.Component:
     )
 
 
+def display_backlog() -> rx.Component:
+    return rx.box(
+        rx.foreach(
+            DisplayState.backlog,
+            lambda line: rx.box(
+                rx.text(line["name"], style={"font-weight": "bold"}),
+                rx.text(line["text"]),
+                on_click=DisplayState.seek(line["index"]),
+                cursor="pointer",
+                padding="0.5em",
+            ),
+        ),
+        background_color="rgba(255, 255, 255, 0.9)",
+        overflow_y="auto",
+        position="absolute",
+        top="0",
+        left="0",
+        width="100%",
+        height="80%",
+        padding="1em",
+    )
+
+
+def display_slots() -> rx.Component:
+    return rx.box(
+        rx.hstack(
+            rx.input(value=DisplayState.slot_name, on_change=DisplayState.set_slot_name, placeholder="Save as"),
+            rx.button("Save", on_click=DisplayState.save_slot),
+        ),
+        rx.foreach(
+            DisplayState.saved_slots,
+            lambda slot: rx.box(
+                rx.text(slot["name"], style={"font-weight": "bold"}),
+                rx.text(slot["saved"], " - line ", slot["line"]),
+                on_click=DisplayState.load_slot(slot["name"]),
+                cursor="pointer",
+                padding="0.5em",
+            ),
+        ),
+        background_color="rgba(255, 255, 255, 0.9)",
+        overflow_y="auto",
+        position="absolute",
+        top="0",
+        left="0",
+        width="100%",
+        height="80%",
+        padding="1em",
+    )
+
+
+def display_scrubber() -> rx.Component:
+    return rx.slider(
+        default_value=DisplayState.diff_pointer,
+        key=DisplayState.diff_pointer,  # re-created at the new position after every step
+        min=0,
+        max=DisplayState.history_length - 1,
+        on_value_commit=DisplayState.scrub,
+        width="240px",
+    )
+
+
 def display_controller() -> rx.Component:
     return rx.box(
         rx.button("<-", on_click=DisplayState.backward, disabled=DisplayState.last_button_disabled),
         rx.button("->", on_click=DisplayState.forward),
+        rx.button("Log", on_click=DisplayState.toggle_backlog),
+        rx.button("Saves", on_click=DisplayState.toggle_slots),
+        rx.cond(DisplayState.history_length > 1, display_scrubber()),
         background_color="rgba(255, 0, 255, 0.7)",  # half opacity
         justify_content="center",  # center the text horizontally
         align_items="center",  # center the text vertically
@@ -280,25 +563,16 @@ def display_dialogue() -> rx.Component:
                 ),
         rx.cond(
             DisplayState.character_url,
-            rx.image(
-                DisplayState.character_url,
+            rx.box(
+                progressive_image(src=DisplayState.character_url, preview=DisplayState.character_preview_url),
                 position="absolute",
-                width="512px",
-                height="512px",
+                width=f"{SPRITE_SLOT}px",
+                height=f"{SPRITE_SLOT}px",
                 bottom="0",  # position it at the bottom
                 z_index="-1",  # ensure it's on bottom of the dialogue box
             )
         ),
-        rx.audio(
-            url=DisplayState.dialogue_url,
-            playing=True,
-            controls=False,
-            width="0",
-            height="0",
-            position="absolute",  # position it at the bottom left
-            bottom="0",  # position it at the bottom
-            left="0",  # position it at the left
-        ),
+        speech_queue(urls=DisplayState.dialogue_url),
         padding="1em",
         border_radius="1em",
         width="fit-content",
@@ -316,17 +590,7 @@ def display_audio() -> rx.Component:
     Returns:
         The audio player component.
     """
-    return rx.audio(
-        url=DisplayState.music_url,
-        playing=True,
-        loop=True,
-        controls=False,
-        height="0",
-        width="0",
-        position="absolute",  # position it at the bottom left
-        bottom="0",  # position it at the bottom
-        left="0",  # position it at the left
-    )
+    return music_player(src=DisplayState.music_url, intro=DisplayState.music_intro_url)
 
 def playground() -> rx.Component:
     """The dashboard page.
@@ -348,10 +612,18 @@ def playground() -> rx.Component:
             DisplayState.music_url,
             display_audio()
         ),
+        rx.cond(
+            DisplayState.show_backlog,
+            display_backlog()
+        ),
+        rx.cond(
+            DisplayState.show_slots,
+            display_slots()
+        ),
         display_controller(),
-        width="1280px",
-        height="720px",
-        background_image=f"url('{DisplayState.background_url}')",
+        width=f"{VIEWPORT[0]}px",
+        height=f"{VIEWPORT[1]}px",
+        background_image=DisplayState.background_image,
         background_size="cover",  # Ensures the background image covers the entire parent element
         background_position="center",  # Centers the background image within the parent element
         background_repeat="no-repeat",
@@ -1,10 +1,27 @@
 """Sidebar component for the app."""
 
+from functools import lru_cache
+
 from vnml import styles
 
 import reflex as rx
 
 
+@lru_cache(maxsize=1)
+def pages() -> tuple[tuple[str, str], ...]:
+    """The title and route of every page.
+
+    Called once every page is decorated, as they are compiled, so it is only
+    collected once rather than for the sidebar and menu of each page.
+    """
+    from reflex.page import get_decorated_pages
+
+    return tuple(
+        (page.get("title") or page["route"].strip("/").capitalize(), page["route"])
+        for page in get_decorated_pages()
+    )
+
+
 def sidebar_header() -> rx.Component:
     """Sidebar header.
 
@@ -109,20 +126,11 @@ def sidebar() -> rx.Component:
     Returns:
         The sidebar component.
     """
-    # Get all the decorated pages and add them to the sidebar.
-    from reflex.page import get_decorated_pages
-
     return rx.box(
         rx.vstack(
             sidebar_header(),
             rx.vstack(
-                *[
-                    sidebar_item(
-                        text=page.get("title", page["route"].strip("/").capitalize()),
-                        url=page["route"],
-                    )
-                    for page in get_decorated_pages()
-                ],
+                *[sidebar_item(text=title, url=route) for title, route in pages()],
                 width="100%",
                 overflow_y="auto",
                 align_items="flex-start",
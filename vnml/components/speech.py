@@ -0,0 +1,70 @@
+"""Speech of a line, played sentence by sentence without gaps."""
+
+from typing import List
+
+import reflex as rx
+
+# Two audio elements take turns: while one plays a sentence, the other has
+# already requested and buffered the next, which starts as soon as it ends.
+_SPEECH_QUEUE = """
+function SpeechQueue({ urls }) {
+  const first = useRef(null);
+  const second = useRef(null);
+  const queue = [].concat(urls ?? []);
+  const key = queue.join("\\n");
+  useEffect(() => {
+    const players = [first.current, second.current];
+    let index = 0;
+    const load = (player, at) => {
+      if (at < queue.length) {
+        player.src = queue[at];
+        player.load();
+      } else {
+        player.removeAttribute("src");
+      }
+    };
+    const play = () => {
+      if (index >= queue.length) {
+        return;
+      }
+      players[index % 2].play().catch(() => {});
+      load(players[(index + 1) % 2], index + 1);
+    };
+    players.forEach((player) => {
+      player.onended = () => {
+        index += 1;
+        play();
+      };
+    });
+    load(players[0], 0);
+    play();
+    return () => players.forEach((player) => {
+      player.onended = null;
+      player.pause();
+    });
+  }, [key]);
+  return (
+    <>
+      <audio ref={first} preload="auto" />
+      <audio ref={second} preload="auto" />
+    </>
+  );
+}
+"""
+
+
+class SpeechQueue(rx.Component):
+    """Plays the sentences of `vnml.compiler.dialogue_url` in order, requesting each next one while one plays."""
+
+    tag = "SpeechQueue"
+
+    urls: rx.Var[List[str]]
+
+    def add_imports(self) -> dict:
+        return {"react": ["useEffect", "useRef"]}
+
+    def add_custom_code(self) -> list[str]:
+        return [_SPEECH_QUEUE]
+
+
+speech_queue = SpeechQueue.create
@@ -0,0 +1,219 @@
+"""Story generation on worker processes, apart from the web workers.
+
+Streaming a turn from llama.cpp and compiling it into diffs takes as long as
+the model writes, and it used to take that long inside a Reflex event handler.
+`GenerationPool` runs it on worker processes instead, one per llama.cpp slot,
+and streams the diffs back to the handler that asked for them.
+
+The workers only generate: `vnml.scheduler` decides which turn gets a llama.cpp
+slot when, and each worker generates on a slot of its own.
+"""
+
+import asyncio
+import contextlib
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator
+
+from vnml import keywords
+from vnml.compiler import FEED_CHARS, Diff, GameSnapshot, TurnCompiler
+from vnml.llm import CompletionMetrics, iter_completion, llm
+
+# Worker processes of a backend; 0, the default, generates in the web worker.
+# Every backend process starts its own, so with several of them llama.cpp gets
+# more turns at once than it has slots: set this to PARALLEL_SLOTS, one per
+# slot, only on a single backend whose event loop is the bottleneck, as
+# `benchmarks.bench_generation` shows for the loop lag.
+GENERATION_WORKERS = int(os.environ.get("VNML_GENERATION_WORKERS", "0"))
+
+
+@dataclass
+class Job:
+    """A turn for a worker to generate."""
+    id: int
+    prompt: str
+    cue: str  # what the turn starts with, written by us rather than the model
+    snapshot: GameSnapshot
+    params: dict  # llama.cpp `/completion` parameters
+
+
+def _work(base_url: str, jobs: multiprocessing.Queue, results: multiprocessing.Queue, cancelled):
+    """A worker process: generates the turns it is handed, one at a time."""
+    llm.client.base_url = base_url
+    counts = {}  # the keyword stats last reported
+    while (job := jobs.get()) is not None:
+        metrics = CompletionMetrics()
+        compiler = TurnCompiler(job.snapshot)
+        error = None
+        try:
+            pending = job.cue
+            for text in iter_completion(job.prompt, metrics, **job.params):
+                if cancelled.value == job.id:
+                    break
+                pending += text
+                if ">" not in text and len(pending) < FEED_CHARS:  # every fragment ends with one
+                    continue
+                turn = compiler.feed(pending)
+                pending = ""
+                if turn.diffs:
+                    results.put(("diffs", job.id, [diff.__dict__ for diff in turn.diffs]))
+                if turn.done or turn.cut:  # the turn is over or goes on in another completion, stop paying for tokens
+                    break
+        except Exception as exception:
+            error = f"{type(exception).__name__}: {exception}"
+        metrics.cut = compiler.cut
+        results.put(("done", job.id, metrics.__dict__, error, keywords.stats_since(counts)))
+
+
+@dataclass(eq=False)
+class _Worker:
+    process: multiprocessing.Process
+    jobs: multiprocessing.Queue
+    cancelled: object  # shared id of the job to stop, checked on every token
+    turns: set = field(default_factory=set)  # those handed to it and not done yet
+
+
+@dataclass(eq=False)
+class _Turn:
+    job: Job
+    worker: _Worker
+    messages: asyncio.Queue = field(default_factory=asyncio.Queue)
+    finished: bool = False
+
+
+class GenerationPool:
+    """Worker processes that generate turns, one per llama.cpp slot.
+
+    Which turn runs when, and on which slot, is up to `vnml.scheduler`: a turn
+    runs on the worker of its slot, which is idle unless there are fewer
+    workers than slots.
+    """
+
+    def __init__(self, workers: int | None = None):
+        self.size = GENERATION_WORKERS if workers is None else workers
+        if self.size < 1:
+            raise ValueError(f"A generation pool needs at least one worker, not {self.size}: "
+                             "set VNML_GENERATION_WORKERS, or generate in the web worker")
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: list[_Worker] = []
+        self._turns: dict[int, _Turn] = {}
+        self._ids = itertools.count()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._results: multiprocessing.Queue | None = None
+        self._reader: threading.Thread | None = None
+
+    def start(self):
+        """Start the workers, on the event loop that will ask for turns."""
+        if self._workers:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._results = self._context.Queue()
+        self._workers = [self._spawn() for _ in range(self.size)]
+        self._reader = threading.Thread(target=self._read, name="vnml-generation-results", daemon=True)
+        self._reader.start()
+
+    def _spawn(self) -> _Worker:
+        jobs, cancelled = self._context.Queue(), self._context.Value("q", -1, lock=False)
+        process = self._context.Process(target=_work, args=(llm.client.base_url, jobs, self._results, cancelled),
+                                        name="vnml-generation", daemon=True)
+        process.start()
+        return _Worker(process, jobs, cancelled)
+
+    def close(self):
+        """Stop the workers once they finish their turns."""
+        for worker in self._workers:
+            worker.jobs.put(None)
+        for worker in self._workers:
+            worker.process.join()
+        if self._results is not None:
+            self._results.put(None)
+            self._reader.join()
+        self._workers = []
+
+    async def generate(self, slot: int, prompt: str, cue: str, snapshot: GameSnapshot,
+                       metrics: CompletionMetrics | None = None, **params) -> AsyncIterator[Diff]:
+        """Generate a turn on the worker of `slot`, as `vnml.components.playground.generate_diffs` does.
+
+        Closing the iterator early stops the worker.
+
+        Args:
+            slot: The llama.cpp slot to generate on.
+            prompt: The prompt to complete.
+            cue: The text the turn starts with, which the prompt ends with.
+            snapshot: The state the turn starts from, which is left as is.
+            metrics: Filled in from the server's timings once the turn ends.
+            **params: Extra llama.cpp `/completion` parameters, e.g. `n_predict`.
+
+        Yields:
+            The diffs of the turn, as the worker compiles them.
+        """
+        self.start()
+        worker = self._workers[slot % len(self._workers)]
+        turn = _Turn(Job(next(self._ids), prompt, cue, snapshot, {**params, "id_slot": slot}), worker)
+        self._turns[turn.job.id] = turn
+        worker.turns.add(turn)
+        worker.jobs.put(turn.job)
+        try:
+            while True:
+                message = await turn.messages.get()
+                if message[0] == "diffs":
+                    for log in message[2]:
+                        yield Diff(**log)
+                    continue
+                _, _, result, error, _ = message
+                if metrics is not None:
+                    metrics.__dict__.update(result)
+                if error is not None:
+                    raise RuntimeError(f"Generation failed: {error}")
+                return
+        finally:
+            if not turn.finished:
+                worker.cancelled.value = turn.job.id
+
+    def _read(self):
+        revived = time.monotonic()
+        while True:
+            with contextlib.suppress(queue.Empty):
+                message = self._results.get(timeout=1)
+                if message is None:
+                    return
+                self._loop.call_soon_threadsafe(self._deliver, message)
+            if time.monotonic() - revived >= 1:
+                revived = time.monotonic()
+                self._loop.call_soon_threadsafe(self._revive)
+
+    def _revive(self):
+        """Replace the workers that died, failing the turns they had."""
+        for index, worker in enumerate(self._workers):
+            if worker.process.is_alive():
+                continue
+            self._workers[index] = self._spawn()
+            for turn in list(worker.turns):
+                self._deliver(("done", turn.job.id, {}, f"worker exited with {worker.process.exitcode}", {}))
+
+    def _deliver(self, message: tuple):
+        if message[0] == "done":
+            keywords.add_stats(message[4])  # the worker compiled the turn, normalizing its keywords
+        turn = self._turns.get(message[1])
+        if turn is None:
+            return
+        turn.messages.put_nowait(message)
+        if message[0] == "done":
+            del self._turns[message[1]]
+            turn.finished = True
+            turn.worker.turns.discard(turn)
+
+
+_pool: GenerationPool | None = None
+
+
+def pool() -> GenerationPool:
+    global _pool
+    if _pool is None:
+        _pool = GenerationPool()
+    return _pool
@@ -0,0 +1,189 @@
+"""The grammar of the VNML the model writes, for llama.cpp to sample from.
+
+Left to itself the model may write an unknown tag, leave out `keywords` or
+never get to the options, and whatever `vnml2log` cannot make sense of is
+shown as raw dialogue, so the player asks for the turn again. The fields in
+README.md, which every prompt starts with, are turned into a GBNF grammar that
+llama.cpp samples the turn with, so it is valid as it is written, and into a
+regular expression that `validate` checks a turn written without it against.
+
+The README lists elements, their attributes and children, and its example
+shows which elements are empty. What it says in prose is spelled out here:
+which children repeat, that an attribute described "if different from the
+previous dialogue" may be left out, and that a turn is one or more scenes
+with their dialogue, then the options.
+"""
+
+import json
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+from vnml.parser import tag_of
+
+GRAMMAR = os.environ.get("VNML_GRAMMAR", "1").lower() in ("1", "true", "yes")
+
+README = Path(__file__).parent.parent / "README.md"
+
+# Children that may appear any number of times, but at least once; those next
+# to each other in the README, e.g. narration and character lines, interleave.
+REPEATED = frozenset({"narration", "character", "option"})
+
+_FIELD = re.compile(r"^( *)- \*\*`(<?)([\w-]+)>?`\*\*:(.*)$")
+_EMPTY = re.compile(r"<([\w-]+)\b[^<>]*/>")
+
+_SPACE = ("[ \\t\\r\\n]", "[ \\t\\r\\n]")
+_TEXT = ("[^<]+", "[^<]+")
+_VALUE = ('"\\"" [^"<]* "\\""', '"[^"<]*"')
+_COMMENT = ('"<!--" ([^-] | "-" [^-])* "-->"', "<!\\-\\-(?:[^-]|\\-[^-])*\\-\\->")
+
+
+@dataclass
+class Element:
+    tag: str
+    attributes: list[str]
+    optional: set[str]  # attributes that may be left out
+    children: list[str]
+    empty: bool = False  # written as `<tag .../>`
+
+
+@lru_cache(maxsize=1)
+def schema() -> dict[str, Element]:
+    """The elements of the field list in README.md, by tag, starting with `vnml`."""
+    readme = README.read_text(encoding="utf-8")
+    fields, example = readme.split("##### Fields:")[1].split("### Example")
+    empty = set(_EMPTY.findall(example))
+    elements = {"vnml": Element("vnml", ["lang"], set(), [])}
+    parents = [elements["vnml"]]  # by depth in the list, which is nested by four spaces
+    for line in fields.splitlines():
+        match = _FIELD.match(line)
+        if match is None:
+            continue
+        indent, is_tag, name, description = match.groups()
+        del parents[len(indent) // 4 + 1:]
+        parent = parents[-1]
+        if is_tag:
+            element = elements[name] = Element(name, [], set(), [], name in empty)
+            parent.children.append(name)
+            parents.append(element)
+        else:
+            parent.attributes.append(name)
+            if "(if " in description:
+                parent.optional.add(name)
+    return elements
+
+
+def _lit(text: str) -> tuple[str, str]:
+    return json.dumps(text), re.escape(text)
+
+
+def _seq(*parts: tuple[str, str]) -> tuple[str, str]:
+    return " ".join(part[0] for part in parts), "".join(part[1] for part in parts)
+
+
+def _alt(*parts: tuple[str, str]) -> tuple[str, str]:
+    if len(parts) == 1:
+        return parts[0]
+    return f"({' | '.join(part[0] for part in parts)})", f"(?:{'|'.join(part[1] for part in parts)})"
+
+
+def _many(part: tuple[str, str], times: str = "*") -> tuple[str, str]:
+    return f"({part[0]}){times}", f"(?:{part[1]}){times}"
+
+
+class _Rules:
+    """Named rules, written out by name in GBNF and inlined in the regular expression."""
+
+    def __init__(self, elements: dict[str, Element]):
+        self.elements = elements
+        self.gbnf: dict[str, str] = {}
+        self.regex: dict[str, str] = {}
+        self.ws = self.define("ws", _many(_alt(_SPACE, self.define("comment", _COMMENT))))
+
+    def define(self, name: str, body: tuple[str, str]) -> tuple[str, str]:
+        self.gbnf[name], self.regex[name] = body
+        return name, f"(?:{body[1]})"
+
+    def element(self, tag: str) -> tuple[str, str]:
+        if tag in self.gbnf:
+            return tag, f"(?:{self.regex[tag]})"
+        element = self.elements[tag]
+        attributes = []
+        for name in element.attributes:
+            attribute = _seq(_many(_SPACE, "+"), _lit(f"{name}="), _VALUE)
+            attributes.append(_many(attribute, "?") if name in element.optional else attribute)
+        start = _seq(_lit(f"<{tag}"), *attributes, _many(_SPACE))
+        if element.empty:
+            return self.define(tag, _seq(start, _lit("/>")))
+        if not element.children:
+            return self.define(tag, _seq(start, _lit(">"), _TEXT, _lit(f"</{tag}>")))
+        content = self.content(tag)
+        return self.define(tag, _seq(start, _lit(">"), content, self.ws, _lit(f"</{tag}>")))
+
+    def content(self, tag: str) -> tuple[str, str]:
+        """What goes between the tags of `tag`, before the whitespace at the end."""
+        parts, children = [], self.elements[tag].children
+        index = 0
+        while index < len(children):
+            if children[index] not in REPEATED:
+                parts.append(_seq(self.ws, self.element(children[index])))
+                index += 1
+                continue
+            group = []
+            while index < len(children) and children[index] in REPEATED:
+                group.append(self.element(children[index]))
+                index += 1
+            parts.append(_many(_seq(self.ws, _alt(*group)), "+"))
+        return self.define(f"{tag}-content", _seq(*parts))
+
+
+@lru_cache(maxsize=1)
+def _grammar() -> tuple[str, dict[str, str], dict[str, re.Pattern]]:
+    """The rules shared by every grammar, and the start rules and patterns by resume point."""
+    rules = _Rules(schema())
+    ws = rules.ws
+    scene, dialogue, options = (rules.element(tag) for tag in ("scene", "dialogue", "options"))
+    line = _alt(rules.element("narration"), rules.element("character"))
+    rest = rules.define("rest", _seq(_many(_seq(ws, scene, ws, dialogue)), ws, options))
+    roots = {
+        # Cues open the first scene of a turn, or its options, see `vnml.prompt`.
+        "<scene>": _seq(rules.content("scene"), ws, _lit("</scene>"), ws, dialogue, rest),
+        "<options>": _seq(rules.content("options"), ws, _lit("</options>")),
+        # A turn cut short goes on after its last fragment.
+        "scene": _seq(ws, dialogue, rest),
+        "narration": _seq(_many(_seq(ws, line)), ws, _lit("</dialogue>"), rest),
+    }
+    roots["character"] = roots["narration"]
+    shared = "".join(f"{name} ::= {body}\n" for name, body in rules.gbnf.items())
+    return (shared, {after: root[0] for after, root in roots.items()},
+            {after: re.compile(root[1]) for after, root in roots.items()})
+
+
+def resume_point(vnml: str, cue: str = "") -> str:
+    """Where a prompt leaves the turn: the tag its cue opens last, or that of its last fragment `vnml`."""
+    if cue:
+        return cue[cue.rindex("<"):].strip()
+    return tag_of(vnml)
+
+
+def gbnf(after: str = "<scene>") -> str | None:
+    """The GBNF grammar of the rest of a turn, or None if there is none to write.
+
+    Args:
+        after: Where the prompt leaves the turn, see `resume_point`.
+    """
+    shared, roots, _ = _grammar()
+    if after not in roots:
+        return None
+    return f"root ::= {roots[after]}\n{shared}"
+
+
+def validate(text: str, after: str = "<scene>") -> bool:
+    """Whether `text`, as the model wrote it from `after` on, is what `gbnf` allows.
+
+    A turn from the grammar always is; this checks those written without it.
+    """
+    pattern = _grammar()[2].get(after)
+    return pattern is not None and pattern.fullmatch(text) is not None
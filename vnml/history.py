@@ -0,0 +1,455 @@
+"""Per-session playback history, kept outside the serialized Reflex state."""
+
+import asyncio
+import json
+import sys
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Callable
+
+from vnml.compiler import merge_characters
+
+MAX_SESSIONS = 1024
+
+# A snapshot of the state is kept every this many diffs, so that any point of
+# the history is restored by replaying at most this many diffs.
+KEYFRAME_INTERVAL = 32
+
+# Histories loaded from a store are read this many diffs at a time, newest
+# first; a multiple of KEYFRAME_INTERVAL, as each page starts at a keyframe.
+PAGE_SIZE = 8 * KEYFRAME_INTERVAL
+
+# Snapshot fields by id, in order of first use, shared by every history.
+FIELDS: list[str] = []
+_FIELD_IDS: dict[str, int] = {}
+
+
+def field_id(name: str) -> int:
+    field = _FIELD_IDS.get(name)
+    if field is None:
+        field = _FIELD_IDS[name] = len(FIELDS)
+        FIELDS.append(name)
+    return field
+
+
+_CHARACTERS = field_id("characters")
+
+
+def _advance(state: dict[int, object], record: "DiffRecord"):
+    """Update `state` past `record`; the character table is merged, see `vnml.compiler.merge_characters`."""
+    for field, value in zip(record.fields, record.new):
+        state[field] = merge_characters(state.get(field) or {}, value) if field == _CHARACTERS else value
+
+
+def _compact(value):
+    # URLs, names and options repeat across diffs and sessions: keep one copy of each.
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return tuple(_compact(item) for item in value)
+    return value
+
+
+def _expand(value):
+    return list(value) if isinstance(value, tuple) else value
+
+
+class DiffRecord:
+    """A diff reduced to the snapshot fields it changes.
+
+    `do_log` is stored for the changed fields only, the others being no-ops,
+    as field ids in a bytes string with the new and old values alongside.
+    """
+
+    __slots__ = ("fields", "new", "old", "vnml", "gap", "scene")
+
+    def __init__(self, fields: bytes, new: tuple, old: tuple, vnml: str, gap: str, scene: bool):
+        self.fields = fields
+        self.new = new
+        self.old = old
+        self.vnml = vnml
+        self.gap = gap
+        self.scene = scene
+
+    @classmethod
+    def from_diff(cls, diff: dict) -> "DiffRecord":
+        do_log, undo_log = diff["do_log"], diff["undo_log"]
+        changed = [key for key in undo_log if key in do_log]
+        return cls(
+            bytes(field_id(key) for key in changed),
+            tuple(_compact(do_log[key]) for key in changed),
+            tuple(_compact(undo_log[key]) for key in changed),
+            diff["vnml"],
+            sys.intern(diff.get("gap", "")),
+            bool(do_log.get("background_url")),
+        )
+
+    def diff(self) -> dict:
+        """The record as the `Diff.__dict__` it was made from, minus the no-op fields."""
+        return {
+            "do_log": {FIELDS[field]: _expand(value) for field, value in zip(self.fields, self.new)},
+            "undo_log": {FIELDS[field]: _expand(value) for field, value in zip(self.fields, self.old)},
+            "vnml": self.vnml,
+            "gap": self.gap,
+        }
+
+
+_MAGIC = b"VNMLH\x01"
+
+_NONE, _STR, _LIST, _JSON = range(4)
+
+
+def _write_varint(out: bytearray, number: int):
+    while number > 0x7F:
+        out.append(number & 0x7F | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    number = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, pos
+        shift += 7
+
+
+class HistoryBuffer:
+    """Append-only list of diffs with a running index over their VNML.
+
+    The VNML of a diff is its fragment preceded by its gap, the raw text the
+    model wrote before it, so the joined history is the story exactly as it was
+    generated. It is cached and only ever extended by the diffs appended since
+    the last call, instead of being re-joined from every diff on each turn.
+
+    Diffs are kept as `DiffRecord`s and encoded to their binary form as they
+    are appended, so serializing a whole session is a copy.
+
+    A history resumed from a store (see `paged`) may hold only its newest
+    pages: the first `_base` diffs are read through `_loader` the first time
+    one of them is needed.
+    """
+
+    def __init__(self):
+        self.journal = None  # told about every append and truncation, e.g. to persist them
+        self._base = 0  # diffs before the loaded ones
+        self._base_state: dict[int, object] = {}  # field id -> value after the first _base diffs
+        self._loader: Callable[[int, int], tuple[dict, list[dict]]] | None = None
+        self._diffs: list[DiffRecord] = []
+        self._ends: list[int] = []  # _ends[i] is the length of the VNML of diffs[:i + 1]
+        self._joined = ""  # VNML of diffs[:self._joined_count]
+        self._joined_count = 0
+        self.scene_starts: list[int] = []  # indices of the diffs that open a new scene
+        self._strings: dict[str, int] = {}  # string table of the binary form
+        self._encoded = bytearray()  # binary form of the records
+        self._encoded_ends: list[int] = []
+        self._state: dict[int, object] = {}  # field id -> value after every diff
+        self._keyframes: list[dict[int, object]] = []  # [k]: the state after (k + 1) * KEYFRAME_INTERVAL diffs
+
+    @classmethod
+    def paged(cls, length: int, scene_starts: list[int],
+              loader: Callable[[int, int], tuple[dict, list[dict]]]) -> "HistoryBuffer":
+        """A stored history of `length` diffs, of which only the last page is read for now.
+
+        Args:
+            length: The number of diffs stored.
+            scene_starts: The indices of the diffs that open a new scene.
+            loader: Called with `(start, stop)` to read diffs `start` to `stop`; returns
+                every field set by the first `start` diffs, with its value after them,
+                and the diffs as `Diff.__dict__`s. `start` is a multiple of `PAGE_SIZE`.
+        """
+        history = cls()
+        history._base, history.scene_starts, history._loader = length, list(scene_starts), loader
+        history._fault(max(0, length - PAGE_SIZE))
+        return history
+
+    def _fault(self, index: int):
+        """Load the older pages of the history down to the one holding diff `index`."""
+        if index >= self._base:
+            return
+        start = index // PAGE_SIZE * PAGE_SIZE
+        self._prepend(start, *self._loader(start, self._base))
+
+    async def load(self, index: int = 0):
+        """Read the older pages down to the one holding diff `index` in a thread.
+
+        The diffs read afterwards are in memory, so reading them does not
+        block the event loop as a page fault would.
+        """
+        index = max(index, 0)
+        while index < self._base:
+            base, start = self._base, index // PAGE_SIZE * PAGE_SIZE
+            state, diffs = await asyncio.to_thread(self._loader, start, base)
+            if self._base == base:  # else a fault or another load read them meanwhile
+                self._prepend(start, state, diffs)
+
+    def _prepend(self, start: int, state: dict, diffs: list[dict]):
+        """Put the diffs from `start` up to the loaded ones in front of them; see `paged` for `state`."""
+        records = [DiffRecord.from_diff(diff) for diff in diffs] + self._diffs
+        history = HistoryBuffer()
+        history._base, history._loader = start, self._loader
+        history._base_state = {field_id(key): _compact(value) for key, value in state.items()}
+        history._state = history._base_state.copy()
+        history.scene_starts = [scene for scene in self.scene_starts if scene < start]
+        for record in records:
+            history._append(record)
+        journal = self.journal
+        self.__dict__.update(history.__dict__)
+        self.journal = journal
+
+    def _record(self, index: int) -> DiffRecord:
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError("history index out of range")
+        self._fault(index)
+        return self._diffs[index - self._base]
+
+    def __len__(self) -> int:
+        return self._base + len(self._diffs)
+
+    @property
+    def loaded_from(self) -> int:
+        """The index of the oldest diff in memory: those before it are still in the store."""
+        return self._base
+
+    def __getitem__(self, index: int) -> dict:
+        return self._record(index).diff()
+
+    def changes(self, index: int, undo: bool = False) -> dict:
+        """The fields diff `index` changes, with their new values (or, with `undo`, their old ones)."""
+        record = self._record(index)
+        values = record.old if undo else record.new
+        return {FIELDS[field]: _expand(value) for field, value in zip(record.fields, values)}
+
+    def vnml_at(self, index: int) -> str:
+        return self._record(index).vnml
+
+    def gap_at(self, index: int) -> str:
+        return self._record(index).gap
+
+    def is_scene(self, index: int) -> bool:
+        return self._record(index).scene
+
+    def append(self, diff: dict):
+        self._append(DiffRecord.from_diff(diff))
+        if self.journal is not None:
+            self.journal.appended(self)
+
+    def _append(self, record: DiffRecord):
+        if record.scene:
+            self.scene_starts.append(len(self))
+        self._diffs.append(record)
+        self._ends.append((self._ends[-1] if self._ends else 0) + len(record.gap) + len(record.vnml))
+        self._encode(record)
+        _advance(self._state, record)
+        if len(self._diffs) % KEYFRAME_INTERVAL == 0:
+            self._keyframes.append(self._state.copy())
+
+    def _encode(self, record: DiffRecord):
+        out, strings = self._encoded, self._strings
+
+        def ref(text: str):
+            _write_varint(out, strings.setdefault(text, len(strings)))
+
+        out.append(record.scene)
+        ref(record.gap)
+        ref(record.vnml)
+        _write_varint(out, len(record.fields))
+        out += record.fields
+        for item in record.new + record.old:
+            if item is None:
+                out.append(_NONE)
+            elif isinstance(item, str):
+                out.append(_STR)
+                ref(item)
+            elif isinstance(item, tuple) and all(isinstance(part, str) for part in item):
+                out.append(_LIST)
+                _write_varint(out, len(item))
+                for part in item:
+                    ref(part)
+            else:
+                out.append(_JSON)
+                ref(json.dumps(_expand(item)))
+        self._encoded_ends.append(len(out))
+
+    def truncate(self, length: int):
+        """Drop every diff from `length` on, e.g. the future of a replayed choice."""
+        if length >= len(self):
+            return
+        self._fault(length)
+        local = length - self._base
+        del self._diffs[local:]
+        del self._ends[local:]
+        del self._encoded[self._encoded_ends[local - 1] if local > 0 else 0:]
+        del self._encoded_ends[local:]
+        del self._keyframes[local // KEYFRAME_INTERVAL:]
+        self._state = self._replay(length)
+        del self.scene_starts[bisect_left(self.scene_starts, length):]
+        if self._joined_count > length:
+            self._joined = self._joined[:self.offset(length)]
+            self._joined_count = length
+        if self.journal is not None:
+            self.journal.truncated(self, length)
+
+    def fork(self) -> "HistoryBuffer":
+        """A copy that shares the recorded diffs but is extended independently."""
+        fork = HistoryBuffer()
+        fork._base, fork._base_state, fork._loader = self._base, self._base_state, self._loader
+        fork._diffs = self._diffs.copy()
+        fork._ends = self._ends.copy()
+        fork._joined, fork._joined_count = self._joined, self._joined_count
+        fork.scene_starts = self.scene_starts.copy()
+        fork._strings = self._strings.copy()
+        fork._encoded = self._encoded.copy()
+        fork._encoded_ends = self._encoded_ends.copy()
+        fork._state = self._state.copy()
+        fork._keyframes = self._keyframes.copy()  # keyframes are never modified
+        return fork
+
+    def _replay(self, length: int) -> dict[int, object]:
+        """The state after `diffs[:length]`, from the last keyframe before it."""
+        self._fault(length)
+        length -= self._base
+        keyframe = min(length // KEYFRAME_INTERVAL, len(self._keyframes))
+        state = self._keyframes[keyframe - 1].copy() if keyframe else self._base_state.copy()
+        for record in self._diffs[keyframe * KEYFRAME_INTERVAL:length]:
+            _advance(state, record)
+        return state
+
+    def state_at(self, index: int) -> dict:
+        """Every field set by `diffs[:index + 1]`, with its value at that point.
+
+        Replays at most `KEYFRAME_INTERVAL` diffs, however long the history.
+        """
+        state = self._state if index + 1 >= len(self) else self._replay(index + 1)
+        return {FIELDS[field]: _expand(value) for field, value in state.items()}
+
+    def offset(self, index: int) -> int:
+        """Where the VNML of diff `index` starts in the joined history.
+
+        Reads every page of a resumed history, as does `vnml`.
+        """
+        self._fault(0)
+        return self._ends[index - 1] if index > 0 else 0
+
+    def vnml(self, end: int | None = None) -> str:
+        """The VNML of `diffs[:end]` (everything by default)."""
+        self._fault(0)
+        end = len(self._diffs) if end is None else min(end, len(self._diffs))
+        if end < self._joined_count:
+            return self._joined[:self.offset(end)]
+        if end > self._joined_count:
+            joined, self._joined = self._joined, ""
+            # With the only reference held here, CPython grows the string in place.
+            joined += "".join(record.gap + record.vnml for record in self._diffs[self._joined_count:end])
+            self._joined, self._joined_count = joined, end
+        return self._joined
+
+    def scenes(self) -> list[tuple[int, int]]:
+        """`(start, end)` index ranges of the history split at every scene change."""
+        bounds = [0, *(start for start in self.scene_starts if start > 0), len(self)]
+        return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+    def to_bytes(self) -> bytes:
+        """A compact binary form of the history, read back by `from_bytes`.
+
+        Every distinct string (URL, name, fragment, gap) is written once in a
+        table and referred to by index, and integers are varints. Strings of
+        diffs that were truncated away stay in the table until reloaded.
+        """
+        self._fault(0)
+        out = bytearray(_MAGIC)
+        for table in (FIELDS, self._strings):
+            _write_varint(out, len(table))
+            for text in table:
+                encoded = text.encode()
+                _write_varint(out, len(encoded))
+                out += encoded
+        _write_varint(out, len(self._diffs))
+        return bytes(out + self._encoded)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HistoryBuffer":
+        if not data.startswith(_MAGIC):
+            raise ValueError("not a serialized history")
+        pos = len(_MAGIC)
+        tables = []
+        for _ in range(2):
+            count, pos = _read_varint(data, pos)
+            table = []
+            for _ in range(count):
+                length, pos = _read_varint(data, pos)
+                table.append(sys.intern(data[pos:pos + length].decode()))
+                pos += length
+            tables.append(table)
+        fields, strings = tables
+        remap = bytes(field_id(name) for name in fields)  # ids of the writer -> ids of this process
+
+        def ref():
+            nonlocal pos
+            index, pos = _read_varint(data, pos)
+            return strings[index]
+
+        def value():
+            nonlocal pos
+            kind = data[pos]
+            pos += 1
+            if kind == _NONE:
+                return None
+            if kind == _STR:
+                return ref()
+            if kind == _LIST:
+                count, pos = _read_varint(data, pos)
+                return tuple(ref() for _ in range(count))
+            return _compact(json.loads(ref()))
+
+        history = cls()
+        count, pos = _read_varint(data, pos)
+        for _ in range(count):
+            scene = bool(data[pos])
+            pos += 1
+            gap, vnml = ref(), ref()
+            width, pos = _read_varint(data, pos)
+            record_fields = data[pos:pos + width].translate(remap + bytes(256 - len(remap)))
+            pos += width
+            new = tuple(value() for _ in range(width))
+            old = tuple(value() for _ in range(width))
+            history._append(DiffRecord(record_fields, new, old, vnml, gap, scene))
+        return history
+
+
+_histories: OrderedDict[str, HistoryBuffer] = OrderedDict()
+
+
+def get_history(token: str, load: Callable[[str], HistoryBuffer] | None = None) -> HistoryBuffer:
+    """The history of the session `token`, created on first use.
+
+    Only the `MAX_SESSIONS` most recently used sessions are kept in memory.
+
+    Args:
+        token: The session.
+        load: Called with `token` for a session that is not in memory, e.g. to
+            read it back from a store; by default it starts empty.
+    """
+    history = _histories.get(token)
+    if history is None:
+        history = _histories[token] = load(token) if load is not None else HistoryBuffer()
+        if len(_histories) > MAX_SESSIONS:
+            _histories.popitem(last=False)
+    else:
+        _histories.move_to_end(token)
+    return history
+
+
+def has_history(token: str) -> bool:
+    """Whether the history of `token` is in memory, i.e. `get_history` does not need to load it."""
+    return token in _histories
+
+
+def drop_history(token: str):
+    """Forget the in-memory history of `token`, e.g. after its stored history was replaced."""
+    _histories.pop(token, None)
@@ -0,0 +1,199 @@
+"""Canonical forms of the keyword lists that media URLs are built from.
+
+The model writes the same set of keywords in many ways ("twilight, foggy",
+"foggy,twilight "), and every spelling is a different URL, hence a separate
+generation. Normalizing them before building URLs lets all spellings share one
+cached asset.
+"""
+
+import json
+import os
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Iterable
+
+# Optional JSON file mapping keywords to a canonical one, e.g. {"dusk": "twilight"}.
+SYNONYMS_FILE = os.environ.get("VNML_KEYWORD_SYNONYMS")
+
+# Keyword sets at least this similar (Jaccard) to one seen before reuse it; 1 disables this.
+SIMILARITY = float(os.environ.get("VNML_KEYWORD_SIMILARITY", "1"))
+
+# The emotions sprites are drawn with, the first for those it cannot place;
+# empty to draw every emotion the model writes.
+PALETTE = [
+    emotion.strip().lower()
+    for emotion in os.environ.get(
+        "VNML_EMOTION_PALETTE", "neutral,happy,sad,angry,surprised,scared,serious,embarrassed"
+    ).split(",")
+    if emotion.strip()
+]
+
+# Emotions the model often writes, by the one of the default palette they are drawn as.
+EMOTION_GROUPS = {
+    "neutral": ["calm", "composed", "indifferent", "relaxed", "curious", "thoughtful", "pensive"],
+    "happy": ["smiling", "cheerful", "joyful", "glad", "delighted", "pleased", "excited", "eager", "welcoming",
+              "relieved", "satisfied", "approving", "encouraging", "proud", "confident", "grateful", "hopeful",
+              "amused", "laughing", "playful", "friendly", "warm", "content", "impressed"],
+    "sad": ["unhappy", "upset", "crying", "tearful", "disappointed", "lonely", "melancholic", "sorrowful",
+            "hurt", "regretful", "tired", "gloomy", "heartbroken", "apologetic"],
+    "angry": ["furious", "annoyed", "frustrated", "irritated", "mad", "hostile", "defiant", "indignant"],
+    "surprised": ["shocked", "astonished", "amazed", "startled", "stunned", "confused", "puzzled",
+                  "bewildered", "intrigued", "wide-eyed"],
+    "scared": ["fearful", "afraid", "frightened", "terrified", "nervous", "anxious", "worried", "panicked",
+               "uneasy", "tense", "alarmed"],
+    "serious": ["determined", "resolute", "focused", "alert", "stern", "grim", "enigmatic", "mysterious",
+                "cautious", "skeptical", "suspicious", "solemn", "wary", "concerned"],
+    "embarrassed": ["shy", "flustered", "blushing", "awkward", "sheepish", "bashful"],
+}
+
+MAX_TRACKED = 65536
+
+_SPACES = re.compile(r"\s+")
+
+
+def load_synonyms(path: str | None = SYNONYMS_FILE) -> dict[str, str]:
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as file:
+        return {key.strip().lower(): value.strip().lower() for key, value in json.load(file).items()}
+
+
+@dataclass
+class KeywordStats:
+    """How many distinct spellings ended up as how many distinct assets."""
+    requests: int = 0
+    spellings: int = 0
+    canonical: int = 0
+
+    @property
+    def collapsed(self) -> int:
+        """Generations saved: spellings that reuse another spelling's asset."""
+        return self.spellings - self.canonical
+
+
+@dataclass
+class KeywordIndex:
+    """Normalizes keyword lists of one kind (backgrounds, music, ...) and counts the savings."""
+    synonyms: dict[str, str] = field(default_factory=dict)
+    similarity: float = SIMILARITY
+    stats: KeywordStats = field(default_factory=KeywordStats)
+    _spellings: OrderedDict = field(default_factory=OrderedDict, init=False, repr=False)  # raw -> canonical
+    _canonical: OrderedDict = field(default_factory=OrderedDict, init=False, repr=False)  # canonical -> tokens
+
+    def normalize(self, keywords: str, names: Iterable[str] = ()) -> str:
+        """Trim, lowercase (except `names`), dedupe and sort comma-separated keywords.
+
+        Not thread-safe: turns are compiled on the event loop, or in a
+        generation worker with its own indexes, see `add_stats`.
+        """
+        self.stats.requests += 1
+        names = {name.lower(): name for name in names}
+        spelling = (keywords, frozenset(names.values()))
+        canonical = self._spellings.get(spelling)
+        if canonical is not None:
+            self._spellings.move_to_end(spelling)
+            return canonical
+        tokens = set()
+        for token in keywords.split(","):
+            token = _SPACES.sub(" ", token).strip()
+            if token:
+                lower = token.lower()
+                tokens.add(names.get(lower) or self.synonyms.get(lower, lower))
+        canonical = ", ".join(sorted(tokens))
+        if canonical not in self._canonical and self.similarity < 1:
+            canonical = self._nearest(tokens) or canonical
+        if canonical not in self._canonical:
+            self.stats.canonical += 1
+            self._canonical[canonical] = frozenset(tokens)
+            if len(self._canonical) > MAX_TRACKED:
+                self._canonical.popitem(last=False)
+        self.stats.spellings += 1
+        self._spellings[spelling] = canonical
+        if len(self._spellings) > MAX_TRACKED:
+            self._spellings.popitem(last=False)
+        return canonical
+
+    def _nearest(self, tokens: set[str]) -> str | None:
+        best, best_score = None, self.similarity
+        for canonical, seen in self._canonical.items():
+            score = len(tokens & seen) / len(tokens | seen) if tokens or seen else 1.0
+            if score >= best_score:
+                best, best_score = canonical, score
+        return best
+
+
+@dataclass
+class EmotionPalette:
+    """Draws the emotions the model writes with a few, so a look has a bounded number of sprites."""
+    emotions: list[str] = field(default_factory=lambda: list(PALETTE))
+    groups: dict[str, list[str]] = field(default_factory=lambda: dict(EMOTION_GROUPS))
+    stats: KeywordStats = field(default_factory=KeywordStats)
+    _quantized: dict[str, str] = field(default_factory=dict, init=False, repr=False)  # normalized -> palette
+    _used: set[str] = field(default_factory=set, init=False, repr=False)
+
+    def __post_init__(self):
+        self._words = {word: emotion for emotion, words in self.groups.items() for word in words}
+        self._words.update({emotion: emotion for emotion in self.emotions})
+
+    def quantize(self, emotion: str | None) -> str | None:
+        """The palette emotion of normalized emotion keywords: that of the first it knows, else the first of the palette."""
+        if not self.emotions or emotion is None:
+            return emotion
+        self.stats.requests += 1
+        quantized = self._quantized.get(emotion)
+        if quantized is None:
+            quantized = next(
+                (word for token in emotion.split(", ") if (word := self._words.get(token)) in self.emotions),
+                self.emotions[0],
+            )
+            self.stats.spellings += 1
+            self._used.add(quantized)
+            self.stats.canonical = len(self._used)
+            if len(self._quantized) < MAX_TRACKED:
+                self._quantized[emotion] = quantized
+        return quantized
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace in text that is spoken, where order and case matter."""
+    return _SPACES.sub(" ", text).strip()
+
+
+_synonyms = load_synonyms()
+
+backgrounds = KeywordIndex(_synonyms)
+music = KeywordIndex(_synonyms)
+characters = KeywordIndex(_synonyms)
+emotions = KeywordIndex(_synonyms)
+palette = EmotionPalette()
+
+
+def _kinds() -> tuple:
+    return (("background", backgrounds), ("music", music),
+            ("character", characters), ("emotion", emotions), ("emotion palette", palette))
+
+
+def collapse_stats() -> dict[str, dict]:
+    """Per kind of keywords, the requests, spellings, assets and generations saved."""
+    return {kind: {**index.stats.__dict__, "collapsed": index.stats.collapsed} for kind, index in _kinds()}
+
+
+def stats_since(counts: dict[str, dict]) -> dict[str, dict]:
+    """Per kind, what the counts of this process grew by since they were `counts`, and updates `counts`."""
+    delta = {}
+    for kind, index in _kinds():
+        before = counts.setdefault(kind, {})
+        delta[kind] = {key: value - before.get(key, 0) for key, value in index.stats.__dict__.items()}
+        before.update(index.stats.__dict__)
+    return delta
+
+
+def add_stats(delta: dict[str, dict]):
+    """Count in what another process normalized, e.g. a generation worker, see `stats_since`.
+
+    Assets are counted once per process that asked for them.
+    """
+    for kind, index in _kinds():
+        for key, value in delta.get(kind, {}).items():
+            setattr(index.stats, key, getattr(index.stats, key) + value)
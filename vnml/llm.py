@@ -0,0 +1,144 @@
+"""Access to the llama.cpp completion server."""
+
+import asyncio
+import contextlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Iterable, Iterator
+
+# Must match `--parallel` of the llama.cpp server in docker-compose.yml.
+PARALLEL_SLOTS = 4
+
+
+class _LazyClient:
+    """The furchain llama.cpp client, imported and built on first use.
+
+    furchain pulls in langchain, most of the time it takes to import the app,
+    which every web and generation worker pays when it starts.
+    """
+
+    def __init__(self):
+        object.__setattr__(self, "_client", None)
+
+    def _get(self):
+        if self._client is None:
+            from furchain.text.schema import ChatFormat, LlamaCpp
+            object.__setattr__(self, "_client", LlamaCpp(chat_format=ChatFormat.Llama3))
+        return self._client
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        setattr(self._get(), name, value)
+
+
+llm = _LazyClient()
+
+
+@dataclass
+class CompletionMetrics:
+    """How much of a completion's prompt llama.cpp could take from its KV cache."""
+    id_slot: int = -1
+    prompt_tokens: int = 0
+    cached_tokens: int = 0  # reused from the slot's KV cache
+    evaluated_tokens: int = 0  # actually run through the model
+    predicted_tokens: int = 0
+    prompt_ms: float = 0.0
+    predicted_ms: float = 0.0
+    cut: str = ""  # the element that ended the completion early at its cap, see `vnml.compiler.MAX_LENGTH`
+
+    def update(self, result: dict):
+        """Fill in from the final event of a llama.cpp `/completion` stream."""
+        timings = result.get("timings", {})
+        self.id_slot = result.get("id_slot", self.id_slot)
+        self.prompt_tokens = result.get("tokens_evaluated", 0)
+        self.evaluated_tokens = timings.get("prompt_n", self.prompt_tokens)
+        self.cached_tokens = max(0, self.prompt_tokens - self.evaluated_tokens)
+        self.predicted_tokens = timings.get("predicted_n", 0)
+        self.prompt_ms = timings.get("prompt_ms", 0.0)
+        self.predicted_ms = timings.get("predicted_ms", 0.0)
+
+
+class SlotPool:
+    """Sticky assignment of sessions to llama.cpp slots.
+
+    A slot keeps the KV cache of the last prompt it ran, so sending a session's
+    turns to the same slot lets llama.cpp skip prefill for the shared prefix.
+    When every slot is taken, the least recently used one changes hands.
+    """
+
+    def __init__(self, slots: int = PARALLEL_SLOTS):
+        self._owners: OrderedDict[int, str | None] = OrderedDict((slot, None) for slot in range(slots))
+
+    def slot(self, session: str, free: Iterable[int] | None = None) -> int:
+        """The slot of `session`, or the least recently used one of `free` if it is not free."""
+        free = set(self._owners if free is None else free)
+        for slot, owner in self._owners.items():
+            if owner == session and slot in free:
+                self._owners.move_to_end(slot)
+                return slot
+        slot = next(slot for slot in self._owners if slot in free)
+        del self._owners[slot]
+        self._owners[slot] = session
+        return slot
+
+
+slots = SlotPool()
+
+
+async def complete(prompt: str, **kwargs) -> str:
+    """Run a whole completion on a worker thread and return its text."""
+    return await asyncio.to_thread(llm.invoke, prompt, **kwargs)
+
+
+async def stream_completion(prompt: str, metrics: CompletionMetrics | None = None, **kwargs) -> AsyncIterator[str]:
+    """Stream a completion without blocking the event loop.
+
+    The furchain client streams over a blocking HTTP response, so every event is
+    pulled on a worker thread and handed back to the loop as soon as it arrives.
+    A matched stop string is yielded as well, so the joined output is exactly
+    what the model wrote.
+
+    Args:
+        prompt: The raw prompt to complete.
+        metrics: Filled in from the server's timings once the stream ends.
+        **kwargs: Extra llama.cpp `/completion` parameters, e.g. `n_predict`.
+
+    Yields:
+        The generated text, one token chunk at a time.
+    """
+    loop = asyncio.get_running_loop()
+    events = llm.client.stream({"prompt": prompt}, **kwargs, **llm.model_kwargs)
+    try:
+        while (event := await loop.run_in_executor(None, next, events, None)) is not None:
+            for text in _texts(event, metrics):
+                yield text
+    finally:
+        # If we were cancelled mid-token the worker thread still owns the generator;
+        # it is then left to the garbage collector, which closes the connection.
+        with contextlib.suppress(ValueError):
+            events.close()
+
+
+def iter_completion(prompt: str, metrics: CompletionMetrics | None = None, **kwargs) -> Iterator[str]:
+    """`stream_completion` for a thread or process that may block on every token.
+
+    Closing the iterator closes the connection, which stops the generation.
+    """
+    events = llm.client.stream({"prompt": prompt}, **kwargs, **llm.model_kwargs)
+    try:
+        for event in events:
+            yield from _texts(event, metrics)
+    finally:
+        events.close()
+
+
+def _texts(event: dict, metrics: CompletionMetrics | None) -> list[str]:
+    texts = [event["content"]] if event.get("content") else []
+    if event.get("stop"):
+        if metrics is not None:
+            metrics.update(event)
+        if event.get("stopped_word") and event.get("stopping_word"):
+            texts.append(event["stopping_word"])
+    return texts
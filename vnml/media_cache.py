@@ -0,0 +1,346 @@
+"""Content-addressed disk cache in front of the media generation services.
+
+Media URLs are deterministic (the seed is part of them), so an asset only ever
+needs generating once, whichever session or browser asks for it. The cache is
+served by the Reflex backend under `/media/<service>/...`: assets are stored on
+disk under a hash of their normalized URL, the least recently used ones are
+evicted past a size limit, and concurrent requests for the same asset share a
+single upstream request. An asset is written to disk as it arrives and served
+from there meanwhile, so a browser gets its first bytes as soon as the service
+sends them. Byte ranges are served too, which browsers ask for to seek in and
+loop audio.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import AsyncIterator
+from urllib.parse import parse_qsl, quote, unquote, urlencode
+
+import httpx
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+from vnml.keywords import collapse_stats
+
+# Where the image, music and speech services are reached: nginx, or a service
+# address per path prefix as in data/nginx/vnml.conf.
+UPSTREAM = os.environ.get("VNML_MEDIA_UPSTREAM", "http://127.0.0.1/")
+
+CACHE_DIR = Path(os.environ.get("VNML_MEDIA_CACHE_DIR", "data/media-cache"))
+
+MAX_BYTES = int(os.environ.get("VNML_MEDIA_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+
+SERVICES = frozenset({"image", "music", "speech"})
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = httpx.Timeout(300.0, connect=5.0)
+
+# Most bytes read from disk at once while serving a download in progress.
+READ_CHUNK = 256 * 1024
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def cache_key(service: str, path: str, query: str) -> str:
+    """Hash of a media request, the same however its URL was encoded.
+
+    The path is unquoted and the query parameters are sorted, so that e.g.
+    `?seed=42&width=1024` and `?width=1024&seed=42&` share one entry.
+    """
+    params = sorted(parse_qsl(query, keep_blank_values=False))
+    canonical = f"{service}/{unquote(path)}?{urlencode(params)}"
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def byte_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """The first and last byte a `Range` header asks for of `size`, or None for all of them.
+
+    Only a single range is served; for several, the whole asset is, as HTTP allows.
+
+    Raises:
+        HTTPException: 416 if the range starts past the end.
+    """
+    match = _RANGE.match(header.strip()) if header else None
+    if match is None or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:  # the last bytes
+        start, end = max(0, size - int(last)), size - 1
+    if start > end:
+        raise HTTPException(416, headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def _read(path: Path, start: int, length: int) -> bytes:
+    with path.open("rb") as file:
+        file.seek(start)
+        return file.read(length)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    collapsed: int = 0  # requests that waited for an identical one in flight
+    evictions: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses + self.collapsed
+        return (self.hits + self.collapsed) / requests if requests else 0.0
+
+
+@dataclass
+class _Entry:
+    size: int
+    content_type: str
+
+
+@dataclass(eq=False)
+class Download:
+    """An asset being written to disk, which can be read as it arrives."""
+    path: Path  # where it ends up; it is written to the `.part` file next to it
+    content_type: str = "application/octet-stream"
+    size: int | None = None  # from the service's Content-Length, if it sent one
+    started: bool = False  # whether the service answered
+    received: int = 0  # bytes on disk
+    done: bool = False
+    error: HTTPException | None = None
+    _changed: asyncio.Condition = field(default_factory=asyncio.Condition, repr=False)
+
+    async def _update(self, **changes):
+        async with self._changed:
+            self.__dict__.update(changes)
+            self._changed.notify_all()
+
+    async def wait(self, received: int = 0):
+        """Wait until the service answered and `received` bytes are on disk, or all of them are.
+
+        Raises:
+            HTTPException: If the service failed.
+        """
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: self.error is not None or self.done or self.started and self.received >= received)
+        if self.error is not None:
+            raise self.error
+
+    async def finished(self) -> tuple[Path, str]:
+        """The file and content type once the whole asset is on disk."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.error is not None or self.done)
+        if self.error is not None:
+            raise self.error
+        return self.path, self.content_type
+
+    def _read(self, start: int, length: int) -> bytes:
+        with contextlib.suppress(FileNotFoundError):
+            return _read(self.path.with_suffix(".part"), start, length)
+        return _read(self.path, start, length)  # done meanwhile
+
+    async def chunks(self, start: int = 0, end: int | None = None) -> AsyncIterator[bytes]:
+        """Bytes `start` to `end` (exclusive, by default the last) of the asset, as they arrive."""
+        while end is None or start < end:
+            await self.wait(start + 1)
+            available = self.received if end is None else min(self.received, end)
+            if start >= available:  # the asset is shorter
+                return
+            data = await asyncio.to_thread(self._read, start, min(available - start, READ_CHUNK))
+            start += len(data)
+            yield data
+
+
+class MediaCache:
+    """An LRU map from cache keys to files, filled from the upstream services."""
+
+    def __init__(self, directory: Path = CACHE_DIR, max_bytes: int = MAX_BYTES, upstream: str = UPSTREAM):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.upstream = upstream.rstrip("/") + "/"
+        self.stats = CacheStats()
+        self._entries: OrderedDict[str, _Entry] | None = None
+        self._inflight: dict[str, Download] = {}
+        self._fills: set[asyncio.Task] = set()
+        self._client: httpx.AsyncClient | None = None
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def _load(self) -> OrderedDict[str, _Entry]:
+        """Index the files left by earlier runs, least recently used first."""
+        found = []
+        for meta in self.directory.glob("*/*.json"):
+            data = self._path(meta.stem)
+            try:
+                found.append((data.stat().st_mtime, meta.stem, _Entry(**json.loads(meta.read_text()))))
+            except (OSError, ValueError, TypeError):
+                meta.unlink(missing_ok=True)
+        return OrderedDict((key, entry) for _, key, entry in sorted(found))
+
+    async def _index(self) -> OrderedDict[str, _Entry]:
+        if self._entries is None:
+            entries = await asyncio.to_thread(self._load)
+            if self._entries is None:
+                self._entries = entries
+                self.stats.entries = len(entries)
+                self.stats.bytes = sum(entry.size for entry in entries.values())
+        return self._entries
+
+    async def get(self, service: str, path: str, query: str) -> tuple[Path, str]:
+        """The cached file and content type of a media request, fetching it if needed.
+
+        Raises:
+            HTTPException: If the upstream service failed.
+        """
+        asset = await self.open(service, path, query)
+        return await asset.finished() if isinstance(asset, Download) else asset
+
+    async def open(self, service: str, path: str, query: str) -> tuple[Path, str] | Download:
+        """Like `get`, but returns the `Download` of an asset still arriving once the service answered."""
+        entries = await self._index()
+        key = cache_key(service, path, query)
+        entry = entries.get(key)
+        if entry is not None:
+            entries.move_to_end(key)
+            self.stats.hits += 1
+            os.utime(self._path(key))  # keeps the LRU order across restarts
+            return self._path(key), entry.content_type
+        download = self._inflight.get(key)
+        if download is not None:
+            self.stats.collapsed += 1
+        else:
+            self.stats.misses += 1
+            download = self._inflight[key] = Download(self._path(key))
+            # The fill outlives requesters that hung up, so it is forgotten when it ends rather than by them.
+            fill = asyncio.ensure_future(self._fill(key, service, path, query, download))
+            self._fills.add(fill)
+            fill.add_done_callback(self._fills.discard)
+        await download.wait()
+        return (download.path, download.content_type) if download.done else download
+
+    async def _fill(self, key: str, service: str, path: str, query: str, download: Download):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=TIMEOUT)
+        url = f"{self.upstream}{service}/{quote(path, safe='/,')}" + (f"?{query}" if query else "")
+        file = None
+        try:
+            async with self._client.stream("GET", url) as response:
+                if response.status_code != 200:
+                    raise HTTPException(502, f"{service} answered {response.status_code}")
+                length = response.headers.get("content-length", "")
+                file = await asyncio.to_thread(self._create, key)
+                await download._update(
+                    content_type=response.headers.get("content-type", "application/octet-stream"),
+                    # Compressed, the length is not that of the bytes read.
+                    size=int(length) if length.isdigit() and "content-encoding" not in response.headers else None,
+                    started=True)
+                async for chunk in response.aiter_bytes():
+                    await asyncio.to_thread(file.write, chunk)
+                    await download._update(received=download.received + len(chunk))
+            await asyncio.to_thread(file.close)
+            entry = _Entry(download.received, download.content_type)
+            await asyncio.to_thread(self._commit, key, entry)
+            entries = await self._index()
+            entries[key] = entry
+            self.stats.entries += 1
+            self.stats.bytes += entry.size
+        except Exception as error:  # whatever went wrong, the requests waiting for it must not hang
+            if file is not None:
+                await asyncio.to_thread(self._discard, key, file)
+            if isinstance(error, httpx.HTTPError):
+                error = HTTPException(502, f"{service} is unreachable: {error}")
+            elif not isinstance(error, HTTPException):
+                logger.exception("caching %s failed", url)
+                error = HTTPException(502, f"{service} could not be cached")
+            await download._update(error=error)
+            return
+        finally:
+            self._inflight.pop(key, None)
+        await download._update(done=True)
+        await self._evict(keep=key)
+
+    def _create(self, key: str):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path.with_suffix(".part").open("wb", buffering=0)  # unbuffered: readers see every chunk written
+
+    def _commit(self, key: str, entry: _Entry):
+        path = self._path(key)
+        path.with_suffix(".part").replace(path)  # the cache never serves a half-written asset once restarted
+        path.with_suffix(".json").write_text(json.dumps(asdict(entry)))
+
+    def _discard(self, key: str, file):
+        with contextlib.suppress(OSError):
+            file.close()
+            self._path(key).with_suffix(".part").unlink(missing_ok=True)
+
+    async def _evict(self, keep: str):
+        entries = await self._index()
+        evicted = []
+        while self.stats.bytes > self.max_bytes and len(entries) > 1:
+            key, entry = next(iter(entries.items()))
+            if key == keep:
+                entries.move_to_end(key)
+                continue
+            del entries[key]
+            evicted.append(key)
+            self.stats.entries -= 1
+            self.stats.bytes -= entry.size
+            self.stats.evictions += 1
+        if evicted:
+            await asyncio.to_thread(self._remove, evicted)
+
+    def _remove(self, keys: list[str]):
+        for key in keys:
+            self._path(key).unlink(missing_ok=True)
+            self._path(key).with_suffix(".json").unlink(missing_ok=True)
+
+
+cache = MediaCache()
+
+
+async def serve_media(service: str, path: str, request: Request) -> Response:
+    """`GET /media/{service}/{path}`: a generated asset, or the byte range asked for, from the cache if possible."""
+    if service not in SERVICES:
+        raise HTTPException(404)
+    asset = await cache.open(service, path, request.url.query)
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "Accept-Ranges": "bytes"}
+    header = request.headers.get("range")
+    if isinstance(asset, Download) and asset.size is None and header:
+        asset = await asset.finished()  # a range needs the size of the asset
+    if isinstance(asset, Download):  # still arriving: served from the part on disk as it grows
+        span = byte_range(header, asset.size) if asset.size is not None else None
+        if span is None:
+            length = {"Content-Length": str(asset.size)} if asset.size is not None else {}
+            return StreamingResponse(asset.chunks(), media_type=asset.content_type, headers={**headers, **length})
+        start, end = span
+        return StreamingResponse(asset.chunks(start, end + 1), 206, media_type=asset.content_type,
+                                 headers={**headers, "Content-Length": str(end - start + 1),
+                                          "Content-Range": f"bytes {start}-{end}/{asset.size}"})
+    file, content_type = asset
+    size = file.stat().st_size
+    span = byte_range(header, size)
+    if span is None:
+        return FileResponse(file, media_type=content_type, headers=headers)
+    start, end = span
+    content = await asyncio.to_thread(_read, file, start, end - start + 1)
+    return Response(content, 206, media_type=content_type,
+                    headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}"})
+
+
+async def media_stats() -> dict:
+    """`GET /media-stats`: hit rate and size of the media cache, and keyword spellings collapsed."""
+    return {**asdict(cache.stats), "hit_rate": cache.stats.hit_rate, "keywords": collapse_stats()}
@@ -1,10 +1,21 @@
 """The home page of the app."""
 
+from functools import lru_cache
+from pathlib import Path
+
 from vnml import styles
 from vnml.templates import template
 
 import reflex as rx
 
+README = Path(__file__).parent.parent.parent / "README.md"
+
+
+@lru_cache(maxsize=1)
+def readme() -> str:
+    """README.md, read once per worker."""
+    return README.read_text(encoding="utf-8")
+
 
 @template(route="/", title="Home")
 def index() -> rx.Component:
@@ -13,6 +24,4 @@ def index() -> rx.Component:
     Returns:
         The UI for the home page.
     """
-    with open("README.md", encoding="utf-8") as readme:
-        content = readme.read()
-    return rx.markdown(content, component_map=styles.markdown_style)
+    return rx.markdown(readme(), component_map=styles.markdown_style)
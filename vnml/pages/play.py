@@ -3,8 +3,8 @@
 import reflex as rx
 
 from vnml.templates import template
-from vnml.components.playground import playground
-@template(route="/play", title="Play")
+from vnml.components.playground import DisplayState, playground
+@template(route="/play", title="Play", on_load=DisplayState.resume)
 def play() -> rx.Component:
     """The dashboard page.
 
@@ -0,0 +1,253 @@
+"""Incremental VNML parsing."""
+
+import re
+from dataclasses import dataclass, field
+from html import unescape
+from typing import Iterable, Iterator
+
+# Elements that are played back one at a time. Everything else (`<vnml>`,
+# `<dialogue>`, closing wrapper tags, code fences, comments) is structure only.
+FRAGMENT_TAGS = frozenset({"scene", "narration", "character", "options", "action"})
+
+_TAG_NAME = re.compile(r"<\s*([A-Za-z_][\w.-]*)")
+
+# What follows the "<" of a tag, a closing tag or a declaration; any other "<" is text, as in "a < b".
+_TAG_START = re.compile(r"[A-Za-z_/!]")
+
+_COMMENT_OPEN = "<!--"
+_COMMENT_CLOSE = "-->"
+
+_OUTSIDE = 0
+_OPEN_TAG = 1
+_ELEMENT = 2
+_COMMENT = 3
+
+
+class VNMLStreamParser:
+    """Push-based tokenizer that cuts raw LLM output into playable VNML fragments.
+
+    Feed it chunks of any size as they arrive; each complete fragment element
+    is returned as soon as its closing tag has been seen. Every byte is scanned
+    a bounded number of times, so the total cost is linear in the stream length
+    no matter how the chunks are split.
+    """
+
+    def __init__(self, tags: Iterable[str] = FRAGMENT_TAGS):
+        self.tags = frozenset(tags)
+        self._mode = _OUTSIDE
+        self._marker = ""  # the string that ends the current mode
+        self._pattern: re.Pattern | None = None  # matches the marker in any case, if it has letters
+        self._parts: list[str] = []  # raw pieces of the tag/element being collected
+        self._tail = ""  # last len(marker) - 1 chars, to catch a marker split across chunks
+        self._pending = ""  # a "<" at the end of the last chunk, maybe of an incomplete "<!--"
+        self._gap: list[str] = []  # raw text skipped since the last fragment
+
+    @property
+    def partial(self) -> str:
+        """The raw text of the element that is currently open, if any."""
+        if self._mode == _ELEMENT:
+            return "".join(self._parts)
+        return ""
+
+    def feed(self, chunk: str) -> list[str]:
+        """Consume a chunk of the stream.
+
+        Args:
+            chunk: The next piece of raw model output.
+
+        Returns:
+            The fragments completed by this chunk, in stream order.
+        """
+        return [fragment for _, fragment in self.feed_raw(chunk)]
+
+    def feed_raw(self, chunk: str) -> list[tuple[str, str]]:
+        """Like `feed`, but pair every fragment with the raw text skipped before it.
+
+        Joining the pairs gives back the stream exactly, up to the end of the
+        last fragment, which is what a byte-stable prompt needs.
+        """
+        fragments = []
+        data = self._pending + chunk
+        self._pending = ""
+        pos, end = 0, len(data)
+        while pos < end:
+            if self._mode == _OUTSIDE:
+                start = data.find("<", pos)
+                if start == -1:
+                    self._gap.append(data[pos:])
+                    break
+                self._gap.append(data[pos:start])
+                head = data[start:start + len(_COMMENT_OPEN)]
+                if head == _COMMENT_OPEN:
+                    self._enter(_COMMENT, _COMMENT_CLOSE, _COMMENT_OPEN)
+                    pos = start + len(_COMMENT_OPEN)
+                elif len(head) < len(_COMMENT_OPEN) and _COMMENT_OPEN.startswith(head):
+                    self._pending = head
+                    break
+                elif _TAG_START.match(data, start + 1):
+                    self._enter(_OPEN_TAG, ">", "<")
+                    pos = start + 1
+                else:
+                    self._gap.append("<")
+                    pos = start + 1
+            else:
+                pos = self._scan(data, pos, fragments)
+        return fragments
+
+    def close(self, keep: int, closing: str) -> list[tuple[str, str]]:
+        """End the element being written early, as `feed_raw` would have.
+
+        Args:
+            keep: How much of `partial` the fragment keeps.
+            closing: What it ends with instead of the rest, e.g. its closing tag.
+
+        Returns:
+            The fragment, or nothing if no element is open. Whatever the model
+            writes past it should not be fed.
+        """
+        fragments = []
+        if self._mode == _ELEMENT:
+            self._emit(self.partial[:keep] + closing, fragments)
+        return fragments
+
+    def _enter(self, mode: int, marker: str, *parts: str):
+        self._mode = mode
+        self._marker = marker
+        # Tag names are matched in any case, as in `decode_fragment`: `</Narration>` closes `<narration>`.
+        self._pattern = re.compile(re.escape(marker), re.I) if marker.lower() != marker.upper() else None
+        self._parts = list(parts)
+        self._tail = ""
+
+    def _scan(self, data: str, pos: int, fragments: list[tuple[str, str]]) -> int:
+        """Look for the end marker of the current mode, starting at `pos`."""
+        marker = self._marker
+        keep = len(marker) - 1
+        found = -1
+        if self._tail:
+            window = self._tail + data[pos:pos + keep]
+            index = self._find(window, 0)
+            if index != -1:
+                found = pos + index + len(marker) - len(self._tail)
+        if found == -1:
+            index = self._find(data, pos)
+            if index != -1:
+                found = index + len(marker)
+        if found == -1:
+            self._parts.append(data[pos:])
+            if keep:
+                self._tail = (self._tail + data[max(pos, len(data) - keep):])[-keep:]
+            return len(data)
+        self._parts.append(data[pos:found])
+        if self._mode == _OPEN_TAG:
+            self._open_tag_done(fragments)
+        elif self._mode == _ELEMENT:
+            self._emit("".join(self._parts), fragments)
+        else:
+            self._gap.extend(self._parts)
+            self._enter(_OUTSIDE, "")
+        return found
+
+    def _find(self, text: str, start: int) -> int:
+        if self._pattern is None:
+            return text.find(self._marker, start)
+        match = self._pattern.search(text, start)
+        return match.start() if match else -1
+
+    def _emit(self, fragment: str, fragments: list[tuple[str, str]]):
+        fragments.append(("".join(self._gap), fragment))
+        self._gap = []
+        self._enter(_OUTSIDE, "")
+
+    def _open_tag_done(self, fragments: list[tuple[str, str]]):
+        tag = "".join(self._parts)
+        match = _TAG_NAME.match(tag)
+        name = match.group(1).lower() if match else None
+        if name not in self.tags:
+            # Wrapper, closing or unknown tag: skip it and keep looking.
+            self._gap.append(tag)
+            self._enter(_OUTSIDE, "")
+        elif tag.endswith("/>"):
+            self._emit(tag, fragments)
+        else:
+            self._enter(_ELEMENT, f"</{name}>", tag)
+
+
+def tag_of(vnml: str) -> str:
+    """The name of the tag that `vnml` starts with, lowercase, or "" if it does not start with one."""
+    match = _TAG_NAME.match(vnml.lstrip())
+    return match.group(1).lower() if match else ""
+
+
+def stream_vnml_parser(vnml: Iterable[str]) -> Iterator[str]:
+    """Turn a stream of raw VNML chunks into a stream of complete fragments."""
+    parser = VNMLStreamParser()
+    for chunk in vnml:
+        yield from parser.feed(chunk)
+
+
+_COMMENTS = re.compile(r"<!--.*?-->", re.S)
+_ROOT = re.compile(r"\s*<\s*([A-Za-z_][\w.-]*)([^>]*?)(/?)>")
+_CHILD = re.compile(r"<\s*([A-Za-z_][\w.-]*)([^>]*?)(?:/>|>(.*?)</\s*\1\s*>)", re.S | re.I)
+_ATTRIBUTE = re.compile(r"""([^\s=/>]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+_MARKUP = re.compile(r"<[^>]*>")
+
+
+@dataclass
+class Fragment:
+    """A decoded VNML element: its tag, attributes, text and child elements."""
+    tag: str
+    attrs: dict[str, str] = field(default_factory=dict)
+    text: str = ""
+    children: list["Fragment"] = field(default_factory=list)
+
+    def find(self, tag: str) -> "Fragment | None":
+        return next((child for child in self.children if child.tag == tag), None)
+
+    def find_all(self, tag: str) -> list["Fragment"]:
+        return [child for child in self.children if child.tag == tag]
+
+
+def _attributes(source: str) -> dict[str, str]:
+    return {
+        match.group(1).lower(): unescape(match.group(2) or match.group(3) or match.group(4) or "")
+        for match in _ATTRIBUTE.finditer(source)
+    }
+
+
+def _text(source: str) -> str:
+    return unescape(_MARKUP.sub("", source))
+
+
+def decode_fragment(vnml: str) -> Fragment | None:
+    """Decode a single fragment as produced by `stream_vnml_parser`.
+
+    VNML fragments are at most two levels deep (`<scene>` holds `<background>`
+    and `<music>`, `<options>` holds `<title>` and `<option>`), so a couple of
+    pre-compiled patterns replace building a full document tree per line.
+
+    Args:
+        vnml: The raw fragment text.
+
+    Returns:
+        The decoded element, or None if the text does not start with a tag.
+    """
+    if "<!--" in vnml:
+        vnml = _COMMENTS.sub("", vnml)
+    root = _ROOT.match(vnml)
+    if root is None:
+        return None
+    tag = root.group(1).lower()
+    fragment = Fragment(tag, _attributes(root.group(2)))
+    if root.group(3):
+        return fragment
+    inner = vnml[root.end():]
+    close = inner.rfind("</")
+    if close != -1 and inner[close + 2:].strip(" \t\r\n>").lower() == tag:
+        inner = inner[:close]
+    fragment.text = _text(inner)
+    if "<" in inner:
+        fragment.children = [
+            Fragment(child.group(1).lower(), _attributes(child.group(2)), _text(child.group(3) or ""))
+            for child in _CHILD.finditer(inner)
+        ]
+    return fragment
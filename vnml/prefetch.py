@@ -0,0 +1,184 @@
+"""Server-side prefetching of the media of upcoming lines.
+
+Images, music and speech are generated on first request, which the browser
+only makes once a line is displayed. Requesting them from the backend as soon
+as the lines are known, a few lines ahead of the player, fills the media cache
+(see vnml.media_cache) so that clicking "->" is served from disk.
+
+Sprite sheets, every sprite of a character's look at once, are requested in
+the background: a service only starts one of them when no upcoming line is
+waiting for it.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+
+from vnml.compiler import media_urls
+from vnml.history import HistoryBuffer
+
+# Lines beyond the one on screen whose media are requested.
+LOOKAHEAD = int(os.environ.get("VNML_PREFETCH_LOOKAHEAD", "8"))
+
+# Requests in flight per media service, e.g. "image=1,music=1,speech=2". A GPU
+# service only runs one generation at a time, so more mostly adds queueing.
+CONCURRENCY = {
+    "image": 1,
+    "music": 1,
+    "speech": 2,
+    **{
+        service.strip(): int(limit)
+        for service, _, limit in (
+            item.partition("=") for item in os.environ.get("VNML_PREFETCH_CONCURRENCY", "").split(",") if item
+        )
+    },
+}
+
+# Where the backend reaches the media cache, if not at the origin the browser uses.
+ORIGIN = os.environ.get("VNML_PREFETCH_ORIGIN")
+
+MAX_URLS = 16384
+
+TIMEOUT = httpx.Timeout(300.0, connect=5.0)
+
+
+def service(url: str) -> str | None:
+    """The media service behind `url`, the first path segment naming one."""
+    return next((segment for segment in urlsplit(url).path.split("/") if segment in CONCURRENCY), None)
+
+
+class _Limit:
+    """A semaphore whose background waiters only get it when no other waiter wants it."""
+
+    def __init__(self, size: int):
+        self._free = size
+        self._waiters = (deque(), deque())  # the others, then the background ones
+
+    async def acquire(self, background: bool = False):
+        if self._free and not any(self._waiters):
+            self._free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[background].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # handed over just as it was cancelled
+            raise
+
+    def release(self):
+        for waiters in self._waiters:
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self._free += 1
+
+
+class MediaPrefetcher:
+    """Requests media URLs once each, with a concurrency limit per service."""
+
+    def __init__(self, lookahead: int = LOOKAHEAD, concurrency: dict[str, int] = CONCURRENCY,
+                 origin: str | None = ORIGIN):
+        self.lookahead = lookahead
+        self.origin = urlsplit(origin) if origin else None
+        self._limits = {name: _Limit(limit) for name, limit in concurrency.items()}
+        self._requested: OrderedDict[str, asyncio.Task] = OrderedDict()
+        self._sheets: set[asyncio.Task] = set()
+        self._client: httpx.AsyncClient | None = None
+        self.fetched = 0
+        self.failed = 0
+
+    def warm(self, history: HistoryBuffer, pointer: int):
+        """Prefetch the media of the `lookahead` diffs after `pointer`."""
+        urls = [
+            url
+            for index in range(pointer + 1, min(len(history), pointer + 1 + self.lookahead))
+            for url in media_urls(history[index]["do_log"])
+        ]
+        if urls:
+            self.prefetch(urls)
+
+    def prefetch(self, urls: list[str]):
+        """Request every URL not requested before, in order, without waiting for them."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        for url in urls:
+            if url in self._requested:
+                continue
+            limit = self._limits.get(service(url))
+            if limit is None:
+                continue
+            self._requested[url] = asyncio.create_task(self._fetch(url, limit))
+            if len(self._requested) > MAX_URLS:
+                self._requested.popitem(last=False)
+
+    def render_sheet(self, urls: list[str]):
+        """Request `urls`, e.g. `vnml.compiler.sprite_sheet`, one after another in the background.
+
+        Each is only requested once its service has nothing else to do, and
+        not at all if it was requested meanwhile.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        urls = [url for url in urls if url not in self._requested]
+        if urls:
+            task = asyncio.create_task(self._render(urls))
+            self._sheets.add(task)
+            task.add_done_callback(self._sheets.discard)
+
+    async def wait(self):
+        """Wait for every request in flight, and every sheet."""
+        await asyncio.gather(*list(self._sheets))
+        await asyncio.gather(*list(self._requested.values()))
+
+    def _target(self, url: str) -> str:
+        if self.origin is None:
+            return url
+        parts = urlsplit(url)
+        return urlunsplit((self.origin.scheme, self.origin.netloc, parts.path, parts.query, parts.fragment))
+
+    async def _render(self, urls: list[str]):
+        for url in urls:
+            limit = self._limits.get(service(url))
+            if limit is None or url in self._requested:
+                continue
+            await limit.acquire(background=True)
+            if url in self._requested:  # an upcoming line needed it first
+                limit.release()
+                continue
+            self._requested[url] = task = asyncio.create_task(self._fetch(url, limit, acquired=True))
+            if len(self._requested) > MAX_URLS:
+                self._requested.popitem(last=False)
+            await task
+
+    async def _fetch(self, url: str, limit: _Limit, acquired: bool = False):
+        if not acquired:
+            await limit.acquire()
+        try:
+            if self._client is None:
+                self._client = httpx.AsyncClient(timeout=TIMEOUT)
+            try:
+                # Read the whole body, so that a cache in between stores the complete asset.
+                async with self._client.stream("GET", self._target(url)) as response:
+                    async for _ in response.aiter_raw():
+                        pass
+                    response.raise_for_status()
+                self.fetched += 1
+            except httpx.HTTPError:
+                self.failed += 1
+                self._requested.pop(url, None)  # let a later warm-up try again
+        finally:
+            limit.release()
+
+
+prefetcher = MediaPrefetcher()
@@ -0,0 +1,302 @@
+"""Prompt assembly for continuing a story within a fixed token budget.
+
+Prompts are laid out so that consecutive turns of a session share the longest
+possible byte-identical prefix, which is what lets llama.cpp reuse a slot's KV
+cache instead of evaluating the whole story again:
+
+    syntax | ```vnml <vnml> | scene digests (append-only) | raw history | continue cue
+
+The history is kept exactly as the model wrote it, including the continue cue
+it was prompted with, so each prompt starts with the previous prompt and its
+completion. Only compacting old scenes into digests changes the prefix, and
+that is done in large steps so it happens rarely.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from weakref import WeakKeyDictionary
+
+from vnml.history import HistoryBuffer
+from vnml.llm import PARALLEL_SLOTS, complete, llm
+from vnml.parser import decode_fragment, tag_of
+from vnml.scheduler import Cancelled, Priority, scheduler
+
+# llama.cpp splits `-c 16384` evenly between its slots.
+SLOT_CONTEXT = 16384 // PARALLEL_SLOTS
+
+N_PREDICT = 2048
+
+PROMPT_BUDGET = SLOT_CONTEXT - N_PREDICT
+
+# Once over budget, old scenes are compacted until the prompt is back under this
+# share of it, which leaves room for several turns before the prefix changes again.
+LOW_WATER = 0.5
+
+SUMMARY_TOKENS = 160
+
+MAX_SUMMARIES = 4096
+
+CONTINUE = "\n<!-- Continue with new scene, dialogue, options, and action based on the chosen action -->\n<scene>\n"
+
+# A session resumed from the store starts with all but this many of its last
+# scenes folded into a character table, instead of reading its whole history
+# back and summarizing every scene before the first turn.
+RESUMED_RAW_SCENES = 2
+
+# The folded scenes summarized in the background, the newest first, to replace
+# the character table the next time the prompt is compacted anyway.
+RESUMED_DIGESTS = 8
+
+# Ends a turn whose dialogue reached its cap, see `vnml.compiler.MAX_LENGTH`.
+WRAP_UP = "\n</dialogue>\n<options>\n"
+
+
+@lru_cache(maxsize=1)
+def syntax() -> str:
+    """The syntax part of README.md, the fixed start of every prompt."""
+    with open(Path(__file__).parent.parent / "README.md", encoding="utf-8") as readme:
+        return readme.read().split("### Example")[0]
+
+
+@lru_cache(maxsize=16384)
+def count_tokens(text: str) -> int:
+    """Number of tokens the model's own tokenizer splits `text` into."""
+    return len(llm.client.tokenize(text)) if text else 0
+
+
+async def _count(texts: list[str]) -> list[int]:
+    return await asyncio.to_thread(lambda: [count_tokens(text) for text in texts])
+
+
+def header(lang: str) -> str:
+    return f'```vnml\n<vnml lang="{lang}">\n'
+
+
+@dataclass
+class SceneDigest:
+    """What is left of a scene once it has been compacted."""
+    summary: str
+    characters: dict[str, dict]
+
+    def render(self) -> str:
+        return self.summary + character_table([self])
+
+
+_digests: OrderedDict[str, asyncio.Future] = OrderedDict()
+
+
+def _scene_characters(fragments: list[str]) -> dict[str, dict]:
+    characters = {}
+    for vnml in fragments:
+        if tag_of(vnml) == "character":
+            attrs = decode_fragment(vnml).attrs
+            character = characters.setdefault(attrs.get("name"), {})
+            character.update({key: attrs[key] for key in ("identifier", "clothes") if attrs.get(key)})
+    return characters
+
+
+async def _digest(key: str, vnml: str, fragments: list[str], lang: str, session: str,
+                  priority: Priority) -> SceneDigest:
+    # Same start as the story prompts and the session's own slot, so the summary
+    # neither re-evaluates the syntax nor evicts another session's KV cache.
+    prompt = (f"{syntax()}{header(lang)}{vnml}\n"
+              f"<!-- Summary of the story above in {lang}, in at most three sentences, "
+              f"keeping names, places and unresolved threads:\n")
+    text = await scheduler.run(
+        lambda slot: complete(prompt, n_predict=SUMMARY_TOKENS, stop=["-->"], id_slot=slot, cache_prompt=True),
+        priority, session, key=key)
+    summary = " ".join(text.replace("--", "-").split())
+    return SceneDigest(f"<!-- Summary: {summary} -->\n", _scene_characters(fragments))
+
+
+def _digest_key(vnml: str, lang: str) -> str:
+    return hashlib.sha1(f"{lang}\0{vnml}".encode()).hexdigest()
+
+
+def summarized(fragments: list[str], lang: str) -> bool:
+    """Whether the digest of a scene is ready, i.e. `digest` returns it without waiting."""
+    future = _digests.get(_digest_key("".join(fragments), lang))
+    return future is not None and future.done() and not future.cancelled() and future.exception() is None
+
+
+async def digest(fragments: list[str], lang: str, session: str = '',
+                 priority: Priority = Priority.SUMMARY) -> SceneDigest:
+    """Summarize a scene, sharing the result between every session that has it.
+
+    Digests are keyed by the scene's text, so a scene is only summarized once
+    however many turns, replays or sessions include it. One still waiting for
+    a llama.cpp slot moves up to the `priority` of whoever needs it most.
+    """
+    vnml = "".join(fragments)
+    key = _digest_key(vnml, lang)
+    future = _digests.get(key)
+    started = future is None
+    if started:
+        future = _digests[key] = asyncio.ensure_future(_digest(key, vnml, fragments, lang, session, priority))
+        if len(_digests) > MAX_SUMMARIES:
+            _digests.popitem(last=False)
+    else:
+        _digests.move_to_end(key)
+        scheduler.promote(key, priority)
+    try:
+        return await asyncio.shield(future)
+    except Cancelled:
+        if _digests.get(key) is future:
+            del _digests[key]
+        if started:
+            raise
+        return await digest(fragments, lang, session, priority)  # the session that started it moved on
+    except Exception:
+        _digests.pop(key, None)
+        raise
+
+
+def character_table(digests: list[SceneDigest]) -> str:
+    """A comment listing the latest known look of every character in `digests`."""
+    characters = {}
+    for scene in digests:
+        for name, attrs in scene.characters.items():
+            characters.setdefault(name, {}).update(attrs)
+    if not characters:
+        return ""
+    lines = [
+        f'{name}: identifier="{attrs.get("identifier", "")}" clothes="{attrs.get("clothes", "")}"'
+        for name, attrs in characters.items()
+    ]
+    return "<!-- Characters:\n" + "\n".join(lines) + "\n-->\n"
+
+
+@dataclass
+class PromptLayout:
+    """Where a session's prompt switches from digests to raw history."""
+    compacted: int = 0  # leading scenes replaced by their digests
+    dropped: int = 0  # leading digests folded into a single character table
+    resumed: int = 0  # leading scenes folded without a digest, see `RESUMED_RAW_SCENES`
+
+
+_layouts: WeakKeyDictionary[HistoryBuffer, PromptLayout] = WeakKeyDictionary()
+
+
+def _layout(history: HistoryBuffer, scenes: list[tuple[int, int]], lang: str, session: str) -> PromptLayout:
+    layout = _layouts.get(history)
+    if layout is not None:
+        return layout
+    layout = _layouts[history] = PromptLayout()
+    if not history.loaded_from:
+        return layout
+    # Resumed from the store: keep the last scenes raw and take the looks of the
+    # characters of the others from the history, which does not read them back.
+    layout.compacted = layout.dropped = layout.resumed = max(0, len(scenes) - RESUMED_RAW_SCENES)
+
+    async def summarize():
+        summarized = scenes[max(0, layout.resumed - RESUMED_DIGESTS):layout.resumed]
+        await history.load(summarized[0][0])  # in a thread, rather than faulting the pages in on the loop
+        for scene in reversed(summarized):
+            with contextlib.suppress(Cancelled):
+                await digest([history.vnml_at(index) for index in range(*scene)], lang, session)
+
+    if layout.resumed:
+        asyncio.ensure_future(summarize())
+    return layout
+
+
+async def _unfold(history: HistoryBuffer, scenes: list[tuple[int, int]], layout: PromptLayout, lang: str):
+    """Give back their digests to the folded scenes of a resumed session summarized since."""
+    resumed = layout.resumed
+    while resumed > 0:
+        await history.load(scenes[resumed - 1][0])
+        if not summarized([history.vnml_at(index) for index in range(*scenes[resumed - 1])], lang):
+            break
+        resumed -= 1
+    if resumed < layout.resumed:
+        layout.resumed = layout.dropped = resumed
+
+
+async def build_prompt(history: HistoryBuffer, lang: str, budget: int = PROMPT_BUDGET, session: str = '',
+                       cue: str = CONTINUE, priority: Priority = Priority.INTERACTIVE) -> str:
+    """Build the continuation prompt for `history` in at most `budget` tokens.
+
+    While it fits, the prompt only ever grows at the end. When it no longer
+    does, the oldest raw scenes are replaced by LLM-written summaries plus the
+    looks of the characters they introduced, down to `LOW_WATER` of the budget.
+    If the digests alone grow too long, the oldest are folded into one
+    character table, and as a last resort the oldest raw lines are cut.
+
+    Args:
+        history: The session history, up to the point to continue from.
+        lang: The language of the story.
+        budget: The maximum number of prompt tokens.
+        session: The session the prompt is for, whose llama.cpp slot runs the summaries.
+        cue: What to end the prompt with; empty to resume a turn that was cut short.
+        priority: That of the turn, which its summaries get too.
+
+    Returns:
+        The prompt text.
+    """
+    scenes = history.scenes()
+    layout = _layout(history, scenes, lang, session)
+    # A replayed choice may have truncated the history below the compacted scenes.
+    layout.compacted = min(layout.compacted, max(0, len(scenes) - 1))
+    layout.dropped = min(layout.dropped, layout.compacted)
+    layout.resumed = min(layout.resumed, layout.dropped)
+
+    def fragments(scene: tuple[int, int]) -> list[str]:
+        return [history.vnml_at(index) for index in range(*scene)]
+
+    async def compacted() -> list[SceneDigest]:
+        """The digests of the compacted scenes; the resumed ones share one, with only their characters."""
+        if scenes:
+            await history.load(scenes[layout.resumed][0])
+        digests = [await digest(fragments(scene), lang, session, priority)
+                   for scene in scenes[layout.resumed:layout.compacted]]
+        if not layout.resumed:
+            return digests
+        state = history.state_at(scenes[layout.resumed][0] - 1)
+        return [SceneDigest("", state.get("characters") or {}), *digests]
+
+    def offset() -> int:
+        """The index in `digests` minus that of the scene."""
+        return 1 - layout.resumed if layout.resumed else 0
+
+    digests = await compacted()
+    start = scenes[layout.compacted][0] if scenes else 0
+    raw = [history.gap_at(index) + history.vnml_at(index) for index in range(start, len(history))]
+    raw_tokens = await _count(raw)
+    fixed, = await _count([syntax() + header(lang) + cue])
+
+    async def total() -> int:
+        counts = await _count([
+            character_table(digests[:layout.dropped + offset()]),
+            *(scene.render() for scene in digests[layout.dropped + offset():]),
+        ])
+        return fixed + sum(counts) + sum(raw_tokens)
+
+    if await total() > budget:
+        if layout.resumed:  # the prefix changes anyway: bring back the summaries made since
+            await _unfold(history, scenes, layout, lang)
+            digests = await compacted()
+        while layout.compacted < len(scenes) - 1 and await total() > budget * LOW_WATER:
+            scene = scenes[layout.compacted]
+            digests.append(await digest(fragments(scene), lang, session, priority))
+            compacted = scene[1] - scene[0]
+            raw, raw_tokens = raw[compacted:], raw_tokens[compacted:]
+            layout.compacted += 1
+        # Folding digests only helps reach the low-water mark if the raw scenes leave room for it.
+        target = budget * LOW_WATER if fixed + sum(raw_tokens) < budget * LOW_WATER else budget
+        while layout.dropped + offset() < len(digests) and await total() > target:
+            layout.dropped += 1
+    while len(raw) > 1 and await total() > budget:
+        raw, raw_tokens = raw[1:], raw_tokens[1:]
+    return "".join([
+        syntax(),
+        header(lang),
+        character_table(digests[:layout.dropped + offset()]),
+        *(scene.render() for scene in digests[layout.dropped + offset():]),
+        *raw,
+        cue,
+    ])
@@ -0,0 +1,328 @@
+"""Scheduling of the work sent to the llama.cpp slots.
+
+llama.cpp runs `--parallel` completions at a time and queues the rest in the
+order they arrive, so a player waiting for the next line could sit behind the
+speculative branches and scene summaries of every other session. Every
+completion goes through the `Scheduler` instead, which only sends as many as
+there are slots, and picks the next one by priority, then by player:
+
+- a player waiting for their turn goes before speculative branches, which go
+  before summaries;
+- among equals, the player with the fewest completions running goes first;
+- a completion identical to one waiting or running joins it rather than
+  running twice, e.g. every new story of a language starts the same way;
+- the work of a session that moved on or disconnected is dropped.
+"""
+
+import asyncio
+import contextlib
+import itertools
+import os
+import statistics
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable
+
+from vnml.llm import PARALLEL_SLOTS, slots
+
+# Completions waiting for a slot across players before asking for one more waits.
+MAX_QUEUED = int(os.environ.get("VNML_GENERATION_QUEUE", "64"))
+
+# Completions one player may have waiting: a turn, the speculative branches of its options, a summary.
+MAX_QUEUED_PER_PLAYER = int(os.environ.get("VNML_GENERATION_QUEUE_PER_PLAYER", "6"))
+
+# How long a player may be disconnected, e.g. reloading the page, before their work is dropped.
+DISCONNECT_GRACE = float(os.environ.get("VNML_DISCONNECT_GRACE", "15"))
+
+SWEEP_INTERVAL = 1.0
+
+# Waits kept per priority for the percentiles in `report`.
+RECENT_WAITS = 1024
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # a player is waiting for it
+    SPECULATIVE = 1  # the branches of options that may never be chosen
+    SUMMARY = 2  # scene digests ahead of the prompts that need them
+
+
+class Cancelled(Exception):
+    """The work was dropped: its session moved on or disconnected."""
+
+
+def player(session: str) -> str:
+    """Whose work it is: speculative branches run as `<session>/<option>`."""
+    return session.partition("/")[0]
+
+
+@dataclass(eq=False)
+class _Subscriber:
+    session: str
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+    cancelled: bool = False
+
+
+@dataclass(eq=False)
+class _Job:
+    work: Callable[[int], AsyncIterator]
+    priority: Priority
+    session: str
+    key: Hashable | None
+    order: int
+    queued_at: float = field(default_factory=time.perf_counter)
+    subscribers: list[_Subscriber] = field(default_factory=list)
+    items: list = field(default_factory=list)
+    error: Exception | None = None
+    finished: bool = False
+    slot: int | None = None
+    task: asyncio.Task | None = None
+
+    def notify(self):
+        for subscriber in self.subscribers:
+            subscriber.changed.set()
+
+
+@dataclass
+class SchedulerStats:
+    submitted: int = 0
+    merged: int = 0  # requests that joined an identical one
+    completed: int = 0
+    failed: int = 0
+    cancelled: int = 0  # started or not, dropped because nobody wanted them anymore
+    waits: dict[str, deque] = field(default_factory=lambda: {
+        priority.name.lower(): deque(maxlen=RECENT_WAITS) for priority in Priority
+    })
+
+
+class Scheduler:
+    """Hands the llama.cpp slots to the completions that need them most.
+
+    Work is a function of the slot it runs on that returns an async iterator,
+    e.g. of tokens; `stream` gives every caller its own iterator over the
+    items, and `run` the single result of work that has one.
+    """
+
+    def __init__(self, parallel: int = PARALLEL_SLOTS, max_queued: int = MAX_QUEUED,
+                 max_queued_per_player: int = MAX_QUEUED_PER_PLAYER):
+        self.parallel = parallel
+        self.max_queued = max_queued
+        self.max_queued_per_player = max_queued_per_player
+        # Whether a player is still connected; unknown players are, see `vnml.vnml`.
+        self.connected: Callable[[str], bool] | None = None
+        self.stats = SchedulerStats()
+        self._waiting: list[_Job] = []
+        self._running: list[_Job] = []
+        self._keys: dict[Hashable, _Job] = {}
+        self._room: deque[asyncio.Future] = deque()
+        self._order = itertools.count()
+        self._gone: dict[str, float] = {}
+        self._sweeper: asyncio.Task | None = None
+
+    async def stream(self, work: Callable[[int], AsyncIterator], priority: Priority, session: str,
+                     key: Hashable | None = None) -> AsyncIterator:
+        """The items of `work`, once it gets a slot.
+
+        Waits while the waiting room, or the player's share of it, is full.
+        Closing the iterator early gives up the work, unless another caller
+        joined it. If the session is dropped, the items just stop, which
+        leaves a turn cut short, to be picked up where it stopped.
+
+        Args:
+            work: Called with the slot to run on, returns the items.
+            priority: How urgent the work is.
+            session: The session the work is for.
+            key: Identifies the work, so that identical requests run once. The
+                work of the first one runs, and they all get its items.
+        """
+        self._watch()
+        self.stats.submitted += 1
+        job = self._join(key, priority)
+        if job is None:
+            await self._admit(player(session))
+            job = self._join(key, priority)  # an identical request may have come in meanwhile
+        if job is None:
+            job = _Job(work, priority, session, key, next(self._order))
+            if key is not None:
+                self._keys[key] = job
+            self._waiting.append(job)
+        subscriber = _Subscriber(session)
+        job.subscribers.append(subscriber)
+        self._dispatch()
+        try:
+            index = 0
+            while True:
+                while index < len(job.items) and not subscriber.cancelled:
+                    yield job.items[index]
+                    index += 1
+                if subscriber.cancelled:
+                    return
+                if job.finished:
+                    if job.error is not None:
+                        raise job.error
+                    return
+                subscriber.changed.clear()
+                await subscriber.changed.wait()
+        finally:
+            self._leave(job, subscriber)
+
+    async def run(self, work: Callable[[int], Awaitable[Any]], priority: Priority, session: str,
+                  key: Hashable | None = None) -> Any:
+        """The result of `work`, once it gets a slot; see `stream`.
+
+        Raises:
+            Cancelled: If the session was dropped first.
+        """
+        async def once(slot: int) -> AsyncIterator:
+            yield await work(slot)
+
+        async with contextlib.aclosing(self.stream(once, priority, session, key)) as results:
+            async for result in results:
+                return result
+        raise Cancelled(session)
+
+    def promote(self, key: Hashable, priority: Priority):
+        """Raise the priority of the work of `key`, e.g. once a player waits for it."""
+        job = self._keys.get(key)
+        if job is not None:
+            job.priority = min(job.priority, priority)
+
+    def promote_session(self, session: str, priority: Priority):
+        """Raise the priority of the work `session` waits for, e.g. the speculative branch a player chose."""
+        for job in [*self._waiting, *self._running]:
+            if any(subscriber.session == session for subscriber in job.subscribers):
+                job.priority = min(job.priority, priority)
+
+    def cancel(self, session: str, branches: bool = True):
+        """Drop the work of a player that moved on: its session and, unless told not to, speculative branches."""
+        for job in [*self._waiting, *self._running]:
+            for subscriber in list(job.subscribers):
+                if subscriber.session == session or branches and player(subscriber.session) == session:
+                    subscriber.cancelled = True
+                    subscriber.changed.set()
+                    self._leave(job, subscriber)
+
+    def report(self) -> dict:
+        """Queue depth, running work and recent waits for a slot, by priority."""
+        queued, running = Counter(job.priority for job in self._waiting), Counter(job.priority for job in self._running)
+        waits = {}
+        for name, recent in self.stats.waits.items():
+            ordered = sorted(recent)
+            waits[name] = {
+                "count": len(ordered),
+                "p50_ms": ordered[len(ordered) // 2] * 1e3 if ordered else 0.0,
+                "p95_ms": ordered[int(len(ordered) * 0.95)] * 1e3 if ordered else 0.0,
+                "max_ms": ordered[-1] * 1e3 if ordered else 0.0,
+                "mean_ms": statistics.fmean(ordered) * 1e3 if ordered else 0.0,
+            }
+        return {
+            "slots": self.parallel,
+            "queued": {priority.name.lower(): queued[priority] for priority in Priority},
+            "running": {priority.name.lower(): running[priority] for priority in Priority},
+            "wait": waits,
+            **{key: value for key, value in self.stats.__dict__.items() if key != "waits"},
+        }
+
+    def _join(self, key: Hashable | None, priority: Priority) -> _Job | None:
+        job = self._keys.get(key) if key is not None else None
+        if job is not None:
+            self.stats.merged += 1
+            self.promote(key, priority)
+        return job
+
+    async def _admit(self, owner: str):
+        while (len(self._waiting) >= self.max_queued
+               or sum(player(job.session) == owner for job in self._waiting) >= self.max_queued_per_player):
+            room = asyncio.get_running_loop().create_future()
+            self._room.append(room)
+            await room
+
+    def _dispatch(self):
+        while self._waiting and len(self._running) < self.parallel:
+            running = Counter(player(job.session) for job in self._running)
+            job = min(self._waiting, key=lambda job: (job.priority, running[player(job.session)], job.order))
+            self._waiting.remove(job)
+            busy = {running.slot for running in self._running}
+            job.slot = slots.slot(job.session, free=[slot for slot in range(self.parallel) if slot not in busy])
+            self._running.append(job)
+            self.stats.waits[job.priority.name.lower()].append(time.perf_counter() - job.queued_at)
+            job.task = asyncio.create_task(self._produce(job))
+        self._make_room()
+
+    def _make_room(self):
+        while self._room:
+            room = self._room.popleft()
+            if not room.done():
+                room.set_result(None)
+
+    async def _produce(self, job: _Job):
+        try:
+            async with contextlib.aclosing(job.work(job.slot)) as items:
+                async for item in items:
+                    job.items.append(item)
+                    job.notify()
+            self.stats.completed += 1
+        except asyncio.CancelledError:
+            pass  # see `_leave`
+        except Exception as exception:
+            job.error = exception
+            self.stats.failed += 1
+        finally:
+            self._finish(job)
+
+    def _finish(self, job: _Job):
+        if job.finished:
+            return
+        job.finished = True
+        self._running.remove(job)
+        self._forget(job)
+        job.notify()
+        self._dispatch()
+
+    def _leave(self, job: _Job, subscriber: _Subscriber):
+        if subscriber not in job.subscribers:
+            return
+        job.subscribers.remove(subscriber)
+        if job.subscribers or job.finished:
+            return
+        self.stats.cancelled += 1
+        self._forget(job)
+        if job.task is not None:
+            job.task.cancel()  # even if it never got to run
+            self._finish(job)
+        else:
+            self._waiting.remove(job)
+            self._make_room()
+
+    def _forget(self, job: _Job):
+        if job.key is not None and self._keys.get(job.key) is job:
+            del self._keys[job.key]
+
+    def _watch(self):
+        if self.connected is None:
+            return
+        if self._sweeper is None or self._sweeper.done() or self._sweeper.get_loop() is not asyncio.get_running_loop():
+            self._sweeper = asyncio.create_task(self._sweep())
+
+    async def _sweep(self):
+        """Drop the work of players disconnected for longer than `DISCONNECT_GRACE`."""
+        while self._waiting or self._running:
+            now = time.monotonic()
+            players = {player(subscriber.session)
+                       for job in [*self._waiting, *self._running] for subscriber in job.subscribers}
+            self._gone = {owner: since for owner, since in self._gone.items() if owner in players}
+            for owner in players:
+                if self.connected(owner):
+                    self._gone.pop(owner, None)
+                elif now - self._gone.setdefault(owner, now) >= DISCONNECT_GRACE:
+                    self.cancel(owner)
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+
+scheduler = Scheduler()
+
+
+async def scheduler_stats() -> dict:
+    """`GET /scheduler-stats`: queue depth, running work and waits for a llama.cpp slot."""
+    return scheduler.report()
@@ -0,0 +1,176 @@
+"""Speculative generation of option branches while the player reads.
+
+As soon as a turn ends with `<options>`, the opening lines of every option can
+be generated ahead of time, so that choosing one does not wait for a whole LLM
+turn. This is opt-in (`VNML_SPECULATE=1`) because most of that work is thrown
+away: only the chosen branch is kept, the others are cancelled.
+"""
+
+import asyncio
+import contextlib
+import logging
+import os
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Hashable
+
+import httpx
+
+from vnml.history import MAX_SESSIONS
+from vnml.scheduler import Cancelled, Priority, scheduler
+
+SPECULATE = os.environ.get("VNML_SPECULATE", "0").lower() in ("1", "true", "yes")
+
+# Branches generated at the same time across all sessions. Keep it below the
+# number of llama.cpp slots, or speculation evicts the KV cache of live turns.
+MAX_CONCURRENT_BRANCHES = int(os.environ.get("VNML_SPECULATION_CONCURRENCY", "2"))
+
+# Fragments generated ahead per branch; the rest is generated once chosen.
+BRANCH_LINES = int(os.environ.get("VNML_SPECULATION_LINES", "6"))
+
+logger = logging.getLogger(__name__)
+
+
+class Branch:
+    """The continuation of the story after one option, generated in the background."""
+
+    def __init__(self, option: str, session: str):
+        self.option = option
+        self.session = session  # what its work runs as, see `vnml.scheduler.player`
+        self.diffs: list[dict] = []
+        self.finished = False
+        self._changed = asyncio.Event()
+        self._budget: asyncio.Semaphore | None = None  # while it counts towards `MAX_CONCURRENT_BRANCHES`
+        self._promoted = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    async def _run(self, generate: Callable[[str], AsyncIterator[dict]], budget: asyncio.Semaphore, lines: int):
+        try:
+            await self._acquire(budget)
+            async with contextlib.aclosing(generate(self.session)) as diffs:
+                async for diff in diffs:
+                    self.diffs.append(diff)
+                    self._changed.set()
+                    if len(self.diffs) >= lines:
+                        break
+        except (Cancelled, httpx.HTTPError):
+            pass  # whatever was generated is still good; the rest is generated on demand
+        except Exception:
+            logger.exception("speculating option %r failed", self.option)
+        finally:
+            self._release()
+            self.finished = True
+            self._changed.set()
+
+    async def _acquire(self, budget: asyncio.Semaphore):
+        """Wait for room in the speculation budget, unless the branch is chosen first."""
+        acquired = asyncio.ensure_future(budget.acquire())
+        promoted = asyncio.ensure_future(self._promoted.wait())
+        try:
+            await asyncio.wait((acquired, promoted), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            promoted.cancel()
+            acquired.cancel()
+            if acquired.done() and not acquired.cancelled():
+                self._budget = budget
+        if self._promoted.is_set():
+            self._release()
+
+    def _release(self):
+        if self._budget is not None:
+            self._budget.release()
+            self._budget = None
+
+    def promote(self):
+        """Generate the rest of the branch as a player's turn, now that it was chosen.
+
+        It stops counting towards `MAX_CONCURRENT_BRANCHES`, and the completion
+        it waits for goes before speculative ones.
+        """
+        self._promoted.set()
+        self._release()
+        scheduler.promote_session(self.session, Priority.INTERACTIVE)
+
+    async def follow(self) -> AsyncIterator[dict]:
+        """Every diff of the branch, waiting for those still being generated."""
+        index = 0
+        while True:
+            while index < len(self.diffs):
+                yield self.diffs[index]
+                index += 1
+            if self.finished:
+                return
+            self._changed.clear()
+            await self._changed.wait()
+
+    def cancel(self):
+        if self.task is not None and not self.finished:
+            self.task.cancel()
+
+
+class BranchCache:
+    """The speculative branches of every session.
+
+    A session has at most one set of branches, for the options it is currently
+    at, identified by a `key` chosen by the caller. Choosing an option keeps
+    that branch for the session to pick up and cancels all the others.
+    """
+
+    def __init__(self, concurrency: int = MAX_CONCURRENT_BRANCHES, lines: int = BRANCH_LINES):
+        self.lines = lines
+        self._budget = asyncio.Semaphore(concurrency)
+        self._pending: OrderedDict[str, tuple[Hashable, dict[str, Branch]]] = OrderedDict()
+        self._chosen: dict[str, Branch] = {}
+
+    def speculate(self, session: str, key: Hashable, branches: dict[str, Callable[[str], AsyncIterator[dict]]]):
+        """Start generating a branch per option, replacing any earlier ones.
+
+        Args:
+            session: The session the options belong to.
+            key: Identifies the options, so a stale choice is never served.
+            branches: For every option, a function of the session to run it as,
+                returning its diffs.
+        """
+        self.discard(session)
+        started = {}
+        for index, (option, generate) in enumerate(branches.items()):
+            branch = started[option] = Branch(option, f"{session}/{index}")
+            branch.task = asyncio.create_task(branch._run(generate, self._budget, self.lines))
+        self._pending[session] = (key, started)
+        if len(self._pending) > MAX_SESSIONS:
+            _, (_, oldest) = self._pending.popitem(last=False)
+            for branch in oldest.values():
+                branch.cancel()
+
+    def choose(self, session: str, key: Hashable, option: str) -> bool:
+        """Keep the branch of `option` for `adopted`, promoted to a player's turn, and cancel the rest.
+
+        Returns:
+            Whether there was a branch for it.
+        """
+        stale = self._chosen.pop(session, None)
+        if stale is not None:
+            stale.cancel()
+        pending_key, branches = self._pending.pop(session, (None, {}))
+        chosen = branches.pop(option, None) if pending_key == key else None
+        for branch in branches.values():
+            branch.cancel()
+        if chosen is not None:
+            chosen.promote()
+            self._chosen[session] = chosen
+        return chosen is not None
+
+    def adopted(self, session: str) -> Branch | None:
+        """The branch the session chose, handed out once."""
+        return self._chosen.pop(session, None)
+
+    def discard(self, session: str):
+        """Cancel whatever is being generated for the session."""
+        _, branches = self._pending.pop(session, (None, {}))
+        for branch in branches.values():
+            branch.cancel()
+        chosen = self._chosen.pop(session, None)
+        if chosen is not None:
+            chosen.cancel()
+
+
+branches = BranchCache()
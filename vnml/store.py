@@ -0,0 +1,420 @@
+"""Persistent sessions: the history, position and save slots of every story.
+
+Histories are written append-only, one record per diff, by a background
+thread that commits everything queued since its last commit as one batch, so
+the event loop never waits for the disk. A session that is not in memory,
+after a restart or on another worker, is read back with only its newest page
+of diffs; older pages are read when the story is scrolled or summarized back
+to them (see `HistoryBuffer.paged`).
+
+`VNML_STORE` picks the backend: `sqlite:///<path>` (the default),
+`redis://...` or `mongodb://...`, the last two needing the `redis` or
+`pymongo` package.
+"""
+
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from vnml.history import KEYFRAME_INTERVAL, HistoryBuffer, drop_history
+
+STORE_URL = os.environ.get("VNML_STORE", "sqlite:///data/sessions.db")
+
+# Seconds between two commits of the queued writes.
+FLUSH_INTERVAL = float(os.environ.get("VNML_STORE_FLUSH_INTERVAL", "0.5"))
+
+logger = logging.getLogger(__name__)
+
+
+def slot_key(session: str, name: str) -> str:
+    """Where the copy of `session` saved as `name` is stored."""
+    return f"{session}#{name}"
+
+
+class SQLiteBackend:
+    """Sessions in a SQLite file; each thread reads through its own connection."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS diffs (
+            session TEXT, idx INTEGER, data TEXT, scene INTEGER, PRIMARY KEY (session, idx)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS keyframes (
+            session TEXT, idx INTEGER, state TEXT, PRIMARY KEY (session, idx)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS sessions (session TEXT PRIMARY KEY, meta TEXT);
+        CREATE TABLE IF NOT EXISTS slots (session TEXT, name TEXT, meta TEXT, PRIMARY KEY (session, name));
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._db.executescript(self.SCHEMA)
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def write(self, ops: list[tuple]):
+        db = self._db
+        db.execute("BEGIN")
+        try:
+            for kind, *args in ops:
+                getattr(self, f"_{kind}")(db, *args)
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _append(self, db, session: str, index: int, data: str, scene: bool):
+        db.execute("INSERT OR REPLACE INTO diffs VALUES (?, ?, ?, ?)", (session, index, data, scene))
+
+    def _keyframe(self, db, session: str, length: int, state: str):
+        db.execute("INSERT OR REPLACE INTO keyframes VALUES (?, ?, ?)", (session, length, state))
+
+    def _truncate(self, db, session: str, length: int):
+        db.execute("DELETE FROM diffs WHERE session = ? AND idx >= ?", (session, length))
+        db.execute("DELETE FROM keyframes WHERE session = ? AND idx > ?", (session, length))
+
+    def _meta(self, db, session: str, meta: str):
+        db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?)", (session, meta))
+
+    def _copy(self, db, source: str, target: str):
+        for table, columns in (("diffs", "idx, data, scene"), ("keyframes", "idx, state"), ("sessions", "meta")):
+            db.execute(f"DELETE FROM {table} WHERE session = ?", (target,))
+            db.execute(f"INSERT INTO {table} SELECT ?, {columns} FROM {table} WHERE session = ?", (target, source))
+
+    def _save_slot(self, db, session: str, name: str, meta: str):
+        self._copy(db, session, slot_key(session, name))
+        db.execute("INSERT OR REPLACE INTO slots VALUES (?, ?, ?)", (session, name, meta))
+
+    def _load_slot(self, db, session: str, name: str):
+        self._copy(db, slot_key(session, name), session)
+
+    def length(self, session: str) -> int:
+        row = self._db.execute("SELECT MAX(idx) FROM diffs WHERE session = ?", (session,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def diffs(self, session: str, start: int, stop: int) -> list[str]:
+        rows = self._db.execute("SELECT data FROM diffs WHERE session = ? AND idx >= ? AND idx < ? ORDER BY idx",
+                                (session, start, stop))
+        return [data for data, in rows]
+
+    def scene_starts(self, session: str) -> list[int]:
+        rows = self._db.execute("SELECT idx FROM diffs WHERE session = ? AND scene ORDER BY idx", (session,))
+        return [index for index, in rows]
+
+    def keyframe(self, session: str, length: int) -> str | None:
+        row = self._db.execute("SELECT state FROM keyframes WHERE session = ? AND idx = ?",
+                               (session, length)).fetchone()
+        return row and row[0]
+
+    def meta(self, session: str) -> str | None:
+        row = self._db.execute("SELECT meta FROM sessions WHERE session = ?", (session,)).fetchone()
+        return row and row[0]
+
+    def slots(self, session: str) -> dict[str, str]:
+        return dict(self._db.execute("SELECT name, meta FROM slots WHERE session = ?", (session,)))
+
+
+class RedisBackend:
+    """Sessions in Redis: per session, a list of diffs, a list of keyframes and a sorted set of scenes.
+
+    Keyframes are written in order, one every `KEYFRAME_INTERVAL` diffs, so the
+    one after `length` diffs is at `length // KEYFRAME_INTERVAL - 1`.
+    """
+
+    def __init__(self, url: str):
+        import redis
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    @staticmethod
+    def _keys(session: str) -> dict[str, str]:
+        return {kind: f"vnml:{session}:{kind}" for kind in ("diffs", "keyframes", "scenes", "meta")}
+
+    def write(self, ops: list[tuple]):
+        pipe = self._redis.pipeline(transaction=True)
+        for kind, *args in ops:
+            getattr(self, f"_{kind}")(pipe, *args)
+        pipe.execute()
+
+    def _append(self, pipe, session: str, index: int, data: str, scene: bool):
+        keys = self._keys(session)
+        pipe.rpush(keys["diffs"], data)
+        if scene:
+            pipe.zadd(keys["scenes"], {str(index): index})
+
+    def _keyframe(self, pipe, session: str, length: int, state: str):
+        pipe.rpush(self._keys(session)["keyframes"], state)
+
+    def _truncate(self, pipe, session: str, length: int):
+        keys = self._keys(session)
+        for key, kept in ((keys["diffs"], length), (keys["keyframes"], length // KEYFRAME_INTERVAL)):
+            if kept:
+                pipe.ltrim(key, 0, kept - 1)
+            else:  # LTRIM to -1 would keep the whole list
+                pipe.delete(key)
+        pipe.zremrangebyscore(keys["scenes"], length, "+inf")
+
+    def _meta(self, pipe, session: str, meta: str):
+        pipe.set(self._keys(session)["meta"], meta)
+
+    def _copy(self, pipe, source: str, target: str):
+        for kind, key in self._keys(target).items():
+            pipe.delete(key)
+            pipe.copy(self._keys(source)[kind], key)
+
+    def _save_slot(self, pipe, session: str, name: str, meta: str):
+        self._copy(pipe, session, slot_key(session, name))
+        pipe.hset(f"vnml:{session}:slots", name, meta)
+
+    def _load_slot(self, pipe, session: str, name: str):
+        self._copy(pipe, slot_key(session, name), session)
+
+    def length(self, session: str) -> int:
+        return self._redis.llen(self._keys(session)["diffs"])
+
+    def diffs(self, session: str, start: int, stop: int) -> list[str]:
+        return self._redis.lrange(self._keys(session)["diffs"], start, stop - 1) if stop > start else []
+
+    def scene_starts(self, session: str) -> list[int]:
+        return [int(index) for index in self._redis.zrange(self._keys(session)["scenes"], 0, -1)]
+
+    def keyframe(self, session: str, length: int) -> str | None:
+        return self._redis.lindex(self._keys(session)["keyframes"], length // KEYFRAME_INTERVAL - 1)
+
+    def meta(self, session: str) -> str | None:
+        return self._redis.get(self._keys(session)["meta"])
+
+    def slots(self, session: str) -> dict[str, str]:
+        return self._redis.hgetall(f"vnml:{session}:slots")
+
+
+class MongoBackend:
+    """Sessions in MongoDB, e.g. the `text-mongo` service of docker-compose.yml.
+
+    Consecutive appends are sent as one `insert_many`.
+    """
+
+    def __init__(self, url: str):
+        import pymongo
+        database = pymongo.MongoClient(url).get_default_database("vnml")
+        self._diffs, self._keyframes = database["diffs"], database["keyframes"]
+        self._sessions, self._slots = database["sessions"], database["slots"]
+        self._diffs.create_index([("session", 1), ("index", 1)], unique=True)
+        self._keyframes.create_index([("session", 1), ("index", 1)], unique=True)
+        self._slots.create_index([("session", 1), ("name", 1)], unique=True)
+
+    def write(self, ops: list[tuple]):
+        appends = []
+        for kind, *args in ops:
+            if kind == "append":
+                session, index, data, scene = args
+                appends.append({"session": session, "index": index, "data": data, "scene": scene})
+                continue
+            if appends:
+                self._diffs.insert_many(appends, ordered=True)
+                appends = []
+            getattr(self, f"_{kind}")(*args)
+        if appends:
+            self._diffs.insert_many(appends, ordered=True)
+
+    def _keyframe(self, session: str, length: int, state: str):
+        self._keyframes.replace_one({"session": session, "index": length},
+                                    {"session": session, "index": length, "state": state}, upsert=True)
+
+    def _truncate(self, session: str, length: int):
+        self._diffs.delete_many({"session": session, "index": {"$gte": length}})
+        self._keyframes.delete_many({"session": session, "index": {"$gt": length}})
+
+    def _meta(self, session: str, meta: str):
+        self._sessions.replace_one({"_id": session}, {"_id": session, "meta": meta}, upsert=True)
+
+    def _copy(self, source: str, target: str):
+        for collection in (self._diffs, self._keyframes):
+            collection.delete_many({"session": target})
+            documents = [{**document, "session": target}
+                         for document in collection.find({"session": source}, {"_id": False})]
+            if documents:
+                collection.insert_many(documents)
+        self._meta(target, self.meta(source) or "{}")
+
+    def _save_slot(self, session: str, name: str, meta: str):
+        self._copy(session, slot_key(session, name))
+        self._slots.replace_one({"session": session, "name": name},
+                                {"session": session, "name": name, "meta": meta}, upsert=True)
+
+    def _load_slot(self, session: str, name: str):
+        self._copy(slot_key(session, name), session)
+
+    def length(self, session: str) -> int:
+        last = self._diffs.find_one({"session": session}, sort=[("index", -1)])
+        return 0 if last is None else last["index"] + 1
+
+    def diffs(self, session: str, start: int, stop: int) -> list[str]:
+        cursor = self._diffs.find({"session": session, "index": {"$gte": start, "$lt": stop}}).sort("index", 1)
+        return [document["data"] for document in cursor]
+
+    def scene_starts(self, session: str) -> list[int]:
+        cursor = self._diffs.find({"session": session, "scene": True}, {"index": True}).sort("index", 1)
+        return [document["index"] for document in cursor]
+
+    def keyframe(self, session: str, length: int) -> str | None:
+        document = self._keyframes.find_one({"session": session, "index": length})
+        return document and document["state"]
+
+    def meta(self, session: str) -> str | None:
+        document = self._sessions.find_one({"_id": session})
+        return document and document["meta"]
+
+    def slots(self, session: str) -> dict[str, str]:
+        return {document["name"]: document["meta"] for document in self._slots.find({"session": session})}
+
+
+def open_backend(url: str = STORE_URL):
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url.removeprefix("sqlite:///"))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    if url.startswith(("mongodb://", "mongodb+srv://")):
+        return MongoBackend(url)
+    raise ValueError(f"unsupported VNML_STORE: {url}")
+
+
+class _Journal:
+    """Queues the changes to the history of one session for the store."""
+
+    def __init__(self, store: "SessionStore", session: str):
+        self.store = store
+        self.session = session
+
+    def appended(self, history: HistoryBuffer):
+        index = len(history) - 1
+        self.store._put(("append", self.session, index, json.dumps(history[index]), history.is_scene(index)))
+        if len(history) % KEYFRAME_INTERVAL == 0:
+            self.store._put(("keyframe", self.session, len(history), json.dumps(history.state_at(index))))
+
+    def truncated(self, history: HistoryBuffer, length: int):
+        self.store._put(("truncate", self.session, length))
+
+
+class SessionStore:
+    """Writes sessions to a backend in batches, from a thread of its own, and reads them back."""
+
+    def __init__(self, backend=None, flush_interval: float = FLUSH_INTERVAL):
+        self._backend = backend
+        self._opening = threading.Lock()
+        self.flush_interval = flush_interval
+        self.batches = 0
+        self.writes = 0
+        self._pending: list[tuple] = []
+        self._meta_at: dict[str, int] = {}  # session -> index in _pending of its queued position
+        self._queued = self._written = 0
+        self._flush_requested = False
+        self._changed = threading.Condition()
+        self._writer: threading.Thread | None = None
+
+    @property
+    def backend(self):
+        with self._opening:
+            if self._backend is None:
+                self._backend = open_backend()
+        return self._backend
+
+    def _put(self, op: tuple):
+        kind, session = op[:2]
+        with self._changed:
+            if kind == "meta" and session in self._meta_at:
+                self._pending[self._meta_at[session]] = op
+            else:
+                if kind == "meta":
+                    self._meta_at[session] = len(self._pending)
+                elif kind in ("save_slot", "load_slot"):
+                    # Positions queued from here on are not those of the story saved, or replaced.
+                    self._meta_at.pop(session, None)
+                self._pending.append(op)
+            self._queued += 1
+            self._changed.notify_all()
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, name="vnml-store", daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _write(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._pending)
+                # Let a batch build up, unless someone is waiting for it.
+                self._changed.wait_for(lambda: self._flush_requested, timeout=self.flush_interval)
+                self._flush_requested = False
+                ops, self._pending, self._meta_at = self._pending, [], {}
+                queued = self._queued
+            try:
+                self.backend.write(ops)
+                self.batches += 1
+                self.writes += len(ops)
+            except Exception:
+                logger.exception("dropped %d session writes", len(ops))
+            with self._changed:
+                self._written = queued
+                self._changed.notify_all()
+
+    def flush(self):
+        """Wait until everything queued so far is committed."""
+        with self._changed:
+            queued = self._queued
+            if self._written < queued:
+                self._flush_requested = True
+                self._changed.notify_all()
+                self._changed.wait_for(lambda: self._written >= queued)
+
+    def open(self, session: str) -> HistoryBuffer:
+        """The stored history of `session`, empty if none, persisting what is appended to it."""
+        self.flush()
+        backend = self.backend
+
+        def load(start: int, stop: int) -> tuple[dict, list[dict]]:
+            state = json.loads(backend.keyframe(session, start) or "{}") if start else {}
+            return state, [json.loads(data) for data in backend.diffs(session, start, stop)]
+
+        history = HistoryBuffer.paged(backend.length(session), backend.scene_starts(session), load)
+        history.journal = _Journal(self, session)
+        return history
+
+    def save_position(self, session: str, pointer: int, lang: str):
+        """Remember where `session` is; only the last position queued before a commit is written."""
+        self._put(("meta", session, json.dumps({"pointer": pointer, "lang": lang})))
+
+    def position(self, session: str) -> dict:
+        """`{"pointer": ..., "lang": ...}` as last saved for `session`, if ever."""
+        self.flush()
+        return json.loads(self.backend.meta(session) or "{}")
+
+    def save_slot(self, session: str, name: str, pointer: int, length: int, lang: str):
+        """Save a copy of the story of `session` as it is now, to be loaded back by `load_slot`."""
+        self.save_position(session, pointer, lang)
+        meta = {"pointer": pointer, "length": length, "lang": lang, "saved": time.strftime("%Y-%m-%d %H:%M")}
+        self._put(("save_slot", session, name, json.dumps(meta)))
+
+    def load_slot(self, session: str, name: str) -> dict:
+        """Replace the story of `session` with the one saved as `name`; returns the position it was saved at."""
+        self._put(("load_slot", session, name))
+        drop_history(session)
+        meta = self.slots(session).get(name, {})
+        return {key: meta[key] for key in ("pointer", "lang") if key in meta}
+
+    def slots(self, session: str) -> dict[str, dict]:
+        """The slots saved for `session`, by name."""
+        self.flush()
+        return {name: json.loads(meta) for name, meta in self.backend.slots(session).items()}
+
+
+store = SessionStore()
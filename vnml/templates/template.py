@@ -3,7 +3,7 @@
 from __future__ import annotations
 
 from vnml import styles
-from vnml.components.sidebar import sidebar
+from vnml.components.sidebar import pages, sidebar
 from typing import Callable
 
 import reflex as rx
@@ -38,8 +38,6 @@ def menu_button() -> rx.Component:
     Returns:
         The menu button component.
     """
-    from reflex.page import get_decorated_pages
-
     return rx.box(
         rx.menu.root(
             rx.menu.trigger(
@@ -49,10 +47,7 @@ def menu_button() -> rx.Component:
                 )
             ),
             rx.menu.content(
-                *[
-                    menu_item_link(page["title"], page["route"])
-                    for page in get_decorated_pages()
-                ],
+                *[menu_item_link(title, route) for title, route in pages()],
                 rx.menu.separator(),
                 menu_item_link("About", "https://github.com/reflex-dev"),
                 menu_item_link("Contact", "mailto:founders@=reflex.dev"),
@@ -4,6 +4,10 @@
 from vnml.pages import *
 
 import reflex as rx
+from reflex.app import EventNamespace
+
+from vnml.media_cache import media_stats, serve_media
+from vnml.scheduler import scheduler, scheduler_stats
 
 
 class State(rx.State):
@@ -12,3 +16,9 @@ class State(rx.State):
 
 # Create the app.
 app = rx.App()
+app.api.add_api_route("/media/{service}/{path:path}", serve_media)
+app.api.add_api_route("/media-stats", media_stats)
+app.api.add_api_route("/scheduler-stats", scheduler_stats)
+
+# Reflex only knows the sockets of clients that sent an event; a generation always follows one.
+scheduler.connected = lambda session: session in EventNamespace.token_to_sid